@@ -1,5 +1,5 @@
 from pathlib import Path
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 import json
 import platform
 import argparse
@@ -7,7 +7,7 @@ import math
 import torch
 
 from lvae.models.registry import get_model
-from lvae.evaluation import imcoding_evaluate
+from lvae.evaluation import imcoding_evaluate_parallel
 
 
 @torch.no_grad()
@@ -19,6 +19,11 @@ def main():
     parser.add_argument('-s', '--steps',        type=int,   default=16)
     parser.add_argument('-n', '--dataset_name', type=str,   default='tecnick-rgb-1200')
     parser.add_argument('-d', '--device',       type=str,   default='cuda:0')
+    parser.add_argument('--lambdas',            type=float, default=None, nargs='+',
+                        help='evaluate these lambdas instead of --lmb_range and --steps')
+    parser.add_argument('-w', '--workers',      type=int,   default=0, help='CPU worker processes')
+    parser.add_argument('--loader_workers',     type=int,   default=2)
+    parser.add_argument('--cache_dir',          type=str,   default='runs/eval-cache')
     args = parser.parse_args()
 
     kwargs = eval(f'dict({args.model_args})')
@@ -29,25 +34,22 @@ def main():
     model.compress_mode()
 
     start, end = args.lmb_range
-    lambdas = torch.linspace(math.log(start), math.log(end), steps=args.steps).exp().tolist()
+    lambdas = args.lambdas or torch.linspace(math.log(start), math.log(end), steps=args.steps).exp().tolist()
 
     save_json_path = Path(f'runs/results/{args.dataset_name}-{args.model}.json')
     if not save_json_path.parent.is_dir():
         print(f'Creating {save_json_path.parent} ...')
         save_json_path.parent.mkdir(parents=True)
 
-    all_lmb_stats = defaultdict(list)
-    for lmb in lambdas:
-        if hasattr(model, 'default_lmb'):
-            model.default_lmb = lmb
-        else:
-            print(f'==== model {args.model} is deprecated. Please use new ones instead ====')
-            model._default_log_lmb = math.log(lmb)
-        results = imcoding_evaluate(model, args.dataset_name)
-        print(results)
-
-        for k,v in results.items():
-            all_lmb_stats[k].append(v)
+    if not hasattr(model, 'default_lmb'):
+        print(f'==== model {args.model} is not variable-rate. Evaluating at its fixed rate ====')
+        lambdas = None
+    # per-image results are cached in args.cache_dir, so only new lambdas or images are computed
+    all_lmb_stats = imcoding_evaluate_parallel(
+        model, args.dataset_name, lambdas=lambdas, loader_workers=args.loader_workers,
+        workers=args.workers, model_spec=(args.model, kwargs), cache_dir=args.cache_dir
+    )
+    all_lmb_stats.pop('lambda')
     # save to json
     json_data = OrderedDict()
     json_data['name'] = args.model
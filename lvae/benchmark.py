@@ -0,0 +1,489 @@
+""" Benchmark suite for the registered models.
+
+Measures encoding / decoding latency (p50, p95, p99), throughput, peak RSS and CUDA memory, and the
+time spent in entropy coding versus the network, across resolutions, batch sizes and thread counts.
+Results are saved as versioned JSON, and `compare_results()` flags regressions against a baseline.
+See `scripts/benchmark-lvae.py` for the command line interface.
+"""
+from pathlib import Path
+from collections import OrderedDict
+import gc
+import os
+import json
+import time
+import platform
+import threading
+import subprocess
+import numpy as np
+import torch
+import torch.nn.functional as tnf
+import torchvision.transforms.functional as tvf
+from PIL import Image, ImageOps
+
+from lvae.paths import known_datasets
+from lvae.models.registry import get_model
+from lvae.profiling import current_rss
+
+BENCHMARK_VERSION = 1
+# (height, width), from 256x256 to 4K
+DEFAULT_RESOLUTIONS = [(256, 256), (512, 512), (1024, 1024), (1080, 1920), (2160, 3840)]
+
+
+def synthetic_images(num, height, width, seed=0):
+    """ Synthetic images with natural-image-like statistics: smooth random fields at several \
+        scales plus fine noise. Deterministic given the seed.
+
+    Returns:
+        list[np.ndarray]: uint8 images, each (H, W, 3)
+    """
+    gen = torch.Generator().manual_seed(seed)
+    images = []
+    for _ in range(num):
+        im = torch.zeros(1, 3, height, width)
+        for scale in (64, 16, 4):
+            noise = torch.rand(1, 3, height // scale + 2, width // scale + 2, generator=gen)
+            im += tnf.interpolate(noise, size=(height, width), mode='bilinear', align_corners=False)
+        im = im / 3 + (torch.rand(1, 3, height, width, generator=gen) - 0.5) * 0.05
+        im = im.clamp_(0, 1).squeeze(0).permute(1, 2, 0).mul_(255).round_()
+        images.append(im.to(dtype=torch.uint8).numpy())
+    return images
+
+
+def dataset_images(dataset, num, height, width):
+    """ The first `num` images of a dataset, resized and center-cropped to (height, width).
+
+    Returns:
+        list[np.ndarray]: uint8 images, each (H, W, 3)
+    """
+    root = known_datasets.get(dataset, Path(dataset))
+    img_paths = sorted(root.rglob('*.*'))[:num]
+    assert len(img_paths) > 0, f'Found no image in {root}'
+    images = []
+    for i in range(num): # repeat images if there are not enough
+        img = Image.open(img_paths[i % len(img_paths)]).convert('RGB')
+        images.append(np.asarray(ImageOps.fit(img, (width, height))))
+    return images
+
+
+class _RssSampler():
+    """ Sample the resident set size of this process in a background thread, to get the peak \
+        RSS of a code region. `resource.getrusage()` only reports the peak of the whole process.
+    """
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+class CoderTimer():
+    """ Accumulate the wall time of entropy coding in a model. While active, the `compress` and \
+        `decompress` methods of all compressai entropy models in the model, the model's \
+        `_entropy_encode` (if any), and the background encoding of asynchronous host transfers \
+        (`entropy_coding._encode_on_host`, see `set_async_transfer()`) are wrapped. Background \
+        encoding overlaps with the network, so the total can be larger than the wall time spent \
+        waiting for it.
+    """
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+        self.total = 0.0
+        self._local = threading.local() # nested calls are counted once, per thread
+        self._lock = threading.Lock()
+        self._wrapped = []
+
+    def reset(self):
+        self.total = 0.0
+
+    def _wrap(self, obj, name):
+        func = getattr(obj, name)
+        def _timed(*args, **kwargs):
+            depth = getattr(self._local, 'depth', 0)
+            self._local.depth = depth + 1
+            t_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+                if depth == 0:
+                    with self._lock:
+                        self.total += time.perf_counter() - t_start
+        # module attributes are restored to the original, instance attributes are removed
+        self._wrapped.append((obj, name, vars(obj).get(name, None)))
+        setattr(obj, name, _timed)
+
+    def __enter__(self):
+        from compressai.entropy_models import EntropyModel
+        import lvae.models.entropy_coding as entropy_coding
+        for module in self.model.modules():
+            if isinstance(module, EntropyModel):
+                self._wrap(module, 'compress')
+                self._wrap(module, 'decompress')
+        if hasattr(self.model, '_entropy_encode'):
+            self._wrap(self.model, '_entropy_encode')
+        self._wrap(entropy_coding, '_encode_on_host')
+        return self
+
+    def __exit__(self, *exc):
+        for obj, name, original in reversed(self._wrapped):
+            if original is None:
+                delattr(obj, name) # remove the instance attribute, ie, restore the class method
+            else:
+                setattr(obj, name, original)
+        self._wrapped = []
+
+
+class IdleTimer():
+    """ Accumulate the GPU idle time during entropy coding, measured by CUDA events around the \
+        host waits in entropy coding (see `entropy_coding.DeviceIdleTimer`). The total is zero \
+        on CPUs.
+    """
+    def __init__(self):
+        import lvae.models.entropy_coding as entropy_coding
+        self._entropy_coding = entropy_coding
+        self._timer = entropy_coding.DeviceIdleTimer()
+
+    def reset(self):
+        self._timer.reset()
+
+    @property
+    def total(self):
+        return self._timer.total
+
+    def __enter__(self):
+        self._entropy_coding.set_idle_timer(self._timer)
+        return self
+
+    def __exit__(self, *exc):
+        self._entropy_coding.set_idle_timer(None)
+
+
+def _sync(device: torch.device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def _latency_stats(values):
+    values = np.array(values)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]).tolist()
+    return {'mean': float(values.mean()), 'p50': p50, 'p95': p95, 'p99': p99}
+
+
+@torch.no_grad()
+def benchmark_config(model, images, repeats=5, warmup=1):
+    """ Benchmark compression and decompression of a batch of images.
+
+    Args:
+        model (torch.nn.Module): model in compress mode, with `compress_bytes` / `decompress_bytes`. \
+            Batches of more than one image use `compress_batch` / `decompress_batch`.
+        images (list[np.ndarray]): uint8 images of the same size, one batch
+        repeats (int, optional): number of measured iterations. Defaults to 5.
+        warmup (int, optional): number of warm-up iterations. Defaults to 1.
+
+    Returns:
+        dict: latency (seconds per batch), throughput (images/s), entropy coding and network \
+            time (seconds per batch), GPU idle time during entropy coding (seconds per batch, \
+            None on CPUs), peak memory (MB), and bpp
+    """
+    device = next(model.parameters()).device
+    if len(images) > 1:
+        tensors = [tvf.to_tensor(img).to(device=device) for img in images]
+        encode = lambda: model.compress_batch(tensors)
+        decode = lambda strings: model.decompress_batch(strings)
+    else:
+        encode = lambda: [model.compress_bytes(images[0])]
+        decode = lambda strings: [model.decompress_bytes(strings[0])]
+
+    enc_times, dec_times, enc_coder, dec_coder, enc_idle, dec_idle = [], [], [], [], [], []
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    with _RssSampler() as rss, CoderTimer(model) as timer, IdleTimer() as idle:
+        rss_start = rss.peak
+        for i in range(warmup + repeats):
+            timer.reset()
+            idle.reset()
+            t_start = time.perf_counter()
+            strings = encode()
+            _sync(device)
+            t_enc = time.perf_counter()
+            coder_time, idle_time = timer.total, idle.total
+            timer.reset()
+            idle.reset()
+            _ = decode(strings)
+            _sync(device)
+            t_dec = time.perf_counter()
+            if i >= warmup:
+                enc_times.append(t_enc - t_start)
+                dec_times.append(t_dec - t_enc)
+                enc_coder.append(coder_time)
+                dec_coder.append(timer.total)
+                enc_idle.append(idle_time)
+                dec_idle.append(idle.total)
+    num_pixels = images[0].shape[0] * images[0].shape[1]
+    stats = OrderedDict()
+    stats['encode'] = _latency_stats(enc_times)
+    stats['decode'] = _latency_stats(dec_times)
+    stats['throughput'] = {
+        'encode': len(images) * repeats / sum(enc_times),
+        'decode': len(images) * repeats / sum(dec_times),
+    }
+    stats['entropy_coding'] = {'encode': float(np.mean(enc_coder)), 'decode': float(np.mean(dec_coder))}
+    stats['network'] = {
+        'encode': float(np.mean(enc_times) - np.mean(enc_coder)),
+        'decode': float(np.mean(dec_times) - np.mean(dec_coder)),
+    }
+    stats['gpu_idle'] = None if (device.type != 'cuda') else {
+        'encode': float(np.mean(enc_idle)), 'decode': float(np.mean(dec_idle))
+    }
+    stats['peak_rss_mb'] = rss.peak / 2**20
+    stats['rss_increase_mb'] = (rss.peak - rss_start) / 2**20
+    stats['cuda_peak_mb'] = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else None
+    stats['bpp'] = float(np.mean([len(s) * 8 / num_pixels for s in strings]))
+    return stats
+
+
+def _environment(device):
+    env = OrderedDict()
+    env['python'] = platform.python_version()
+    env['pytorch'] = torch.__version__
+    env['cuda'] = torch.version.cuda
+    env['platform'] = platform.platform()
+    env['processor'] = platform.processor()
+    env['cpu_count'] = os.cpu_count()
+    device = torch.device(device)
+    env['device'] = str(device)
+    if device.type == 'cuda':
+        env['device_name'] = torch.cuda.get_device_name(device)
+    try:
+        env['git_commit'] = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, timeout=10,
+            cwd=Path(__file__).parent
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        env['git_commit'] = None
+    return env
+
+
+def benchmark_async_transfer(model, images, repeats=5, warmup=1):
+    """ Measure the GPU idle time removed by asynchronous host transfers (see `set_async_transfer()`), \
+    which overlap entropy coding and copies with the network. The idle time is measured by CUDA \
+    events around the host waits, with and without asynchronous transfers (see `IdleTimer`). \
+    On CPUs, there is no idle time to measure, and only the saved wall time is reported.
+
+    Returns:
+        dict: encoding and decoding latency (seconds per batch) with asynchronous transfers, \
+            GPU idle time per image (milliseconds) in both settings, the idle time removed per \
+            image (milliseconds, None on CPUs), and the wall time saved per image (milliseconds)
+    """
+    model.set_async_transfer(False)
+    sync_stats = benchmark_config(model, images, repeats=repeats, warmup=warmup)
+    model.set_async_transfer(True)
+    try:
+        async_stats = benchmark_config(model, images, repeats=repeats, warmup=warmup)
+    finally:
+        model.set_async_transfer(False)
+    per_image_ms = lambda seconds: seconds / len(images) * 1000
+    stats = OrderedDict()
+    stats['encode'] = async_stats['encode']
+    stats['decode'] = async_stats['decode']
+    if sync_stats['gpu_idle'] is None:
+        stats['gpu_idle_ms'] = None
+        stats['idle_removed_ms'] = None
+    else:
+        stats['gpu_idle_ms'] = {
+            mode: {k: per_image_ms(s['gpu_idle'][k]) for k in ('encode', 'decode')}
+            for mode, s in (('sync', sync_stats), ('async', async_stats))
+        }
+        stats['idle_removed_ms'] = {
+            k: per_image_ms(sync_stats['gpu_idle'][k] - async_stats['gpu_idle'][k]) for k in ('encode', 'decode')
+        }
+    stats['time_saved_ms'] = {
+        k: per_image_ms(sync_stats[k]['mean'] - async_stats[k]['mean']) for k in ('encode', 'decode')
+    }
+    return stats
+
+
+def run_benchmark(models, resolutions=DEFAULT_RESOLUTIONS, batch_sizes=(1,), threads=(None,),
+                  repeats=5, device='cpu', images='synthetic', model_kwargs=None, verbose=True,
+                  async_transfer=False):
+    """ Run the benchmark for all combinations of models, resolutions, thread counts, and batch sizes.
+
+    Args:
+        models (list[str]): registered model names, see `lvae.models.registry.list_models()`
+        resolutions (list[tuple]): (height, width) of the images
+        batch_sizes (list[int], optional): batch sizes. Models without `compress_batch` only run 1.
+        threads (list[int], optional): numbers of CPU threads. None means the current setting.
+        repeats (int, optional): number of measured iterations per configuration.
+        device (str, optional): device. Defaults to 'cpu'.
+        images (str, optional): 'synthetic', or a dataset name / path.
+        model_kwargs (dict, optional): kwargs for `get_model()`, eg, dict(pretrained=True).
+        verbose (bool, optional): print one line per configuration.
+        async_transfer (bool, optional): also measure asynchronous host transfers, for models \
+            with `set_async_transfer()`. See `benchmark_async_transfer()`.
+
+    Returns:
+        dict: versioned results, see `save_results()`
+    """
+    device = torch.device(device)
+    default_threads = torch.get_num_threads()
+    results = []
+    for name in models:
+        record = OrderedDict(model=name, device=str(device))
+        try:
+            model = get_model(name, **(model_kwargs or dict()))
+        except Exception as e:
+            results.append(OrderedDict(record, skipped=f'cannot build the model: {e}'))
+            continue
+        if not hasattr(model, 'compress_bytes'):
+            results.append(OrderedDict(record, skipped='no entropy coding (compress_bytes) API'))
+            continue
+        model = model.to(device=device)
+        model.eval()
+        model.compress_mode(True)
+        for (height, width) in resolutions:
+            if images == 'synthetic':
+                all_images = synthetic_images(max(batch_sizes), height, width)
+            else:
+                all_images = dataset_images(images, max(batch_sizes), height, width)
+            for num_threads in threads:
+                torch.set_num_threads(num_threads or default_threads)
+                for bs in batch_sizes:
+                    config = OrderedDict(record, height=height, width=width, batch_size=bs,
+                                         threads=torch.get_num_threads())
+                    if (bs > 1) and not hasattr(model, 'compress_batch'):
+                        continue
+                    try:
+                        stats = benchmark_config(model, all_images[:bs], repeats=repeats)
+                        if async_transfer and hasattr(model, 'set_async_transfer'):
+                            stats['async_transfer'] = benchmark_async_transfer(model, all_images[:bs], repeats=repeats)
+                    except (RuntimeError, MemoryError) as e: # eg, out of memory
+                        results.append(OrderedDict(config, error=str(e).splitlines()[0]))
+                        if device.type == 'cuda':
+                            torch.cuda.empty_cache()
+                        continue
+                    results.append(OrderedDict(config, **stats))
+                    if verbose:
+                        print(format_result(results[-1]))
+        del model
+        gc.collect()
+    torch.set_num_threads(default_threads)
+    data = OrderedDict()
+    data['version'] = BENCHMARK_VERSION
+    data['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    data['environment'] = _environment(device)
+    data['results'] = results
+    return data
+
+
+def format_result(r: dict):
+    """ One-line summary of a benchmark result """
+    head = f"{r['model']:<20s} {r['height']}x{r['width']} bs={r['batch_size']} threads={r['threads']}"
+    if 'error' in r:
+        return f'{head}: error: {r["error"]}'
+    enc, dec = r['encode'], r['decode']
+    return (f"{head}: encode p50={enc['p50']*1000:.1f}ms p99={enc['p99']*1000:.1f}ms "
+            f"(coder {r['entropy_coding']['encode']*1000:.1f}ms), "
+            f"decode p50={dec['p50']*1000:.1f}ms p99={dec['p99']*1000:.1f}ms "
+            f"(coder {r['entropy_coding']['decode']*1000:.1f}ms), "
+            f"{r['throughput']['encode']:.2f}/{r['throughput']['decode']:.2f} images/s, "
+            f"peak RSS={r['peak_rss_mb']:.0f}MB, bpp={r['bpp']:.3f}"
+            + ('' if ('async_transfer' not in r) else _format_async_transfer(r['async_transfer'])))
+
+
+def _format_async_transfer(stats: dict):
+    if stats.get('idle_removed_ms', None) is None: # no GPU
+        saved = stats['time_saved_ms']
+        return f", async transfer saves {saved['encode']:.1f}/{saved['decode']:.1f}ms per image"
+    removed, idle = stats['idle_removed_ms'], stats['gpu_idle_ms']['async']
+    return (f", async transfer removes {removed['encode']:.1f}/{removed['decode']:.1f}ms GPU idle "
+            f"per image ({idle['encode']:.1f}/{idle['decode']:.1f}ms left)")
+
+
+def save_results(data: dict, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, fp=f, indent=2)
+
+
+def load_results(path):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if data.get('version') != BENCHMARK_VERSION:
+        raise ValueError(f'{path} has benchmark version {data.get("version")}, expected {BENCHMARK_VERSION}')
+    return data
+
+
+# metric name -> (getter, True if higher is better)
+_compared_metrics = OrderedDict([
+    ('encode_p50',        (lambda r: r['encode']['p50'],        False)),
+    ('encode_p95',        (lambda r: r['encode']['p95'],        False)),
+    ('decode_p50',        (lambda r: r['decode']['p50'],        False)),
+    ('decode_p95',        (lambda r: r['decode']['p95'],        False)),
+    ('encode_throughput', (lambda r: r['throughput']['encode'], True)),
+    ('decode_throughput', (lambda r: r['throughput']['decode'], True)),
+    ('peak_rss_mb',       (lambda r: r['peak_rss_mb'],          False)),
+    ('cuda_peak_mb',      (lambda r: r['cuda_peak_mb'],         False)),
+])
+
+
+def _config_key(r: dict):
+    return (r['model'], r['device'], r['height'], r['width'], r['batch_size'], r['threads'])
+
+
+def compare_results(baseline: dict, current: dict, tolerance=0.1):
+    """ Compare two benchmark results, configuration by configuration.
+
+    Args:
+        baseline (dict): baseline results, see `run_benchmark()`
+        current (dict): current results
+        tolerance (float, optional): relative change that is considered a regression. Defaults to 0.1.
+
+    Returns:
+        list[dict]: one row per (configuration, metric), with the relative change (positive \
+            means worse) and whether it is a regression
+    """
+    valid = lambda r: ('skipped' not in r) and ('error' not in r)
+    base = {_config_key(r): r for r in baseline['results'] if valid(r)}
+    rows = []
+    for r in current['results']:
+        if not valid(r) or (_config_key(r) not in base):
+            continue
+        for metric, (getter, higher_is_better) in _compared_metrics.items():
+            b, c = getter(base[_config_key(r)]), getter(r)
+            if (b is None) or (c is None) or (b == 0):
+                continue
+            change = (b - c) / b if higher_is_better else (c - b) / b
+            rows.append(OrderedDict(config=_config_key(r), metric=metric, baseline=b, current=c,
+                                    change=change, regression=(change > tolerance)))
+    return rows
+
+
+def format_comparison(rows, only_regressions=False):
+    """ Format the output of `compare_results()` as a table """
+    lines = [f'{"model":<20s} {"size":>10s} {"bs":>3s} {"thr":>3s} {"metric":<18s} '
+             f'{"baseline":>10s} {"current":>10s} {"change":>8s}']
+    for row in rows:
+        if only_regressions and not row['regression']:
+            continue
+        model, _, h, w, bs, nt = row['config']
+        flag = '  REGRESSION' if row['regression'] else ''
+        lines.append(f'{model:<20s} {f"{h}x{w}":>10s} {bs:>3d} {nt:>3d} {row["metric"]:<18s} '
+                     f'{row["baseline"]:>10.4g} {row["current"]:>10.4g} {row["change"]*100:>+7.1f}%{flag}')
+    return '\n'.join(lines)
@@ -1,11 +1,14 @@
 from PIL import Image
 from pathlib import Path
+import io
+import hashlib
+import numpy as np
 from torch.utils.data import Dataset
 import torchvision as tv
 
 from lvae.paths import known_datasets
 
-__all__ = ['ImageDataset', 'get_image_dateset']
+__all__ = ['ImageDataset', 'ImageFileDataset', 'get_image_dateset']
 
 
 class ImageDataset(Dataset):
@@ -26,6 +29,28 @@ class ImageDataset(Dataset):
         return im
 
 
+class ImageFileDataset(Dataset):
+    """ Images for evaluation, in their original sizes. Each item is a dict with the image path, \
+    the SHA-1 of the file content, and the image as a uint8 (H, W, 3) array.
+    """
+    def __init__(self, image_paths):
+        self.image_paths = [Path(p) for p in image_paths]
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        impath = self.image_paths[index]
+        data = impath.read_bytes()
+        img = Image.open(io.BytesIO(data)).convert('RGB') # decode the bytes that are hashed
+        item = {
+            'path': str(impath),
+            'sha1': hashlib.sha1(data).hexdigest(),
+            'image': np.asarray(img, dtype=np.uint8)
+        }
+        return item
+
+
 def get_image_dateset(name: str, transform_cfg: str=None) -> Dataset:
     """ get image dataset from name
 
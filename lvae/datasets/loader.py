@@ -1,7 +1,7 @@
 import os
 from torch.utils.data import DataLoader, DistributedSampler
 
-__all__ = ['make_trainloader']
+__all__ = ['make_trainloader', 'make_evalloader']
 
 
 def _make_generator(dataloader: DataLoader):
@@ -30,3 +30,19 @@ def make_trainloader(dataset, batch_size: int, workers: int):
     )
     generater = _make_generator(dataloader)
     return generater, sampler
+
+
+def make_evalloader(dataset, workers: int, prefetch_factor=4):
+    """ Create evaluation data loader, which reads (and decodes) images one by one in the \
+    background, in the original order.
+
+    Args:
+        dataset (torch.utils.data.Dataset): PyTorch dataset, eg, `ImageFileDataset`
+        workers (int): number of CPU workers. If 0, images are read in the main process.
+        prefetch_factor (int, optional): number of items prefetched by each worker.
+    """
+    dataloader = DataLoader(
+        dataset, batch_size=None, shuffle=False, num_workers=workers,
+        prefetch_factor=(prefetch_factor if workers > 0 else None)
+    )
+    return dataloader
@@ -1,15 +1,19 @@
 from PIL import Image
 from tqdm import tqdm
 from pathlib import Path
-from tempfile import gettempdir
-from collections import defaultdict
+from collections import defaultdict, deque
+import json
 import math
+import hashlib
+import functools
 import torch
 import torchvision.transforms.functional as tvf
 from timm.utils import AverageMeter
 
 from lvae.paths import known_datasets
-from lvae.utils.coding import crop_divisible_by
+from lvae.utils.coding import crop_divisible_by, read_image, bd_rate
+from lvae.datasets.image import ImageFileDataset
+from lvae.datasets.loader import make_evalloader
 
 
 @torch.no_grad()
@@ -18,42 +22,24 @@ def imcoding_evaluate(model: torch.nn.Module, dataset: str):
 
     Args:
         model (torch.nn.Module): pytorch model. \
-            Need to have `compress_file` and `decompress_file` methods.
+            Need to have `compress_bytes` and `decompress_bytes` methods.
         dataset (str): dataset name or path to the dataset.
 
     Returns:
         dict[str -> float]: results, including bpp, mse, psnr.
     """
-    assert hasattr(model, 'compress_file')
-    assert hasattr(model, 'decompress_file')
+    assert hasattr(model, 'compress_bytes')
+    assert hasattr(model, 'decompress_bytes')
 
     # find images
     root = known_datasets.get(dataset, Path(dataset))
     img_paths = list(root.rglob('*.*'))
     img_paths.sort()
-    # temp folder to save bits
-    tmp_bits_dir = Path(gettempdir())
     # start for-loop
     pbar = tqdm(img_paths, ascii=True)
     all_image_stats = defaultdict(AverageMeter)
     for impath in pbar:
-        tmp_bits_path = tmp_bits_dir / f'{impath.stem}.bits'
-        model.compress_file(impath, tmp_bits_path)
-        num_bits = tmp_bits_path.stat().st_size * 8
-        fake = model.decompress_file(tmp_bits_path).squeeze(0).cpu()
-        tmp_bits_path.unlink()
-
-        # compute psnr
-        real = tvf.to_tensor(Image.open(impath))
-        mse = (real - fake).square().mean().item()
-        psnr = -10 * math.log10(mse)
-        # compute bpp
-        bpp = num_bits / float(real.shape[1] * real.shape[2])
-        stats = {
-            'bpp':  float(bpp),
-            'mse':  float(mse),
-            'psnr': float(psnr)
-        }
+        stats = evaluate_image_coding(model, Image.open(impath))
 
         # accumulate stats
         for k,v in stats.items():
@@ -68,13 +54,249 @@ def imcoding_evaluate(model: torch.nn.Module, dataset: str):
 
 
 @torch.no_grad()
-def image_self_evaluate(model: torch.nn.Module, dataset: str, progress=True):
+def evaluate_image_coding(model: torch.nn.Module, image, lmb=None):
+    """ Compress and decompress one image, and measure the rate and distortion.
+
+    Args:
+        model (torch.nn.Module): pytorch model, with `compress_bytes` and `decompress_bytes` methods.
+        image: image, see `lvae.utils.coding.read_image()`
+        lmb (float, optional): lambda, for variable-rate models. Defaults to the model's default.
+
+    Returns:
+        dict[str -> float]: bpp, mse, psnr
+    """
+    img = read_image(image)
+    string = model.compress_bytes(img) if (lmb is None) else model.compress_bytes(img, lmb=lmb)
+    num_bits = len(string) * 8
+    fake = model.decompress_bytes(string).squeeze(0).cpu()
+
+    # compute psnr
+    real = tvf.to_tensor(img)
+    mse = (real - fake).square().mean().item()
+    psnr = -10 * math.log10(mse)
+    # compute bpp
+    bpp = num_bits / float(real.shape[1] * real.shape[2])
+    stats = {
+        'bpp':  float(bpp),
+        'mse':  float(mse),
+        'psnr': float(psnr)
+    }
+    return stats
+
+
+def model_checksum(model: torch.nn.Module):
+    """ SHA-1 of the model class and all its parameters and buffers """
+    sha1 = hashlib.sha1(type(model).__name__.encode('utf-8'))
+    for name, value in sorted(model.state_dict().items()):
+        sha1.update(name.encode('utf-8'))
+        _update_sha1(sha1, value)
+    return sha1.hexdigest()
+
+
+def coding_config(model: torch.nn.Module):
+    """ Settings that change the bitstreams or reconstructions of a model but are not in its \
+    state dict: the model id (eg, of INT8 models, see `lvae.models.quantization`), the entropy \
+    coder and number of channel groups (see `set_entropy_coding()`), and deterministic \
+    decoding (see `set_deterministic()`).
+
+    Returns:
+        dict: JSON-serializable configuration
+    """
+    entropy_models = [m for m in model.modules() if hasattr(m, 'channel_groups') and hasattr(m, 'coder')]
+    config = {
+        'model_id': getattr(model, 'model_id', None),
+        'quantized': bool(getattr(model, 'quantized_layers', None)),
+        'channel_groups': sorted(set([int(m.channel_groups) for m in entropy_models])),
+        'coder': sorted(set([m.coder for m in entropy_models])),
+        'deterministic': any([getattr(m, 'deterministic', False) for m in model.modules()]),
+    }
+    return config
+
+
+def apply_coding_config(model: torch.nn.Module, config: dict):
+    """ Apply a configuration from `coding_config()` to a model built from the registry """
+    if config['quantized']:
+        raise ValueError('INT8 models cannot be built from the registry, use them in the main process')
+    if hasattr(model, 'set_entropy_coding') and config['coder']:
+        assert len(config['channel_groups']) == 1 and len(config['coder']) == 1, f'{config=}'
+        model.set_entropy_coding(channel_groups=config['channel_groups'][0], coder=config['coder'][0])
+    if hasattr(model, 'set_deterministic'):
+        model.set_deterministic(config['deterministic'])
+    assert coding_config(model) == config, f'{coding_config(model)=} != {config=}'
+    return model
+
+
+def _get_configured_model(config, name, **kwargs):
+    """ `lvae.models.registry.get_model()` followed by `apply_coding_config()`. A top-level \
+    function, such that worker processes build replicas with the same coding configuration.
+    """
+    from lvae.models.registry import get_model
+    return apply_coding_config(get_model(name, **kwargs), config)
+
+
+def _update_sha1(sha1, value):
+    # state dicts of quantized layers also have tuples of (quantized) tensors, and dtypes
+    if isinstance(value, (tuple, list)):
+        for v in value:
+            _update_sha1(sha1, v)
+    elif isinstance(value, torch.Tensor):
+        if value.is_quantized:
+            value = value.dequantize()
+        sha1.update(value.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    else:
+        sha1.update(str(value).encode('utf-8'))
+
+
+class EvalResultCache():
+    """ On-disk cache of per-image evaluation results, keyed by (model checksum, lambda, image hash). \
+    Results are appended to a JSONL file as soon as they are computed, such that an interrupted \
+    evaluation resumes from where it stopped.
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path (str or Path): JSONL file. Created if it does not exist.
+        """
+        self.path = Path(path)
+        self._results = dict()
+        if self.path.is_file():
+            with open(self.path, mode='r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError: # eg, a partially written last line
+                        continue
+                    key = self.make_key(record['model'], record['lambda'], record['sha1'])
+                    self._results[key] = record
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(checksum, lmb, sha1):
+        # lambdas are compared up to 6 significant digits
+        return (checksum, None if (lmb is None) else f'{float(lmb):.6g}', sha1)
+
+    def __contains__(self, key):
+        return key in self._results
+
+    def __getitem__(self, key):
+        return self._results[key]
+
+    def put(self, record: dict):
+        """ Add a record, which has `model`, `lambda`, and `sha1` fields, and append it to the file """
+        key = self.make_key(record['model'], record['lambda'], record['sha1'])
+        self._results[key] = record
+        with open(self.path, mode='a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+@torch.no_grad()
+def imcoding_evaluate_parallel(model: torch.nn.Module, dataset: str, lambdas=None, loader_workers=2,
+                               workers=0, model_spec=None, cache_dir='runs/eval-cache', progress=True,
+                               image_func=None):
+    """ Evaluate image coding performance on a dataset at multiple lambdas, with entropy coding. \
+    Images are read by a prefetching `DataLoader`, and each (image, lambda) is evaluated in the \
+    main process or in CPU worker processes (see `lvae.serving.ModelWorkerProcesses`). \
+    Per-image results are cached in `cache_dir`, so only new (model, lambda, image) are computed. \
+    The model is identified by its weights and its coding configuration (see `coding_config()`), \
+    which is also applied to the replicas in worker processes.
+
+    Args:
+        model (torch.nn.Module): pytorch model. See `evaluate_image_coding()`.
+        dataset (str): dataset name or path to the dataset.
+        lambdas (list[float], optional): lambdas. If None, use the model's default.
+        loader_workers (int, optional): number of image reading processes. Defaults to 2.
+        workers (int, optional): number of CPU worker processes hosting model replicas. \
+            Defaults to 0, ie, run the model in the main process.
+        model_spec (tuple, optional): (registered name, kwargs) to build replicas in worker \
+            processes. Defaults to (`model.model_id`, {}).
+        cache_dir (str, optional): directory of the result cache. Defaults to 'runs/eval-cache'.
+        progress (bool, optional): show a progress bar. Defaults to True.
+        image_func (callable, optional): (model, image, lmb) -> dict of bpp, mse, and psnr. \
+            A top-level function, such that it can be sent to worker processes. Results are \
+            cached separately for each function. Defaults to `evaluate_image_coding()`.
+
+    Returns:
+        dict[str -> list[float]]: results averaged over images, one value per lambda, \
+            same structure as `VariableRateLossyVAE.self_evaluate()`
+    """
+    root = known_datasets.get(dataset, Path(dataset))
+    img_paths = sorted(root.rglob('*.*'))
+    lambdas = [None] if (lambdas is None) else [float(lmb) for lmb in lambdas]
+    config = coding_config(model)
+    checksum = hashlib.sha1(model_checksum(model).encode('utf-8'))
+    checksum.update(json.dumps(config, sort_keys=True).encode('utf-8'))
+    checksum = checksum.hexdigest()
+    if image_func is None:
+        image_func = evaluate_image_coding
+        cache_name = f'{checksum[:16]}.jsonl'
+    else:
+        cache_name = f'{checksum[:16]}-{image_func.__module__}.{image_func.__name__}.jsonl'
+    cache = EvalResultCache(Path(cache_dir) / cache_name)
+
+    replicas = None
+    if workers > 0:
+        from lvae.serving import ModelPool, ModelWorkerProcesses
+        name, kwargs = model_spec or (model.model_id, dict())
+        if config['quantized']:
+            raise ValueError('INT8 models cannot be evaluated in worker processes, use workers=0')
+        pool = ModelPool(device='cpu', model_func=functools.partial(_get_configured_model, config))
+        pool.add(name, model, **kwargs)
+        replicas = ModelWorkerProcesses(pool, num_workers=workers)
+
+    def _finish(future, record):
+        stats = future.result()[0] if (replicas is not None) else future
+        record.update(stats)
+        cache.put(record)
+
+    loader = make_evalloader(ImageFileDataset(img_paths), workers=loader_workers)
+    pbar = tqdm(loader, ascii=True) if progress else loader
+    all_sha1 = []
+    pending = deque()
+    try:
+        for item in pbar:
+            all_sha1.append(item['sha1'])
+            for lmb in lambdas:
+                if cache.make_key(checksum, lmb, item['sha1']) in cache:
+                    continue
+                record = {'model': checksum, 'lambda': lmb, 'sha1': item['sha1'], 'image': item['path']}
+                image = item['image'].numpy()
+                if replicas is None:
+                    _finish(image_func(model, image, lmb=lmb), record)
+                    continue
+                params = [{'lmb': lmb, 'image_func': image_func}]
+                future = replicas.submit(name, kwargs, 'evaluate', [image], params)
+                pending.append((future, record))
+                while len(pending) >= 2 * workers: # bound the number of images in flight
+                    _finish(*pending.popleft())
+        while pending:
+            _finish(*pending.popleft())
+    finally:
+        if replicas is not None:
+            replicas.shutdown()
+
+    # average over all images
+    all_lmb_stats = defaultdict(list)
+    for lmb in lambdas:
+        all_image_stats = defaultdict(AverageMeter)
+        for sha1 in all_sha1:
+            record = cache[cache.make_key(checksum, lmb, sha1)]
+            for k in ('bpp', 'mse', 'psnr'):
+                all_image_stats[k].update(record[k])
+        for k, meter in all_image_stats.items():
+            all_lmb_stats[k].append(meter.avg)
+        all_lmb_stats['lambda'].append(lmb)
+    return all_lmb_stats
+
+
+@torch.no_grad()
+def image_self_evaluate(model: torch.nn.Module, dataset: str, progress=True, loader_workers=2):
     """ Evaluate the model on a dataset with the model's `forward()` function.
     Typically, no entropy coding is used.
 
     Args:
         model (torch.nn.Module): pytorch model
         dataset (str): dataset name or path to the dataset.
+        loader_workers (int, optional): number of image reading processes. Defaults to 2.
 
     Returns:
         dict[str -> float]: results
@@ -84,10 +306,12 @@ def image_self_evaluate(model: torch.nn.Module, dataset: str, progress=True):
     root = known_datasets.get(dataset, Path(dataset))
     img_paths = sorted(root.rglob('*.*'))
     # evaluate on all images and average the results
-    pbar = tqdm(img_paths, ascii=True) if progress else img_paths
+    loader = make_evalloader(ImageFileDataset(img_paths), workers=loader_workers)
+    pbar = tqdm(loader, ascii=True) if progress else loader
     all_image_stats = defaultdict(AverageMeter)
-    for impath in pbar:
-        img = Image.open(impath)
+    for item in pbar:
+        impath = Path(item['path'])
+        img = Image.fromarray(item['image'].numpy())
         if hasattr(model, 'max_stride'):
             img = crop_divisible_by(img, div=model.max_stride)
         im = tvf.to_tensor(img).unsqueeze_(0).to(device=device)
@@ -148,3 +372,28 @@ def video_fast_evaluate(model: torch.nn.Module, dataset='uvg-1080p', max_frames=
     count = accumulated_stats.pop('count')
     results = {k: v/count for k,v in accumulated_stats.items()}
     return results
+
+
+# rate-distortion results of VTM 18.0, the anchor of BD-rate
+_results_root = Path(__file__).parent.parent / 'results'
+vtm_anchor_paths = {
+    'kodak': _results_root / 'kodak/kodak-vtm18.0.json',
+    'tecnick-rgb-1200': _results_root / 'tecnick-rgb-1200/tecnick-rgb-1200-vtm18.0.json',
+    'clic2022-test': _results_root / 'clic2022-test/clic2022-test-vtm18.0.json'
+}
+
+def read_rd_stats_from_json(json_path):
+    with open(json_path, mode='r') as f:
+        stats = json.load(fp=f)
+    assert isinstance(stats, dict)
+    stats = stats.get('results', stats)
+    return stats
+
+def get_anchor_stats(dataset_name):
+    anchor_stats = read_rd_stats_from_json(vtm_anchor_paths[dataset_name])
+    return anchor_stats
+
+def compute_bd_rate_over_anchor(stats, dataset_name):
+    anchor_stats = get_anchor_stats(dataset_name)
+    bdr = bd_rate(anchor_stats['bpp'], anchor_stats['psnr'], stats['bpp'], stats['psnr'])
+    return bdr
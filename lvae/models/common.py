@@ -1,5 +1,7 @@
 from collections import OrderedDict
+from contextlib import contextmanager
 import math
+import threading
 import torch
 import torch.nn as nn
 import torch.nn.functional as tnf
@@ -107,6 +109,63 @@ def sinusoidal_embedding(values: torch.Tensor, dim=256, max_period=64):
     return embedding
 
 
+_batch_invariant = threading.local()
+
+@contextmanager
+def batch_invariant():
+    """ Within this context, `per_sample()` runs its function on each sample separately. Used by \
+    the entropy coding paths that run in batches, where the CDF indexes of an image must not \
+    depend on the batch. The flag is per thread, so other threads keep the batched kernels.
+    """
+    previous = getattr(_batch_invariant, 'enabled', False)
+    _batch_invariant.enabled = True
+    try:
+        yield
+    finally:
+        _batch_invariant.enabled = previous
+
+
+def per_sample(func, x: torch.Tensor):
+    """ Apply `func` to each sample of a batch separately within `batch_invariant()`, such that \
+    the output of a sample does not depend on the batch. Eg, a matrix product over all \
+    (N x H x W) rows may use different kernels, and summation orders, for different batch sizes. \
+    Outside of `batch_invariant()`, `func` is applied to the whole batch.
+    """
+    if (x.shape[0] == 1) or not getattr(_batch_invariant, 'enabled', False):
+        return func(x)
+    return torch.cat([func(xi) for xi in x.split(1, dim=0)], dim=0)
+
+
+class AdaLNParams():
+    """ Precomputed AdaLN (shift, scale) of a set of `ConvNeXtBlockAdaLN` blocks. \
+    It can be passed to the blocks in place of the (lambda) embedding.
+    """
+    def __init__(self, params: dict):
+        """
+        Args:
+            params (dict): block (nn.Module) -> (shift, scale), each of shape (N, 1, 1, C)
+        """
+        self.params = params
+
+    def __getitem__(self, block):
+        return self.params[block]
+
+    @staticmethod
+    def cat(all_params):
+        """ Concatenate a list of AdaLNParams along the batch dimension
+
+        Args:
+            all_params (list[AdaLNParams]): a list of AdaLNParams for the same blocks
+        """
+        blocks = all_params[0].params.keys()
+        params = dict()
+        for block in blocks:
+            shift = torch.cat([p[block][0] for p in all_params], dim=0)
+            scale = torch.cat([p[block][1] for p in all_params], dim=0)
+            params[block] = (shift, scale)
+        return AdaLNParams(params)
+
+
 class ConvNeXtBlockAdaLN(nn.Module):
     default_embedding_dim = 256
     def __init__(self, dim, embed_dim=None, out_dim=None, kernel_size=7, mlp_ratio=2,
@@ -139,7 +198,69 @@ class ConvNeXtBlockAdaLN(nn.Module):
         self.residual = residual
         self.requires_embedding = True
 
+        # fused inference path, see `fuse_for_inference()`
+        self.register_buffer('_fused_fc2_weight', None, persistent=False)
+        self.register_buffer('_fused_fc2_bias', None, persistent=False)
+
+    @torch.no_grad()
+    def fuse_for_inference(self, mode=True):
+        """ Enable (or disable) the fused inference path, where the layer scaling (gamma) is \
+        folded into the second linear layer of the MLP. Must be called again if weights change.
+
+        Args:
+            mode (bool): enable or disable the fused path
+        """
+        if (not mode) or not isinstance(self.mlp.fc2, nn.Linear): # eg, INT8-quantized
+            self._fused_fc2_weight = None
+            self._fused_fc2_bias = None
+            return
+        weight, bias = self.mlp.fc2.weight, self.mlp.fc2.bias
+        if self.gamma is not None:
+            gamma = self.gamma.view(-1)
+            weight = weight * gamma.view(-1, 1)
+            bias = bias * gamma
+        self._fused_fc2_weight = weight.detach().clone()
+        self._fused_fc2_bias = bias.detach().clone()
+
+    def get_adaln_params(self, emb):
+        """ Get the AdaLN (shift, scale) from the embedding
+
+        Args:
+            emb (torch.Tensor or AdaLNParams): embedding, or precomputed AdaLN parameters
+        """
+        if isinstance(emb, AdaLNParams):
+            return emb[self]
+        embedding = self.embedding_layer(emb)
+        shift, scale = torch.chunk(embedding, chunks=2, dim=-1)
+        return shift, scale
+
+    def _fused_mlp(self, x):
+        x = self.mlp.act(self.mlp.fc1(x))
+        return tnf.linear(x, self._fused_fc2_weight, self._fused_fc2_bias)
+
+    def forward_fused(self, x, emb):
+        """ Inference-only forward pass that keeps activations in channels_last memory format. \
+        The NCHW <-> NHWC permutations are views of the same memory, so no copies are made.
+        """
+        x = x.contiguous(memory_format=torch.channels_last)
+        shortcut = x
+        # depthwise conv
+        x = self.conv_dw(x)
+        # layer norm over channels. For channels_last tensors, NHWC is contiguous
+        x = self.norm(x.permute(0, 2, 3, 1))
+        # AdaLN
+        shift, scale = self.get_adaln_params(emb)
+        x = torch.addcmul(shift, x, 1 + scale)
+        # MLP, with gamma folded into the second linear layer
+        x = per_sample(self._fused_mlp, x)
+        x = x.permute(0, 3, 1, 2)
+        if self.residual:
+            x = x.add_(shortcut)
+        return x
+
     def forward(self, x, emb):
+        if (self._fused_fc2_weight is not None) and not torch.is_grad_enabled():
+            return self.forward_fused(x, emb)
         shortcut = x
         # depthwise conv
         x = self.conv_dw(x)
@@ -147,11 +268,11 @@ class ConvNeXtBlockAdaLN(nn.Module):
         x = x.permute(0, 2, 3, 1).contiguous()
         x = self.norm(x)
         # AdaLN
-        embedding = self.embedding_layer(emb)
-        shift, scale = torch.chunk(embedding, chunks=2, dim=-1)
+        shift, scale = self.get_adaln_params(emb)
         x = x * (1 + scale) + shift
-        # MLP
-        x = self.mlp(x)
+        # MLP. In batched entropy coding, it runs per sample, so the CDF indexes are the same as
+        # in single-image coding (see `batch_invariant()`)
+        x = per_sample(self.mlp, x)
         x = x.permute(0, 3, 1, 2).contiguous()
         # scaling
         if self.gamma is not None:
@@ -160,3 +281,17 @@ class ConvNeXtBlockAdaLN(nn.Module):
             x = x + shortcut
         return x
 
+
+def fuse_adaln_blocks(model: nn.Module, mode=True):
+    """ Enable (or disable) the fused inference path of all `ConvNeXtBlockAdaLN` in a model. \
+    When enabled, the model weights are also converted to channels_last memory format.
+
+    Args:
+        model (nn.Module): a model
+        mode (bool): enable or disable the fused path
+    """
+    for module in model.modules():
+        if isinstance(module, ConvNeXtBlockAdaLN):
+            module.fuse_for_inference(mode)
+    memory_format = torch.channels_last if mode else torch.contiguous_format
+    return model.to(memory_format=memory_format)
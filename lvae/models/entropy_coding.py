@@ -1,11 +1,24 @@
+import os
 import math
+import hashlib
+import threading
 import scipy.stats
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import torch
 import torch.distributions as td
 
+import compressai
+from compressai import ans
 from compressai.ops import LowerBound
 from compressai.entropy_models import GaussianConditional
 
+import lvae.utils.coding as coding
+import lvae.models.rans as rans
+
 
 def _to_float32(*args):
     if len(args) == 1:
@@ -25,6 +38,172 @@ def _safe_log_prob_mass(distribution, x, bin_size, prob_clamp):
     return log_prob
 
 
+def rans_encode(job):
+    """ Encode symbols with the compressai rANS coder. A top-level function such that \
+        it can be used by both thread pools and process pools.
+
+    Args:
+        job (tuple): (symbols, indexes, cdf, cdf_lengths, offsets), \
+            where symbols and indexes are 1-D np.ndarray, and the others are lists.
+    """
+    symbols, indexes, cdf, cdf_lengths, offsets = job
+    return ans.RansEncoder().encode_with_indexes(symbols.tolist(), indexes.tolist(),
+                                                 cdf, cdf_lengths, offsets)
+
+
+def rans_decode(job):
+    """ Decode symbols with the compressai rANS coder. See `rans_encode()`.
+
+    Args:
+        job (tuple): (string, indexes, cdf, cdf_lengths, offsets)
+    """
+    string, indexes, cdf, cdf_lengths, offsets = job
+    if not isinstance(string, bytes): # eg, a memoryview of a container
+        string = bytes(string)
+    values = ans.RansDecoder().decode_with_indexes(string, indexes.tolist(),
+                                                   cdf, cdf_lengths, offsets)
+    return np.array(values, dtype=np.int32)
+
+
+def numpy_rans_encode(job):
+    """ Encode symbols with the NumPy interleaved rANS coder, see `lvae.models.rans`.
+
+    Args:
+        job (tuple): (symbols, indexes, tables), where tables is a `rans.RansTables`
+    """
+    symbols, indexes, tables = job
+    return rans.encode(symbols, indexes, tables)
+
+
+def numpy_rans_decode(job):
+    """ Decode symbols with the NumPy interleaved rANS coder, see `lvae.models.rans`.
+
+    Args:
+        job (tuple): (string, indexes, tables), where tables is a `rans.RansTables`
+    """
+    string, indexes, tables = job
+    return rans.decode(string, indexes, tables)
+
+
+def run_job(job):
+    """ Run an entropy coding job, (function, args), as given by `DiscretizedGaussian.encode_jobs()`
+    """
+    func, args = job
+    return func(args)
+
+
+class CDFTables():
+    """ Quantized CDF tables of an entropy model. Identical tables are computed only once \
+        and shared by all entropy models, see `get_cdf_tables()`.
+    """
+    def __init__(self, quantized_cdf, cdf_length, offset):
+        self.quantized_cdf = quantized_cdf
+        self.cdf_length = cdf_length
+        self.offset = offset
+        self._lists = None
+        self._rans_tables = None
+
+    def as_lists(self):
+        """ (cdf, cdf_lengths, offsets) as python lists, for the compressai rANS coder """
+        if self._lists is None:
+            self._lists = (
+                self.quantized_cdf.tolist(),
+                self.cdf_length.reshape(-1).int().tolist(),
+                self.offset.reshape(-1).int().tolist()
+            )
+        return self._lists
+
+    def as_rans_tables(self):
+        """ `rans.RansTables`, for the NumPy rANS coder """
+        if self._rans_tables is None:
+            self._rans_tables = rans.RansTables(
+                self.quantized_cdf.numpy(), self.cdf_length.numpy(), self.offset.numpy()
+            )
+        return self._rans_tables
+
+
+# content hash -> CDFTables
+_cdf_tables_registry = dict()
+# if set, CDF tables are also saved to (and memory-mapped from) this directory
+_cdf_cache_dir = os.environ.get('LVAE_CDF_CACHE_DIR', None)
+
+
+def set_cdf_cache_dir(cache_dir):
+    """ Set the directory to persist CDF tables. Processes that share the directory \
+        memory-map the tables instead of recomputing them. None disables persistence.
+
+    Args:
+        cache_dir (str or Path or None): directory
+    """
+    global _cdf_cache_dir
+    _cdf_cache_dir = cache_dir
+
+
+def _cdf_tables_key(entropy_model: GaussianConditional):
+    # the tables only depend on the distribution, tail mass, and scale table
+    scale_table = entropy_model.scale_table.detach().float().cpu().numpy()
+    content = f'{type(entropy_model).__name__}-{entropy_model.tail_mass!r}-{compressai.__version__}'
+    return hashlib.sha1(content.encode() + scale_table.tobytes()).hexdigest()
+
+
+def _load_cdf_tables(cache_dir, key):
+    paths = [Path(cache_dir) / f'{key}-{name}.npy' for name in ('cdf', 'length', 'offset')]
+    if not all([p.is_file() for p in paths]):
+        return None
+    # copy-on-write memory map. Pages are shared by all processes that read the same files
+    arrays = [torch.from_numpy(np.load(p, mmap_mode='c')) for p in paths]
+    return CDFTables(*arrays)
+
+
+def _save_cdf_tables(cache_dir, key, tables: CDFTables):
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    arrays = (tables.quantized_cdf, tables.cdf_length, tables.offset)
+    for name, t in zip(('cdf', 'length', 'offset'), arrays):
+        path = cache_dir / f'{key}-{name}.npy'
+        tmp_path = cache_dir / f'{key}-{name}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, t.numpy())
+        os.replace(tmp_path, path) # atomic, in case multiple workers write at the same time
+
+
+def get_cdf_tables(entropy_model: GaussianConditional):
+    """ Get the quantized CDF tables of an entropy model. Look up the in-memory registry first, \
+        then the on-disk cache (if set), and compute the tables only if both miss.
+
+    Args:
+        entropy_model (GaussianConditional): entropy model
+
+    Returns:
+        CDFTables: CDF tables, on CPU
+    """
+    key = _cdf_tables_key(entropy_model)
+    if key in _cdf_tables_registry:
+        return _cdf_tables_registry[key]
+    tables = None
+    if _cdf_cache_dir is not None:
+        tables = _load_cdf_tables(_cdf_cache_dir, key)
+    if tables is None:
+        GaussianConditional.update(entropy_model) # compute the tables
+        tables = CDFTables(
+            entropy_model._quantized_cdf.cpu().clone(),
+            entropy_model._cdf_length.cpu().clone(),
+            entropy_model._offset.cpu().clone()
+        )
+        if _cdf_cache_dir is not None:
+            _save_cdf_tables(_cdf_cache_dir, key, tables)
+    _cdf_tables_registry[key] = tables
+    return tables
+
+
+def _update_from_registry(entropy_model: GaussianConditional):
+    tables = get_cdf_tables(entropy_model)
+    device = entropy_model.scale_table.device
+    entropy_model._quantized_cdf = tables.quantized_cdf.to(device=device)
+    entropy_model._cdf_length = tables.cdf_length.to(device=device)
+    entropy_model._offset = tables.offset.to(device=device)
+    entropy_model._cdf_tables = tables
+
+
 def _sanity_check_scale_table(scale_table):
     assert isinstance(scale_table, torch.Tensor)
     assert (scale_table.dim() == 1) and (scale_table.shape[0] >= 1) and (scale_table.min() > 0)
@@ -49,6 +228,132 @@ def gaussian_log_prob_mass(mean, scale, x, bin_size=1.0, prob_clamp=1e-6):
     return log_prob
 
 
+class HostTransfer():
+    """ Device <-> host copies of symbols and CDF indexes for entropy coding, through reusable \
+    pinned host buffers with non-blocking copies, and a background thread that entropy-encodes \
+    each latent block as soon as its copy is complete. See `VariableRateLossyVAE.set_async_transfer()`.
+    """
+    def __init__(self, max_buffers=64):
+        """
+        Args:
+            max_buffers (int, optional): maximum number of cached host buffers (eg, for many \
+                image sizes). The least recently used ones are released. Defaults to 64.
+        """
+        self._buffers = OrderedDict()
+        self.max_buffers = max_buffers
+        self._encoder = ThreadPoolExecutor(max_workers=1)
+
+    def host_buffer(self, key, shape, dtype, device):
+        """ A host tensor for copies from / to `device`, pinned if `device` is a CUDA device. \
+        The same buffer is returned for the same key, shape, and dtype in the same thread, so \
+        its previous contents must have been consumed (eg, copies are ordered on a CUDA stream).
+        """
+        pin = (device.type == 'cuda')
+        key = (threading.get_ident(), key, tuple(shape), dtype, pin)
+        buffer = self._buffers.get(key, None)
+        if buffer is None:
+            buffer = torch.empty(tuple(shape), dtype=dtype, pin_memory=pin)
+            self._buffers[key] = buffer
+            while len(self._buffers) > self.max_buffers:
+                self._buffers.popitem(last=False)
+        self._buffers.move_to_end(key)
+        return buffer
+
+    def to_host(self, tensor: torch.Tensor, key):
+        """ Start copying a tensor to a host buffer.
+
+        Returns:
+            tuple: host tensor, and a CUDA event which completes after the copy \
+                (None if `tensor` is already on the host)
+        """
+        if tensor.device.type != 'cuda':
+            return tensor, None
+        host = self.host_buffer(key, tensor.shape, tensor.dtype, tensor.device)
+        host.copy_(tensor, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record(torch.cuda.current_stream(tensor.device))
+        return host, event
+
+    def to_device(self, host: torch.Tensor, device):
+        """ Start copying a host tensor to `device` """
+        return host.to(device=device, non_blocking=True)
+
+    def encode(self, entropy_model, symbols: torch.Tensor, indexes: torch.Tensor, key):
+        """ Start entropy encoding in the background thread. The caller can continue to launch \
+        work on the device, which overlaps with the copy and the encoding.
+
+        Returns:
+            concurrent.futures.Future: strings, same as `DiscretizedGaussian.collect_strings()`
+        """
+        symbols, _ = self.to_host(symbols.int(), (key, 'symbols'))
+        indexes, event = self.to_host(indexes.int(), (key, 'indexes')) # after both copies
+        return self._encoder.submit(_encode_on_host, entropy_model, symbols, indexes, event)
+
+    def shutdown(self):
+        self._encoder.shutdown()
+
+
+class DeviceIdleTimer():
+    """ Accumulate the GPU idle time while the host waits for the device (eg, for CDF indexes) \
+    and entropy-codes. A CUDA event is recorded before and after each wait (see `device_idle()`), \
+    so the measured time is from the completion of the work queued before the wait, to the work \
+    queued after it. Waits during which the device is still busy count as (almost) zero.
+    """
+    def __init__(self):
+        self._events = []
+
+    def reset(self):
+        self._events = []
+
+    def measure(self, device):
+        return _IdleInterval(self, device)
+
+    @property
+    def total(self):
+        """ Total idle time in seconds """
+        for _, end in self._events:
+            end.synchronize()
+        return sum([start.elapsed_time(end) for start, end in self._events]) / 1000.0
+
+
+class _IdleInterval():
+    def __init__(self, timer: DeviceIdleTimer, device):
+        self.timer = timer
+        self.stream = torch.cuda.current_stream(device)
+
+    def __enter__(self):
+        self.start = torch.cuda.Event(enable_timing=True)
+        self.start.record(self.stream)
+        return self
+
+    def __exit__(self, *exc):
+        end = torch.cuda.Event(enable_timing=True)
+        end.record(self.stream)
+        self.timer._events.append((self.start, end))
+
+
+_idle_timer = None
+
+def set_idle_timer(timer):
+    """ Set a `DeviceIdleTimer` that measures the host waits in entropy coding. None to disable. """
+    global _idle_timer
+    _idle_timer = timer
+
+
+def device_idle(device: torch.device):
+    """ Context for a host wait on `device`, measured by the timer of `set_idle_timer()` if any """
+    if (_idle_timer is None) or (device.type != 'cuda'):
+        return nullcontext()
+    return _idle_timer.measure(device)
+
+
+def _encode_on_host(entropy_model, symbols, indexes, event):
+    if event is not None:
+        event.synchronize()
+    results = entropy_model._map(run_job, entropy_model.encode_jobs(symbols, indexes))
+    return entropy_model.collect_strings(results, num_channels=symbols.shape[1])
+
+
 class DiscretizedGaussian(GaussianConditional):
     """ Custom discretized gaussian.
     """
@@ -81,6 +386,156 @@ class DiscretizedGaussian(GaussianConditional):
     def _standardized_cumulative(self, inputs: torch.Tensor):
         return self.standard_gaussian.cdf(inputs)
 
+    # Entropy coding of each latent can be split into `channel_groups` sub-streams, and the rANS
+    # coding runs in `executor` (a concurrent.futures executor) if provided. Set by the model.
+    channel_groups = 1
+    executor = None
+    # entropy coder backend, 'compressai' or 'numpy-rans'. Set by the model.
+    coder = 'compressai'
+    # `HostTransfer` for the copies of indexes and decoded symbols on CUDA devices. Set by the model.
+    transfer = None
+    _coder_funcs = {
+        'compressai': (rans_encode, rans_decode),
+        'numpy-rans': (numpy_rans_encode, numpy_rans_decode),
+    }
+    # coder identifiers stored in bitstream headers
+    coder_ids = {'compressai': 0, 'numpy-rans': 1}
+
+    def update(self):
+        """ Prepare the CDF tables for entropy coding. Tables are shared across entropy models.
+        """
+        _update_from_registry(self)
+
+    def build_indexes(self, scales: torch.Tensor):
+        """ Same as `GaussianConditional.build_indexes()`, ie, the index of the first scale in \
+        the table that is >= `scales`, but in one `searchsorted` instead of a loop over the table, \
+        and without the Python autograd function of `LowerBound`, so it can be captured in graphs.
+        """
+        scales = torch.maximum(scales, self.lower_bound_scale.bound)
+        indexes = torch.searchsorted(self.scale_table[:-1].to(dtype=scales.dtype), scales.contiguous())
+        return indexes.int()
+
+    def _get_cdf_tables(self) -> CDFTables:
+        if getattr(self, '_cdf_tables', None) is None:
+            raise ValueError('Uninitialized CDFs. Run update() first')
+        return self._cdf_tables
+
+    def coding_tables(self):
+        """ CDF tables as python lists, (cdf, cdf_lengths, offsets), for the compressai coder.
+        """
+        return self._get_cdf_tables().as_lists()
+
+    def rans_tables(self):
+        """ CDF tables for the NumPy rANS coder.
+        """
+        return self._get_cdf_tables().as_rans_tables()
+
+    def _job_tables(self):
+        if self.coder == 'numpy-rans':
+            return (self.rans_tables(),)
+        return self.coding_tables()
+
+    def _channel_slices(self, num_channels, channel_groups=None):
+        groups = min(channel_groups or self.channel_groups, num_channels)
+        edges = np.linspace(0, num_channels, num=groups+1).round().astype(int).tolist()
+        return [slice(edges[g], edges[g+1]) for g in range(groups)]
+
+    def encode_jobs(self, symbols: torch.Tensor, indexes: torch.Tensor):
+        """ Prepare rANS encoding jobs, one per (image, channel group). See `run_job()`.
+
+        Args:
+            symbols (torch.Tensor): quantized symbols, (N, C, H, W)
+            indexes (torch.Tensor): CDF indexes, (N, C, H, W)
+        """
+        assert symbols.shape == indexes.shape, f'{symbols.shape=}, {indexes.shape=}'
+        encode_func, _ = self._coder_funcs[self.coder]
+        tables = self._job_tables()
+        symbols = symbols.int().cpu().numpy()
+        indexes = indexes.int().cpu().numpy()
+        jobs = []
+        for i in range(symbols.shape[0]):
+            for ch in self._channel_slices(symbols.shape[1]):
+                args = (symbols[i, ch].reshape(-1), indexes[i, ch].reshape(-1), *tables)
+                jobs.append((encode_func, args))
+        return jobs
+
+    def collect_strings(self, results, num_channels):
+        """ Collect the outputs of `encode_jobs()` per image.
+
+        Returns:
+            list[list[bytes]]: strings[i][g] is the string of the i-th image and g-th channel group
+        """
+        groups = len(self._channel_slices(num_channels))
+        results = list(results)
+        return [results[i:i+groups] for i in range(0, len(results), groups)]
+
+    def _map(self, func, jobs):
+        if self.executor is None:
+            return map(func, jobs)
+        return self.executor.map(func, jobs)
+
+    def compress(self, inputs, indexes, means=None):
+        symbols = self.quantize(inputs, 'symbols', means)
+        results = self._map(run_job, self.encode_jobs(symbols, indexes))
+        strings = self.collect_strings(results, num_channels=symbols.shape[1])
+        # channel groups, if more than one, are packed by `coding.pack_byte_strings()`
+        return [strs[0] if (len(strs) == 1) else coding.pack_byte_strings(strs) for strs in strings]
+
+    def decompress(self, strings, indexes, dtype=torch.float, means=None):
+        """ Decode symbols from strings.
+
+        Args:
+            strings (list): one item per image, either a string produced by `compress()`, \
+                or a list of channel group strings as produced by `collect_strings()`.
+            indexes (torch.Tensor): CDF indexes, (N, C, H, W)
+        """
+        assert isinstance(strings, (tuple, list)) and (len(strings) == indexes.shape[0])
+        _, decode_func = self._coder_funcs[self.coder]
+        tables = self._job_tables()
+        if isinstance(strings[0], (tuple, list)): # channel groups are given explicitly
+            slices = self._channel_slices(indexes.shape[1], channel_groups=len(strings[0]))
+        else:
+            slices = self._channel_slices(indexes.shape[1])
+        transfer = self.transfer if indexes.is_cuda else None
+        if transfer is not None: # start the copy, and prepare the strings while it runs
+            host_indexes, event = transfer.to_host(indexes.int(), (id(self), 'indexes'))
+        with device_idle(indexes.device):
+            # strings can be memoryviews (eg, slices of a container), which cannot be sent to processes
+            to_bytes = isinstance(self.executor, ProcessPoolExecutor)
+            all_group_strings = []
+            for string in strings:
+                if isinstance(string, (tuple, list)):
+                    group_strings = string
+                else:
+                    group_strings = [string] if (len(slices) == 1) else coding.unpack_byte_string(string)
+                assert len(group_strings) == len(slices), f'{len(group_strings)=}, {len(slices)=}'
+                all_group_strings.append([
+                    bytes(gs) if (to_bytes and not isinstance(gs, bytes)) else gs for gs in group_strings
+                ])
+            if transfer is None:
+                np_indexes = indexes.int().cpu().numpy()
+                outputs = np.empty(np_indexes.shape, dtype=np.int32)
+            else: # decode into a pinned buffer, and copy it to the device without blocking
+                host_outputs = transfer.host_buffer((id(self), 'symbols'), indexes.shape, torch.int32, indexes.device)
+                outputs = host_outputs.numpy()
+                event.synchronize() # the indexes are needed from here on
+                np_indexes = host_indexes.numpy()
+            jobs = []
+            for i, group_strings in enumerate(all_group_strings):
+                for gs, ch in zip(group_strings, slices):
+                    jobs.append((decode_func, (gs, np_indexes[i, ch].reshape(-1), *tables)))
+            # channel groups are decoded in parallel if an executor is provided
+            results = iter(self._map(run_job, jobs))
+            for i in range(len(strings)):
+                for ch in slices:
+                    outputs[i, ch] = next(results).reshape(outputs[i, ch].shape)
+        if transfer is None:
+            outputs = torch.from_numpy(outputs).to(device=indexes.device)
+        else:
+            outputs = transfer.to_device(host_outputs, indexes.device)
+        outputs = self.dequantize(outputs, means, dtype)
+        return outputs
+
 
 def laplace_log_prob_mass(mean, scale, x, bin_size=1.0, prob_clamp=1e-6):
     mean, scale, x = _to_float32(mean, scale, x)
@@ -117,5 +572,10 @@ class DiscretizedLaplace(GaussianConditional):
     def _standardized_quantile(quantile):
         return scipy.stats.laplace.ppf(quantile)
 
+    def update(self):
+        """ Prepare the CDF tables for entropy coding. Tables are shared across entropy models.
+        """
+        _update_from_registry(self)
+
     def _standardized_cumulative(self, inputs: torch.Tensor):
         return self.standard_laplace.cdf(inputs)
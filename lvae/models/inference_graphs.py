@@ -0,0 +1,105 @@
+""" Capture of network-only inference graphs (traced or compiled), with an on-disk cache.
+See `VariableRateLossyVAE.compile_for_inference()`.
+"""
+from pathlib import Path
+import os
+import hashlib
+import torch
+import torch.nn as nn
+
+
+def module_fingerprint(module: nn.Module):
+    """ A hash of the weights and buffers of a module, and of the PyTorch version, device, and \
+    dtype. Captured graphs are only valid for the module they are captured from.
+    """
+    sha1 = hashlib.sha1(torch.__version__.encode())
+    for name, value in module.state_dict().items():
+        # quantized layers store tuples of quantized tensors, see `lvae.models.quantization`
+        values = value if isinstance(value, tuple) else (value,)
+        for t in values:
+            if not isinstance(t, torch.Tensor):
+                sha1.update(f'{name}-{t}'.encode())
+                continue
+            sha1.update(f'{name}-{t.dtype}-{t.device.type}-{tuple(t.shape)}'.encode())
+            t = t.dequantize() if t.is_quantized else t
+            sha1.update(t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def _share_tensors(loaded: torch.jit.ScriptModule, module: nn.Module):
+    """ Make the parameters and buffers of a loaded graph share memory with the original \
+    module, such that each captured graph does not hold another copy of the weights.
+
+    Returns:
+        int: number of shared tensors
+    """
+    sources = dict(module.named_parameters(remove_duplicate=False))
+    sources.update(dict(module.named_buffers(remove_duplicate=False)))
+    num = 0
+    with torch.no_grad():
+        for name, t in list(loaded.named_parameters()) + list(loaded.named_buffers()):
+            src = sources.get(name, None)
+            if (src is not None) and (src.shape == t.shape) and (src.dtype == t.dtype):
+                t.set_(src.detach())
+                num += 1
+    return num
+
+
+# number of graphs captured by torch.compile, see `_recompile_limit_patch()`
+_num_compiled = 0
+
+
+def _recompile_limit_patch():
+    """ Graphs of modules of the same class (eg, all `DecodeSegment`s) share the code object of \
+    `forward()`, and dynamo stops compiling a code object after a limit of recompilations. \
+    A graph may need more than one entry (eg, for inputs with and without requires_grad). \
+    The returned context raises the limit only while a graph is compiled, such that the global \
+    dynamo config of other code is not changed. Calls of compiled graphs hit their cache entries.
+    """
+    global _num_compiled
+    _num_compiled += 1
+    import torch._dynamo
+    limit = 8 + 2 * _num_compiled
+    changes = dict()
+    for name in ('recompile_limit', 'cache_size_limit'): # the name depends on the PyTorch version
+        if hasattr(torch._dynamo.config, name):
+            changes[name] = max(getattr(torch._dynamo.config, name), limit)
+    return torch._dynamo.config.patch(**changes)
+
+
+@torch.no_grad()
+def capture(module: nn.Module, example_inputs: tuple, backend='trace', cache_path=None):
+    """ Capture a network-only module as a graph.
+
+    Args:
+        module (nn.Module): a module whose forward pass has no data-dependent control flow
+        example_inputs (tuple): example inputs. The graph is specialized to their shapes.
+        backend (str, optional): 'trace' (`torch.jit.trace`) or 'compile' (`torch.compile`). \
+            Defaults to 'trace'.
+        cache_path (str or Path, optional): for 'trace', the graph is loaded from this file \
+            if it exists, and saved to it otherwise. 'compile' uses the inductor cache \
+            (`TORCHINDUCTOR_CACHE_DIR`) instead.
+
+    Returns:
+        callable: the captured graph
+    """
+    if backend == 'trace':
+        if (cache_path is not None) and Path(cache_path).is_file():
+            device = example_inputs[0].device
+            graph = torch.jit.load(str(cache_path), map_location=device)
+            _share_tensors(graph, module)
+            return graph
+        graph = torch.jit.trace(module, example_inputs, check_trace=False)
+        if cache_path is not None:
+            cache_path = Path(cache_path)
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+            torch.jit.save(graph, str(tmp_path))
+            os.replace(tmp_path, cache_path) # atomic, in case multiple processes write at the same time
+        return graph
+    elif backend == 'compile':
+        with _recompile_limit_patch():
+            graph = torch.compile(module, dynamic=False)
+            graph(*example_inputs) # compile now rather than at the first call
+        return graph
+    raise ValueError(f'Unknown {backend=}')
@@ -2,8 +2,14 @@ from PIL import Image
 from tqdm import tqdm
 from pathlib import Path
 from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import os
 import math
 import struct
+import hashlib
+import weakref
+import threading
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as tnf
@@ -14,17 +20,56 @@ from timm.utils import AverageMeter
 import lvae.utils.coding as coding
 import lvae.models.common as common
 import lvae.models.entropy_coding as entropy_coding
+import lvae.models.inference_graphs as inference_graphs
+
+
+@functools.lru_cache(maxsize=8)
+def _prior_logscale_thresholds(scale_table: tuple, frac_bits: int):
+    """ Values of the prior head output (before softplus) at which the scale reaches each entry \
+    of the scale table, ie, the inverse of the transform in `VRLVBlockBase.transform_prior()`. \
+    Rounded down to multiples of 2^-frac_bits, in units of 2^-frac_bits (ie, integers).
+    """
+    thresholds = []
+    for scale in scale_table:
+        t = math.log(math.expm1(math.log(scale) + 2.3)) - 2.3
+        thresholds.append(float(math.floor(t * 2**frac_bits)))
+    return thresholds
+
+
+# models in deterministic mode, see `VariableRateLossyVAE.set_deterministic()`. TF32 is disabled
+# while any of them is in this mode, and the previous flags are restored when the last one leaves it.
+_deterministic_models = weakref.WeakSet()
+_saved_tf32_flags = None # (matmul, cudnn)
+
+
+def _set_tf32_for_deterministic(model: nn.Module, mode: bool):
+    global _saved_tf32_flags
+    if mode:
+        if _saved_tf32_flags is None:
+            _saved_tf32_flags = (torch.backends.cuda.matmul.allow_tf32, torch.backends.cudnn.allow_tf32)
+        _deterministic_models.add(model)
+        torch.backends.cuda.matmul.allow_tf32 = False
+        torch.backends.cudnn.allow_tf32 = False
+    elif model in _deterministic_models:
+        _deterministic_models.discard(model)
+        if (len(_deterministic_models) == 0) and (_saved_tf32_flags is not None):
+            torch.backends.cuda.matmul.allow_tf32, torch.backends.cudnn.allow_tf32 = _saved_tf32_flags
+            _saved_tf32_flags = None
 
 
 class VRLVBlockBase(nn.Module):
     """ Vriable-Rate Latent Variable Block
     """
     default_embedding_dim = 256
+    # deterministic decoding, see `prior_fixed_point()`. Set by `VariableRateLossyVAE.set_deterministic()`
+    deterministic = False
+    fixed_point_bits = 16
     def __init__(self, width, zdim, enc_key, enc_width, embed_dim=None, kernel_size=7, mlp_ratio=2):
         super().__init__()
         self.in_channels  = width
         self.out_channels = width
         self.enc_key = enc_key
+        self.zdim = zdim
 
         block = common.ConvNeXtBlockAdaLN
         embed_dim = embed_dim or self.default_embedding_dim
@@ -48,11 +93,47 @@ class VRLVBlockBase(nn.Module):
             feature (torch.Tensor): feature map
         """
         feature = self.resnet_front(feature, lmb_embedding)
+        if self.deterministic and not torch.is_grad_enabled():
+            pm, pv = self.prior_fixed_point(feature)
+            return feature, pm, pv
         pm, plogv = self.prior(feature).chunk(2, dim=1)
         plogv = tnf.softplus(plogv + 2.3) - 2.3 # make logscale > -2.3
         pv = torch.exp(plogv)
         return feature, pm, pv
 
+    def prior_fixed_point(self, feature):
+        """ Prior parameters for deterministic decoding. The prior head runs in float64, so its \
+        outputs do not depend on the kernels (eg, summation order) of the device. The log-scale \
+        output is rounded to multiples of 2^-fixed_point_bits, and its CDF index is found by \
+        integer comparisons instead of softplus, exp, and a float search, so the index is an \
+        exact function of the fixed-point value. The scale is snapped to the scale table. \
+        The mean is rounded to the same grid, so a small difference of the head output (below \
+        the grid step, and not across a rounding boundary) gives the same mean, and the same \
+        latent `z = symbols + mean`, on both sides.
+
+        The features that feed the head still come from the floating-point network, so this \
+        makes a mismatch rare, not impossible (see `scripts/qarv/test-deterministic-decoding.py`).
+
+        Args:
+            feature (torch.Tensor): feature map
+
+        Returns:
+            tuple: prior mean and scale
+        """
+        F = self.fixed_point_bits
+        x = feature.double().permute(0, 2, 3, 1)
+        weight = self.prior.weight.double().flatten(1)
+        raw = common.per_sample(lambda xi: tnf.linear(xi, weight, self.prior.bias.double()), x)
+        raw = raw.permute(0, 3, 1, 2)
+        raw_m, raw_v = raw.chunk(2, dim=1)
+        raw_m = torch.round(raw_m.mul(2**F)).div(2**F)
+        raw_v = torch.round(raw_v.mul(2**F)) # integers
+        scale_table = self.discrete_gaussian.scale_table
+        thresholds = _prior_logscale_thresholds(tuple(scale_table[:-1].tolist()), F)
+        indexes = torch.searchsorted(raw_v.new_tensor(thresholds), raw_v.contiguous())
+        pv = scale_table[indexes]
+        return raw_m.to(dtype=feature.dtype), pv.to(dtype=feature.dtype)
+
     def transform_posterior(self, feature, enc_feature, lmb_embedding):
         """ posterior q(z_i | z_<i, x)
 
@@ -74,6 +155,46 @@ class VRLVBlockBase(nn.Module):
         feature = feature + self.z_proj(z)
         return feature
 
+    def forward_end(self, feature, z, lmb_embedding):
+        """ Merge the latent z into the feature, after the prior (and posterior)
+        """
+        feature = self.fuse_feature_and_z(feature, z)
+        feature = self.resnet_end(feature, lmb_embedding)
+        return feature
+
+    def quantize_posterior(self, qm, pm, pv):
+        """ Quantize the posterior mean for entropy coding.
+
+        Returns:
+            tuple: dequantized z, symbols, and CDF indexes
+        """
+        indexes = self.discrete_gaussian.build_indexes(pv)
+        symbols = self.discrete_gaussian.quantize(qm, mode='symbols', means=pm)
+        z = self.discrete_gaussian.quantize(qm, mode='dequantize', means=pm)
+        return z, symbols, indexes
+
+    def forward_compress(self, feature, lmb_embedding, enc_feature):
+        """ Network part of compression, see `CompressNetwork`.
+
+        Returns:
+            tuple: feature, symbols, and CDF indexes
+        """
+        feature, pm, pv = self.transform_prior(feature, lmb_embedding)
+        qm = self.transform_posterior(feature, enc_feature, lmb_embedding)
+        z, symbols, indexes = self.quantize_posterior(qm, pm, pv)
+        feature = self.forward_end(feature, z, lmb_embedding)
+        return feature, symbols, indexes
+
+    def decode_prior(self, feature, lmb_embedding):
+        """ Network part of decompression before entropy decoding, see `DecodeSegment`.
+
+        Returns:
+            tuple: feature, prior mean, and CDF indexes
+        """
+        feature, pm, pv = self.transform_prior(feature, lmb_embedding)
+        indexes = self.discrete_gaussian.build_indexes(pv)
+        return feature, pm, indexes
+
     def forward(self, feature, lmb_embedding, enc_feature=None, mode='trainval',
                 get_latent=False, latent=None, t=1.0, strings=None):
         """ a complicated forward function
@@ -101,12 +222,9 @@ class VRLVBlockBase(nn.Module):
             else: # if `z` is provided, directly use it.
                 assert pm.shape == latent.shape
                 z = latent
-        elif mode == 'compress': # encode z into bits
+        elif mode == 'compress': # quantize z. Entropy coding is done later by the model
             qm = self.transform_posterior(feature, enc_feature, lmb_embedding)
-            indexes = self.discrete_gaussian.build_indexes(pv)
-            strings = self.discrete_gaussian.compress(qm, indexes, means=pm)
-            z = self.discrete_gaussian.quantize(qm, mode='dequantize', means=pm)
-            additional['strings'] = strings
+            z, additional['symbols'], additional['indexes'] = self.quantize_posterior(qm, pm, pv)
         elif mode == 'decompress': # decode z from bits
             assert strings is not None
             indexes = self.discrete_gaussian.build_indexes(pv)
@@ -114,8 +232,7 @@ class VRLVBlockBase(nn.Module):
         else:
             raise ValueError(f'Unknown mode={mode}')
 
-        feature = self.fuse_feature_and_z(feature, z)
-        feature = self.resnet_end(feature, lmb_embedding)
+        feature = self.forward_end(feature, z, lmb_embedding)
         if get_latent:
             additional['z'] = z.detach()
         return feature, additional
@@ -131,6 +248,7 @@ class VRLVBlockSmall(VRLVBlockBase):
         self.in_channels  = width
         self.out_channels = width
         self.enc_key = enc_key
+        self.zdim = zdim
 
         block = common.ConvNeXtBlockAdaLN
         enc_width = enc_width or width
@@ -197,6 +315,13 @@ class VariableRateLossyVAE(nn.Module):
         # self._stats_log = dict()
         self._logging_images = config.get('log_images', [])
         self._flops_mode = False
+        # LRU cache of per-image rate-lambda curves, image fingerprint -> {lmb: estimated bytes}
+        self._rate_curves = OrderedDict()
+        self.rate_curve_cache_size = 8
+        # captured inference graphs, padded (H, W) -> dict, see `compile_for_inference()`
+        self._inference_graphs = dict()
+        # asynchronous host transfers for entropy coding, see `set_async_transfer()`
+        self._async_transfer = None
 
     def _setup_lmb_embedding(self, config):
         _low, _high = config['lmb_range']
@@ -209,6 +334,25 @@ class VariableRateLossyVAE(nn.Module):
             nn.Linear(self.lmb_embed_dim[1], self.lmb_embed_dim[1]),
         )
         self._sin_period = config['sin_period']
+        # LRU cache of AdaLN parameters, (lmb, device, dtype) -> common.AdaLNParams. The lock is
+        # held for all accesses, as serving and tiled coding threads share the model
+        self._adaln_cache = OrderedDict()
+        self._adaln_lock = threading.Lock()
+        self.adaln_cache_size = config.get('adaln_cache_size', 16)
+
+    def __getstate__(self):
+        # locks cannot be copied (eg, by `copy.deepcopy()`), so a new one is made in `__setstate__()`
+        state = self.__dict__.copy()
+        state.pop('_adaln_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._adaln_lock = threading.Lock()
+
+    def _clear_adaln_cache(self):
+        with self._adaln_lock:
+            self._adaln_cache.clear()
 
     def preprocess_input(self, im: torch.Tensor):
         """ Shift and scale the input image
@@ -280,24 +424,75 @@ class VariableRateLossyVAE(nn.Module):
 
     def _get_lmb_embedding(self, lmb, n):
         lmb = self.expand_to_tensor(lmb, n=n)
+        if self.compressing and not torch.is_grad_enabled():
+            # at inference time, use the cached AdaLN parameters of all blocks
+            return self._get_cached_adaln_params(lmb)
+        return self._compute_lmb_embedding(lmb)
+
+    def _compute_lmb_embedding(self, lmb: torch.Tensor):
         scaled = self._lmb_scaling(lmb)
         embedding = common.sinusoidal_embedding(scaled, dim=self.lmb_embed_dim[0],
                                                 max_period=self._sin_period)
         embedding = self.lmb_embedding(embedding)
         return embedding
 
+    def _get_cached_adaln_params(self, lmb: torch.Tensor):
+        """ Get the AdaLN parameters of all `ConvNeXtBlockAdaLN` blocks from an LRU cache
+
+        Args:
+            lmb (torch.Tensor): a batch of lambdas, shape (N,)
+        """
+        device, dtype = self.bias.device, self.bias.dtype
+        keys = [(v, device, dtype) for v in lmb.tolist()]
+        batch_params = dict() # keep a reference in case the cache is smaller than the batch
+        with self._adaln_lock:
+            for key in keys:
+                if key in batch_params:
+                    continue
+                if key not in self._adaln_cache:
+                    emb = self._compute_lmb_embedding(lmb.new_full((1,), fill_value=key[0]))
+                    blocks = [m for m in self.modules() if isinstance(m, common.ConvNeXtBlockAdaLN)]
+                    self._adaln_cache[key] = common.AdaLNParams({b: b.get_adaln_params(emb) for b in blocks})
+                    while len(self._adaln_cache) > self.adaln_cache_size:
+                        self._adaln_cache.popitem(last=False)
+                self._adaln_cache.move_to_end(key)
+                batch_params[key] = self._adaln_cache[key]
+        if len(batch_params) == 1: # the (1, 1, 1, C) parameters are broadcasted over the batch
+            return batch_params[keys[0]]
+        return common.AdaLNParams.cat([batch_params[key] for key in keys])
+
+    @torch.no_grad()
+    def prepare_lmb_cache(self, lambdas):
+        """ Pre-compute and cache the AdaLN parameters for a list of lambdas. \
+        Should be called after `compress_mode(True)`.
+
+        Args:
+            lambdas (list[float]): lambdas that will be used for compression/decompression
+        """
+        assert self.compressing, 'Please call compress_mode(True) first.'
+        assert len(lambdas) <= self.adaln_cache_size, f'{len(lambdas)=} > {self.adaln_cache_size=}'
+        for lmb in lambdas:
+            self._get_lmb_embedding(lmb, n=1)
+
     def get_bias(self, bhw_repeat=(1,1,1)):
         nB, nH, nW = bhw_repeat
         feature = self.bias.expand(nB, -1, nH, nW)
         return feature
 
-    def forward_end2end(self, im: torch.Tensor, lmb: torch.Tensor, mode='trainval', get_latent=False):
+    def forward_end2end(self, im: torch.Tensor, lmb: torch.Tensor, mode='trainval', get_latent=False,
+                        on_latent=None):
         x = self.preprocess_input(im)
         # ================ get lambda embedding ================
-        emb = self._get_lmb_embedding(lmb, n=im.shape[0])
+        # multi-rate: a single image with a batch of lambdas. The image is broadcasted to the
+        # lambdas at the first AdaLN block, so lambda-independent layers before it run only once.
+        multi_rate = (im.shape[0] == 1) and isinstance(lmb, torch.Tensor) and (lmb.numel() > 1)
+        nB = lmb.numel() if multi_rate else im.shape[0]
+        emb = self._get_lmb_embedding(lmb, n=nB)
         # ================ Forward pass ================
         _, enc_features = self.encoder(x, emb)
-        nB, _, xH, xW = x.shape
+        if multi_rate: # features set before the first AdaLN block have batch size 1
+            enc_features = {k: v.expand(nB, -1, -1, -1) for k, v in enc_features.items()}
+        _, _, xH, xW = x.shape
         feature = self.get_bias(bhw_repeat=(nB, xH//self.max_stride, xW//self.max_stride))
         lv_block_results = [] # all latent variable block results
         for i, block in enumerate(self.dec_blocks):
@@ -305,6 +500,8 @@ class VariableRateLossyVAE(nn.Module):
                 f_enc = enc_features[block.enc_key]
                 feature, stats = block(feature, emb, enc_feature=f_enc, mode=mode, get_latent=get_latent)
                 lv_block_results.append(stats)
+                if on_latent is not None: # eg, start entropy coding while the next blocks run
+                    on_latent(block, stats)
             elif getattr(block, 'requires_embedding', False):
                 feature = block(feature, emb)
             elif isinstance(block, common.CompresionStopFlag) and (mode == 'compress'):
@@ -472,6 +669,61 @@ class VariableRateLossyVAE(nn.Module):
 
         return avg_stats
 
+    @torch.no_grad()
+    def _self_evaluate_sweep(self, img_paths, lambdas, max_pixels=2**21, pbar=False, log_dir=None):
+        """ Image-major version of `_self_evaluate()` for multiple lambdas. Each image is loaded \
+        once, and all lambdas are evaluated in batched forward passes (lambdas in the batch \
+        dimension), with at most `max_pixels` (batch x height x width) per pass.
+
+        Returns:
+            list[dict]: results of each lambda, same as `_self_evaluate()`
+        """
+        pbar = tqdm(img_paths) if pbar else img_paths
+        device = self._dummy.device
+        all_image_stats = [defaultdict(float) for _ in lambdas]
+        if log_dir is not None:
+            log_dir = Path(log_dir)
+            channel_bpp_stats = [defaultdict(AverageMeter) for _ in lambdas]
+        for impath in pbar:
+            img = Image.open(impath)
+            imgh, imgw = img.height, img.width
+            img_padded = coding.pad_divisible_by(img, div=self.max_stride)
+            im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
+            real = tvf.to_tensor(img).unsqueeze_(0)
+            x_target = self.preprocess_target(real.to(device=device))
+            _, imC, imH, imW = im.shape
+            step = max(1, max_pixels // (imH * imW))
+            for start in range(0, len(lambdas), step):
+                lmbs = lambdas[start:start+step]
+                x_hat, stats_all = self.forward_end2end(im, lmb=torch.tensor(lmbs, device=device))
+                x_hat = x_hat[:, :, :imgh, :imgw]
+                # compute bpp
+                kl = sum([stat['kl'].sum(dim=(1, 2, 3)) for stat in stats_all]) / (imC*imgh*imgw)
+                # compute psnr
+                distortion = self.distortion_func(x_hat, x_target.expand_as(x_hat))
+                fake = self.process_output(x_hat).cpu()
+                mse = (real - fake).square().mean(dim=(1, 2, 3))
+                for i, lmb in enumerate(lmbs):
+                    stats = all_image_stats[start + i]
+                    stats['count'] += 1
+                    stats['loss'] += float(kl[i].item() + lmb * distortion[i].item())
+                    stats['bpp']  += kl[i].item() * self.log2_e * imC
+                    stats['psnr'] += float(-10 * math.log10(mse[i].item()))
+                    if log_dir is not None:
+                        for bi, stat in enumerate(stats_all):
+                            ch_bpp = stat['kl'][i].sum(dim=(1,2)).cpu() / (imH*imW) * self.log2_e
+                            channel_bpp_stats[start + i][bi].update(ch_bpp)
+        # average over all images
+        all_results = []
+        for i, lmb in enumerate(lambdas):
+            count = all_image_stats[i].pop('count')
+            avg_stats = {k: v/count for k,v in all_image_stats[i].items()}
+            avg_stats['lambda'] = lmb
+            if log_dir is not None:
+                self._log_channel_stats(channel_bpp_stats[i], log_dir, lmb)
+            all_results.append(avg_stats)
+        return all_results
+
     @staticmethod
     def _log_channel_stats(channel_bpp_stats, log_dir, lmb):
         msg = '=' * 64 + '\n'
@@ -489,15 +741,39 @@ class VariableRateLossyVAE(nn.Module):
             print(msg, file=f)
 
     @torch.no_grad()
-    def self_evaluate(self, img_dir, lmb_range=None, steps=8, log_dir=None):
+    def self_evaluate(self, img_dir, lmb_range=None, steps=8, log_dir=None, image_major=False,
+                      max_pixels=2**21):
+        """ Evaluate on a folder of images at `steps` lambdas, without entropy coding.
+
+        Args:
+            img_dir (str or Path): image folder
+            lmb_range (tuple, optional): (min, max) lambda. Defaults to `self.lmb_range`.
+            steps (int, optional): number of lambdas, uniform in log space. Defaults to 8.
+            log_dir (str or Path, optional): if provided, log per-channel bpp to this folder.
+            image_major (bool, optional): load each image once and evaluate all lambdas in \
+                batched forward passes. Defaults to False, ie, loop over lambdas in the outer \
+                loop, one image per forward pass.
+            max_pixels (int, optional): memory budget of image-major evaluation, as the \
+                maximum (batch x height x width) per forward pass.
+
+        Returns:
+            dict[str -> list]: results, one value per lambda
+        """
         img_paths = list(Path(img_dir).rglob('*.*'))
         start, end = self.lmb_range if (lmb_range is None) else lmb_range
         # uniform in cube root space
         lambdas = torch.linspace(math.log(start), math.log(end), steps=steps).exp()
-        pbar = tqdm(lambdas.tolist(), position=0, ascii=True)
         all_lmb_stats = defaultdict(list)
         if log_dir is not None:
             (Path(log_dir) / 'all_lmb_channel_stats.txt').unlink(missing_ok=True)
+        if image_major:
+            all_results = self._self_evaluate_sweep(img_paths, lambdas.tolist(), max_pixels=max_pixels,
+                                                    pbar=True, log_dir=log_dir)
+            for results in all_results:
+                for k,v in results.items():
+                    all_lmb_stats[k].append(v)
+            return all_lmb_stats
+        pbar = tqdm(lambdas.tolist(), position=0, ascii=True)
         for lmb in pbar:
             assert isinstance(lmb, float)
             results = self._self_evaluate(img_paths, lmb, log_dir=log_dir)
@@ -506,78 +782,1079 @@ class VariableRateLossyVAE(nn.Module):
                 all_lmb_stats[k].append(v)
         return all_lmb_stats
 
+    def set_entropy_coding(self, channel_groups=1, workers=0, executor='thread', coder='compressai'):
+        """ Configure (parallel) entropy coding. The same `channel_groups` and `coder` must be used \
+            for compression and decompression.
+
+        Args:
+            channel_groups (int, optional): split each latent into this number of sub-streams \
+                along the channel dimension. Defaults to 1.
+            workers (int, optional): number of entropy coding workers. 0 means no parallelism.
+            executor (str, optional): 'thread' or 'process'. Defaults to 'thread'.
+            coder (str, optional): entropy coder backend, 'compressai' or 'numpy-rans' \
+                (see `lvae.models.rans`). Defaults to 'compressai'.
+        """
+        assert coder in entropy_coding.DiscretizedGaussian._coder_funcs, f'Unknown {coder=}'
+        old_executor = getattr(self, '_entropy_executor', None)
+        if old_executor is not None:
+            old_executor.shutdown()
+        if workers == 0:
+            self._entropy_executor = None
+        elif executor == 'thread':
+            self._entropy_executor = ThreadPoolExecutor(max_workers=workers)
+        elif executor == 'process':
+            self._entropy_executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f'Unknown {executor=}')
+        for block in self.dec_blocks:
+            if getattr(block, 'is_latent_block', False):
+                block.discrete_gaussian.channel_groups = int(channel_groups)
+                block.discrete_gaussian.executor = self._entropy_executor
+                block.discrete_gaussian.coder = coder
+
+    def set_deterministic(self, mode=True):
+        """ Enable (or disable) deterministic decoding, where the prior parameters are computed in \
+        fixed-point arithmetic (see `VRLVBlockBase.prior_fixed_point()`), so that the CDF indexes \
+        and means rarely depend on the device or kernels. The network before the prior head still \
+        runs in floating point, so this is not a guarantee. TF32 is also disabled in PyTorch, as its rounding \
+        differs from CPUs. This is a process-wide setting: it stays disabled while any model is in \
+        deterministic mode, and the previous TF32 flags are restored when the last one leaves it. \
+        The mode is stored in the bitstream header, and the decoder must use the same mode as \
+        the encoder.
+
+        Args:
+            mode (bool): enable or disable deterministic decoding
+        """
+        for block in self.dec_blocks:
+            if getattr(block, 'is_latent_block', False):
+                block.deterministic = bool(mode)
+        _set_tf32_for_deterministic(self, bool(mode))
+        self._clear_adaln_cache()
+        self._inference_graphs.clear()
+
+    def set_async_transfer(self, mode=True):
+        """ Enable (or disable) asynchronous host transfers for entropy coding. Symbols and CDF \
+        indexes are copied through reusable pinned host buffers with non-blocking copies. \
+        In compression, each latent block is entropy-coded in a background thread as soon as its \
+        symbols reach the host, while the network continues with the next blocks. In decompression, \
+        the decoded symbols are copied back to the device without blocking. \
+        Bitstreams are the same as without this option.
+
+        Args:
+            mode (bool): enable or disable asynchronous transfers
+        """
+        if self._async_transfer is not None:
+            self._async_transfer.shutdown()
+        self._async_transfer = entropy_coding.HostTransfer() if mode else None
+        for block in self.dec_blocks:
+            if getattr(block, 'is_latent_block', False):
+                block.discrete_gaussian.transfer = self._async_transfer
+
+    def _compress_and_encode(self, im, lmb):
+        """ Network pass of compression, `forward_end2end(mode='compress')`, and entropy coding. \
+        See `set_async_transfer()` for the pipelined version.
+
+        Returns:
+            list[list[bytes]]: strings[i][j] is the string of the i-th image and j-th latent block
+        """
+        if self._async_transfer is None:
+            with common.batch_invariant(): # batches of images or lambdas, see `compress_batch()`
+                lv_block_results = self.forward_end2end(im, lmb=lmb, mode='compress')
+            assert len(lv_block_results) == self.num_latents
+            return self._entropy_encode(lv_block_results)
+        futures = []
+        def _encode_block(block, stats):
+            futures.append(self._async_transfer.encode(
+                block.discrete_gaussian, stats['symbols'], stats['indexes'], key=len(futures)))
+        with common.batch_invariant():
+            lv_block_results = self.forward_end2end(im, lmb=lmb, mode='compress', on_latent=_encode_block)
+        assert len(lv_block_results) == self.num_latents
+        with entropy_coding.device_idle(im.device):
+            block_strings = [f.result() for f in futures]
+        nB = lv_block_results[0]['symbols'].shape[0]
+        return [[strs[i] for strs in block_strings] for i in range(nB)]
+
+    def _entropy_encode(self, lv_block_results):
+        """ Entropy coding of all latent blocks at once, after the network pass.
+
+        Args:
+            lv_block_results (list[dict]): outputs of `forward_end2end(mode='compress')`
+
+        Returns:
+            list[list[bytes]]: strings[i][j] is the string of the i-th image and j-th latent block
+        """
+        latent_blocks = [b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)]
+        assert len(latent_blocks) == len(lv_block_results)
+        with entropy_coding.device_idle(lv_block_results[0]['symbols'].device):
+            # gather the jobs of all latent blocks, and run them in one batch
+            all_jobs = []
+            for block, res in zip(latent_blocks, lv_block_results):
+                all_jobs.append(block.discrete_gaussian.encode_jobs(res['symbols'], res['indexes']))
+            flat_jobs = [job for jobs in all_jobs for job in jobs]
+            executor = getattr(self, '_entropy_executor', None)
+            results = list(map(entropy_coding.run_job, flat_jobs) if (executor is None)
+                           else executor.map(entropy_coding.run_job, flat_jobs))
+        block_strings = []
+        for block, res, jobs in zip(latent_blocks, lv_block_results, all_jobs):
+            block_results, results = results[:len(jobs)], results[len(jobs):]
+            block_strings.append(block.discrete_gaussian.collect_strings(
+                block_results, num_channels=res['symbols'].shape[1]))
+        nB = lv_block_results[0]['symbols'].shape[0]
+        return [[strs[i] for strs in block_strings] for i in range(nB)]
+
     def compress_mode(self, mode=True):
         if mode:
             for block in self.dec_blocks:
                 if hasattr(block, 'update'):
                     block.update()
+        # model weights may have changed, so the cached AdaLN parameters and graphs are invalid
+        self._clear_adaln_cache()
+        self._inference_graphs.clear()
         self.compressing = mode
 
+    # bitstream header: image height and width, lambda, latent height and width (in units of
+    # `max_stride`), number of channel groups, entropy coder id, and deterministic decoding flag.
+    # See `coding.pack_container()`. Headers without the last flag are also accepted.
+    _bitstream_header = '<2Hf2H3B'
+    # if True, store a CRC32 checksum for each sub-stream
+    bitstream_crc = False
+
+    def _pack_bitstream(self, img_hw, lmb, latent_hw, block_strings):
+        """ Pack the strings of one image into a container.
+
+        Args:
+            img_hw (tuple): original (unpadded) image height and width
+            lmb (float): lambda
+            latent_hw (tuple): height and width of the top latent, in units of `max_stride`
+            block_strings (list[list[bytes]]): strings of each latent block and channel group
+        """
+        latent_blocks = [b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)]
+        dg = latent_blocks[0].discrete_gaussian
+        header = struct.pack(self._bitstream_header, *img_hw, float(lmb), *latent_hw,
+                             dg.channel_groups, dg.coder_ids[dg.coder], int(latent_blocks[0].deterministic))
+        substreams = [s for strs in block_strings for s in strs]
+        model_id = getattr(self, 'model_id', None) or type(self).__name__
+        return coding.pack_container(model_id, header, substreams, crc=self.bitstream_crc)
+
+    def _parse_header(self, container: coding.Container):
+        """ Parse the header of a container produced by `_pack_bitstream()`.
+
+        Returns:
+            tuple: (img_h, img_w), lmb, (nH, nW), number of sub-streams of each latent block
+        """
+        header = container.header
+        if len(header) + 1 == struct.calcsize(self._bitstream_header): # without the deterministic flag
+            header = header + b'\x00'
+        img_h, img_w, lmb, nH, nW, groups, coder_id, deterministic = struct.unpack(
+            self._bitstream_header, header)
+        latent_blocks = [b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)]
+        block_counts = []
+        for block in latent_blocks:
+            dg = block.discrete_gaussian
+            if dg.coder_ids[dg.coder] != coder_id:
+                raise ValueError(f'The bitstream uses entropy coder id {coder_id}, but the model '
+                                 f'uses {dg.coder}. See `set_entropy_coding()`.')
+            if bool(deterministic) != block.deterministic:
+                raise ValueError(f'The bitstream uses {bool(deterministic)=}, but the model uses '
+                                 f'{block.deterministic}. See `set_deterministic()`.')
+            block_counts.append(len(dg._channel_slices(block.zdim, channel_groups=groups)))
+        if sum(block_counts) != len(container):
+            raise ValueError(f'Expected {sum(block_counts)} sub-streams, got {len(container)}')
+        return (img_h, img_w), lmb, (nH, nW), block_counts
+
+    def _unpack_bitstream(self, string):
+        """ Parse a container produced by `_pack_bitstream()`.
+
+        Returns:
+            tuple: (img_h, img_w), lmb, (nH, nW), block_strings
+        """
+        container = coding.unpack_container(string, model_id=getattr(self, 'model_id', None))
+        img_hw, lmb, latent_hw, block_counts = self._parse_header(container)
+        substreams = container.substreams()
+        block_strings = []
+        pos = 0
+        for num in block_counts:
+            block_strings.append(substreams[pos:pos+num])
+            pos += num
+        return img_hw, lmb, latent_hw, block_strings
+
     @torch.no_grad()
     def compress(self, im, lmb=None):
+        """ Compress an image into a bitstream. See `_pack_bitstream()` for the format.
+
+        Args:
+            im (torch.Tensor): an image, (1, 3, H, W), values between (0, 1). \
+                It is padded internally if H or W is not divisible by `max_stride`.
+            lmb (float, optional): lambda. Defaults to `self.default_lmb`.
+
+        Returns:
+            bytes: bitstream
+        """
         lmb = lmb or self.default_lmb # if no lmb is provided, use the default one
-        lv_block_results = self.forward_end2end(im, lmb=lmb, mode='compress')
-        assert len(lv_block_results) == self.num_latents
         assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
-        all_lv_strings = [res['strings'][0] for res in lv_block_results]
-        string = coding.pack_byte_strings(all_lv_strings)
-        # encode lambda and image shape in the header
-        nB, _, imH, imW = im.shape
-        header1 = struct.pack('f', lmb)
-        header2 = struct.pack('3H', nB, imH//self.max_stride, imW//self.max_stride)
-        string = header1 + header2 + string
-        return string
+        img_h, img_w = im.shape[2:4]
+        im = self._pad_to_stride(im)
+        graphs = self._inference_graphs.get(tuple(im.shape[2:4]), None)
+        if graphs is not None: # captured graph, see `compile_for_inference()`
+            x = self.preprocess_input(im)
+            outputs = graphs['compress'](x, self._compute_lmb_embedding(self.expand_to_tensor(lmb, n=1)))
+            lv_block_results = [{'symbols': outputs[i], 'indexes': outputs[i+1]}
+                                for i in range(0, len(outputs), 2)]
+            assert len(lv_block_results) == self.num_latents
+            block_strings = self._entropy_encode(lv_block_results)[0]
+        else:
+            block_strings = self._compress_and_encode(im, lmb)[0]
+        latent_hw = (im.shape[2] // self.max_stride, im.shape[3] // self.max_stride)
+        return self._pack_bitstream((img_h, img_w), lmb, latent_hw, block_strings)
 
     @torch.no_grad()
     def decompress(self, string):
-        # extract lambda
-        _len = 4
-        lmb, string = struct.unpack('f', string[:_len])[0], string[_len:]
-        # extract shape
-        _len = 2 * 3
-        (nB, nH, nW), string = struct.unpack('3H', string[:_len]), string[_len:]
-        all_lv_strings = coding.unpack_byte_string(string)
+        """ Decompress a bitstream produced by `compress()`.
 
-        lmb = self.expand_to_tensor(lmb, n=nB)
-        lmb_embedding = self._get_lmb_embedding(lmb, n=nB)
+        Args:
+            string (bytes, bytearray, or memoryview): bitstream
 
-        feature = self.get_bias(bhw_repeat=(nB, nH, nW))
-        str_i = 0
-        for bi, block in enumerate(self.dec_blocks):
-            if getattr(block, 'is_latent_block', False):
-                strs_batch = [all_lv_strings[str_i],]
-                feature, _ = block(feature, lmb_embedding, mode='decompress', strings=strs_batch)
-                str_i += 1
-            elif getattr(block, 'requires_embedding', False):
-                feature = block(feature, lmb_embedding)
+        Returns:
+            torch.Tensor: reconstructed image, (1, 3, H, W), values between (0, 1)
+        """
+        (img_h, img_w), lmb, (nH, nW), block_strings = self._unpack_bitstream(string)
+        graphs = self._inference_graphs.get((nH * self.max_stride, nW * self.max_stride), None)
+        if graphs is not None: # captured graphs, see `compile_for_inference()`
+            im_hat = self._decompress_with_graphs(graphs['decompress'], lmb, (nH, nW), block_strings)
+            return im_hat[:, :, :img_h, :img_w]
+        state = DecoderState(self, lmb, latent_hw=(nH, nW))
+        for strings in block_strings:
+            state.advance(strings=[strings])
+        im_hat = state.preview()
+        return im_hat[:, :, :img_h, :img_w]
+
+    def _decompress_with_graphs(self, segments, lmb, latent_hw, block_strings):
+        """ Decompression with the captured `DecodeSegment` graphs, where entropy decoding \
+        runs between consecutive segments.
+        """
+        emb = self._compute_lmb_embedding(self.expand_to_tensor(lmb, n=1))
+        latent_blocks = [b for b in self.dec_blocks if getattr(b, 'is_latent_block', False)]
+        feature, pm, indexes = segments[0](self.get_bias(bhw_repeat=(1, *latent_hw)), emb)
+        for i, (block, strings) in enumerate(zip(latent_blocks, block_strings)):
+            z = block.discrete_gaussian.decompress([strings], indexes, means=pm)
+            if i + 1 < len(latent_blocks):
+                feature, pm, indexes = segments[i+1](feature, emb, z)
             else:
-                feature = block(feature)
-        assert str_i == len(all_lv_strings), f'str_i={str_i}, len={len(all_lv_strings)}'
-        im_hat = self.process_output(feature)
-        return im_hat
+                x = segments[i+1](feature, emb, z)
+        return self.process_output(x)
+
+    @torch.no_grad()
+    def compile_for_inference(self, shape_buckets=((512, 768), (768, 512)), backend='trace',
+                              cache_dir='~/.cache/lvae/graphs'):
+        """ Capture network-only graphs (`CompressNetwork` and `DecodeSegment`) of `compress()` \
+        and `decompress()` for common image sizes. Images whose padded size matches a bucket use \
+        the graphs, and other sizes fall back to the eager path. Must be called after \
+        `compress_mode(True)`, which also removes the graphs.
+
+        Graphs run the same operations as the eager path. With backend='trace', the bitstreams \
+        are identical to the eager ones. 'compile' generates new kernels, whose tiny numerical \
+        differences may change the CDF indexes, so encoder and decoder should use the same backend.
+
+        Args:
+            shape_buckets (list[tuple]): image (height, width), padded to multiples of `max_stride`
+            backend (str, optional): 'trace' (`torch.jit.trace`), whose graphs are saved to \
+                `cache_dir` and reloaded by later processes, or 'compile' (`torch.compile`), \
+                whose kernels are cached by inductor. None removes all graphs. Defaults to 'trace'.
+            cache_dir (str, optional): cache directory. Defaults to '~/.cache/lvae/graphs'.
+        """
+        self._inference_graphs.clear()
+        if backend is None:
+            return
+        assert self.compressing and not self.training, 'Please call eval() and compress_mode(True) first.'
+        cache_dir = Path(cache_dir).expanduser()
+        if backend == 'compile':
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(cache_dir / 'inductor'))
+        model_key = None
+        if backend == 'trace':
+            model_id = getattr(self, 'model_id', None) or type(self).__name__
+            model_key = f'{model_id}-{inference_graphs.module_fingerprint(self)[:16]}'
+        compress_net = CompressNetwork(self)
+        segments = make_decode_segments(self)
+        emb = self._compute_lmb_embedding(self.expand_to_tensor(self.default_lmb, n=1))
+        for bucket in shape_buckets:
+            H, W = [math.ceil(v / self.max_stride) * self.max_stride for v in bucket]
+            _path = lambda name: None if (model_key is None) else cache_dir / f'{model_key}-{H}x{W}-{name}.pt'
+            x = torch.zeros(1, 3, H, W, device=self._dummy.device)
+            graphs = {'compress': inference_graphs.capture(compress_net, (x, emb), backend, _path('compress'))}
+            # decoding segments, with example inputs from the previous segment
+            inputs = (self.get_bias(bhw_repeat=(1, H // self.max_stride, W // self.max_stride)), emb)
+            graphs['decompress'] = []
+            for i, seg in enumerate(segments):
+                graphs['decompress'].append(inference_graphs.capture(seg, inputs, backend, _path(f'decode{i}')))
+                if i + 1 < len(segments):
+                    feature, pm, _ = seg(*inputs)
+                    inputs = (feature, emb, torch.zeros_like(pm))
+            self._inference_graphs[(H, W)] = graphs
+
+    def _synthesis_tail(self):
+        """ Geometry of the synthesis tail, ie, the blocks after the last latent block, \
+        which only depend on local neighborhoods (convolutions and per-pixel layers).
+
+        Returns:
+            tuple: (start position in `dec_blocks`, upsampling factor, receptive-field halo \
+                in units of the tail input)
+        """
+        latent_pos = [i for i, b in enumerate(self.dec_blocks) if getattr(b, 'is_latent_block', False)]
+        start = latent_pos[-1] + 1
+        scale, halo = 1, 0.0
+        for block in self.dec_blocks[start:]:
+            for m in block.modules():
+                if isinstance(m, nn.Conv2d):
+                    assert m.stride == (1, 1), f'Strided convolution is not supported: {m}'
+                    radius = max([d * (k - 1) // 2 for k, d in zip(m.kernel_size, m.dilation)])
+                    halo += radius / scale
+                elif isinstance(m, nn.PixelShuffle):
+                    scale *= m.upscale_factor
+        return start, scale, math.ceil(halo)
+
+    @torch.no_grad()
+    def decompress_roi(self, string, box):
+        """ Decompress a region of interest (crop) of the image. Latents are decoded for the \
+        whole image, but the synthesis tail (see `_synthesis_tail()`) only runs on the region \
+        plus its receptive-field halo. The pixels are the same as the crop of a full decoding.
+
+        Args:
+            string (bytes, bytearray, or memoryview): bitstream produced by `compress()`
+            box (tuple): (left, top, right, bottom), in pixels, same as `PIL.Image.crop()`
+
+        Returns:
+            torch.Tensor: the region, (1, 3, bottom-top, right-left), values between (0, 1)
+        """
+        (img_h, img_w), lmb, (nH, nW), block_strings = self._unpack_bitstream(string)
+        left, top, right, bottom = box
+        if not (0 <= left < right <= img_w and 0 <= top < bottom <= img_h):
+            raise ValueError(f'Invalid {box=} for image size {(img_h, img_w)}')
+        state = DecoderState(self, lmb, latent_hw=(nH, nW))
+        for strings in block_strings:
+            state.advance(strings=[strings])
+        return state.preview(box=box)
+
+    @torch.no_grad()
+    def decompress_bands(self, string, band_height=256):
+        """ Decompress a bitstream produced by `compress()`, and yield the image in horizontal \
+        bands from top to bottom. See `DecoderState.iter_bands()`. \
+        Concatenating all bands gives the same image as `decompress()`.
+
+        Args:
+            string (bytes, bytearray, or memoryview): bitstream
+            band_height (int, optional): number of pixel rows per band. Defaults to 256.
+
+        Yields:
+            torch.Tensor: rows of the image, (1, 3, h, W), values between (0, 1)
+        """
+        (img_h, img_w), lmb, (nH, nW), block_strings = self._unpack_bitstream(string)
+        state = DecoderState(self, lmb, latent_hw=(nH, nW))
+        for strings in block_strings:
+            state.advance(strings=[strings])
+        row = 0
+        for band in state.iter_bands(band_height=band_height):
+            band = band[:, :, :max(img_h - row, 0), :img_w]
+            row += band.shape[2]
+            if band.shape[2] > 0:
+                yield band
+
+    @torch.no_grad()
+    def decompress_partial(self, string):
+        """ Decompress a byte prefix of a bitstream produced by `compress()`. Latent sub-streams \
+        are stored coarse to fine, so a prefix decodes to a coarse reconstruction. \
+        See `ProgressiveDecoder` for incremental decoding.
+
+        Args:
+            string (bytes, bytearray, or memoryview): (truncated) bitstream
+
+        Returns:
+            torch.Tensor: reconstructed image, (1, 3, H, W), values between (0, 1)
+        """
+        decoder = ProgressiveDecoder(self)
+        decoder.feed(string)
+        return decoder.reconstruct()
+
+    def _pad_to_stride(self, im: torch.Tensor):
+        """ Pad an image tensor at right and bottom border (edge padding), \
+            such that both sides are divisible by `self.max_stride`.
+
+        Args:
+            im (torch.Tensor): an image, (3, H, W) or (1, 3, H, W)
+        """
+        return coding.pad_tensor_divisible_by(im, div=self.max_stride)
+
+    @torch.no_grad()
+    def compress_batch(self, ims, lmbs=None, max_batch=None):
+        """ Compress a list of images into independent bitstreams. Images are grouped into \
+        buckets of the same padded shape, and each bucket is processed by one network pass.
+
+        Args:
+            ims (list[torch.Tensor]): images, each (3, H, W) or (1, 3, H, W), values between (0, 1). \
+                Sizes can be different.
+            lmbs (list[float], optional): lambda of each image. Defaults to `self.default_lmb`.
+            max_batch (int, optional): maximum number of images per network pass.
+
+        Returns:
+            list[bytes]: one bitstream per image, same format as `compress()`. The decoder \
+                computes the CDF indexes at batch size 1 (or another batch size), so they must \
+                not depend on the batch: in batched coding, the layers whose kernels depend on the \
+                batch size run per sample (see `common.batch_invariant()`). \
+                Tested by `scripts/qarv/test-batch-coding.py`.
+        """
+        lmbs = [self.default_lmb] * len(ims) if (lmbs is None) else lmbs
+        assert len(lmbs) == len(ims), f'{len(lmbs)=}, {len(ims)=}'
+        # bucket the images by their padded shape
+        buckets = defaultdict(list)
+        for i, im in enumerate(ims):
+            padded = self._pad_to_stride(im)
+            buckets[tuple(padded.shape[2:4])].append(i)
+        device = self._dummy.device
+        all_strings = [None] * len(ims)
+        for (imH, imW), indices in buckets.items():
+            step = max_batch or len(indices)
+            for start in range(0, len(indices), step):
+                batch_idx = indices[start:start+step]
+                im = torch.cat([self._pad_to_stride(ims[i]) for i in batch_idx], dim=0).to(device=device)
+                lmb = torch.tensor([float(lmbs[i]) for i in batch_idx], device=device)
+                # entropy coding for each image
+                batch_strings = self._compress_and_encode(im, lmb)
+                latent_hw = (imH // self.max_stride, imW // self.max_stride)
+                for bi, i in enumerate(batch_idx):
+                    img_hw = (ims[i].shape[-2], ims[i].shape[-1])
+                    all_strings[i] = self._pack_bitstream(img_hw, lmbs[i], latent_hw, batch_strings[bi])
+        return all_strings
+
+    @torch.no_grad()
+    def decompress_batch(self, strings, max_batch=None):
+        """ Decompress a list of bitstreams produced by `compress_batch()` or `compress()`. \
+        Bitstreams with the same latent shape are decoded together in one network pass, \
+        with the same outputs as `decompress()` (see `compress_batch()`).
+
+        Args:
+            strings (list[bytes]): bitstreams
+            max_batch (int, optional): maximum number of images per network pass.
+
+        Returns:
+            list[torch.Tensor]: reconstructed images, each (1, 3, H, W), values between (0, 1)
+        """
+        # parse headers and bucket by latent shape
+        headers, bodies = [], []
+        buckets = defaultdict(list)
+        for i, string in enumerate(strings):
+            (img_h, img_w), lmb, (nH, nW), block_strings = self._unpack_bitstream(string)
+            headers.append((img_h, img_w, lmb))
+            bodies.append(block_strings)
+            # bitstreams with different numbers of channel groups are decoded separately
+            buckets[(nH, nW, len(block_strings[0]))].append(i)
+        device = self._dummy.device
+        im_hats = [None] * len(strings)
+        for (nH, nW, _), indices in buckets.items():
+            step = max_batch or len(indices)
+            for start in range(0, len(indices), step):
+                batch_idx = indices[start:start+step]
+                nB = len(batch_idx)
+                lmb = torch.tensor([headers[i][2] for i in batch_idx], device=device)
+                lmb_embedding = self._get_lmb_embedding(lmb, n=nB)
+                feature = self.get_bias(bhw_repeat=(nB, nH, nW))
+                str_i = 0
+                with common.batch_invariant():
+                    for block in self.dec_blocks:
+                        if getattr(block, 'is_latent_block', False):
+                            strs_batch = [bodies[i][str_i] for i in batch_idx]
+                            feature, _ = block(feature, lmb_embedding, mode='decompress', strings=strs_batch)
+                            str_i += 1
+                        elif getattr(block, 'requires_embedding', False):
+                            feature = block(feature, lmb_embedding)
+                        else:
+                            feature = block(feature)
+                assert str_i == self.num_latents, f'str_i={str_i}, num_latents={self.num_latents}'
+                im_hat = self.process_output(feature)
+                for bi, i in enumerate(batch_idx):
+                    img_h, img_w, _ = headers[i]
+                    im_hats[i] = im_hat[bi:bi+1, :, :img_h, :img_w]
+        return im_hats
+
+    @torch.no_grad()
+    def compress_multi_rate(self, im, lmbs, max_batch=None):
+        """ Compress an image at multiple lambdas (eg, a quality ladder for adaptive streaming). \
+        The lambdas are stacked in the batch dimension, sharing the input preprocessing and all \
+        lambda-independent layers of the encoder.
+
+        Args:
+            im (torch.Tensor): an image, (1, 3, H, W), values between (0, 1). \
+                It is padded internally if H or W is not divisible by `max_stride`.
+            lmbs (list[float]): lambdas
+            max_batch (int, optional): maximum number of lambdas per network pass.
+
+        Returns:
+            list[bytes]: one bitstream per lambda, same format as `compress()`, and decodable by \
+                `decompress()`, as the CDF indexes do not depend on the batch (see `compress_batch()`). \
+                The bytes can differ from `compress()`, as the encoder layers before the first \
+                AdaLN block run on a batch of one image instead of the lambdas.
+        """
+        assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
+        img_hw = tuple(im.shape[2:4])
+        im = self._pad_to_stride(im).to(device=self._dummy.device)
+        latent_hw = (im.shape[2] // self.max_stride, im.shape[3] // self.max_stride)
+        step = max_batch or len(lmbs)
+        all_strings = []
+        for start in range(0, len(lmbs), step):
+            batch_lmbs = [float(v) for v in lmbs[start:start+step]]
+            lmb = torch.tensor(batch_lmbs, device=im.device)
+            batch_strings = self._compress_and_encode(im, lmb)
+            all_strings.extend([self._pack_bitstream(img_hw, v, latent_hw, strs)
+                                for v, strs in zip(batch_lmbs, batch_strings)])
+        return all_strings
+
+    @torch.no_grad()
+    def estimate_rate(self, im, lmbs, max_batch=None):
+        """ Estimate the bitstream size at each lambda from the prior and posterior probabilities \
+        (the `kl` of the latent blocks), without running the entropy coder. The encoder runs once, \
+        with the lambdas stacked in the batch dimension, and the top-down path stops after the \
+        last latent block (at `common.CompresionStopFlag`), so the synthesis tail does not run.
+
+        Args:
+            im (torch.Tensor): an image, (1, 3, H, W), values between (0, 1)
+            lmbs (list[float]): lambdas
+            max_batch (int, optional): maximum number of lambdas per pass of the latent blocks.
+
+        Returns:
+            list[float]: estimated number of bytes at each lambda, excluding the container header
+        """
+        assert not self.training, 'Rate estimation uses quantized latents. Please call model.eval() first.'
+        assert im.shape[0] == 1, f'Right now only support a single image, got {im.shape=}'
+        im = self._pad_to_stride(im).to(device=self._dummy.device)
+        x = self.preprocess_input(im)
+        nL = len(lmbs)
+        lmb = torch.tensor([float(v) for v in lmbs], device=im.device)
+        # the image is broadcasted to the lambdas at the first AdaLN block (see `forward_end2end()`)
+        _, enc_features = self.encoder(x, self._get_lmb_embedding(lmb, n=nL))
+        enc_features = {k: v.expand(nL, -1, -1, -1) for k, v in enc_features.items()}
+        latent_hw = (x.shape[2] // self.max_stride, x.shape[3] // self.max_stride)
+        step = max_batch or nL
+        all_bytes = []
+        for start in range(0, nL, step):
+            nB = min(step, nL - start)
+            emb = self._get_lmb_embedding(lmb[start:start+nB], n=nB)
+            feature = self.get_bias(bhw_repeat=(nB, *latent_hw))
+            kl, num_latents = 0.0, 0 # nats per image
+            for block in self.dec_blocks:
+                if getattr(block, 'is_latent_block', False):
+                    f_enc = enc_features[block.enc_key][start:start+nB]
+                    feature, stats = block(feature, emb, enc_feature=f_enc, mode='trainval')
+                    kl = kl + stats['kl'].sum(dim=(1, 2, 3))
+                    num_latents += 1
+                elif isinstance(block, common.CompresionStopFlag):
+                    break
+                elif getattr(block, 'requires_embedding', False):
+                    feature = block(feature, emb)
+                else:
+                    feature = block(feature)
+            assert num_latents == self.num_latents, f'{num_latents=}, {self.num_latents=}'
+            all_bytes.extend((kl * self.log2_e / 8).tolist())
+        return all_bytes
+
+    def _get_rate_curve(self, im, num_probes, max_batch=None):
+        """ Get the (cached) rate-lambda curve of an image. A new curve is initialized by \
+        `num_probes` lambdas, uniformly spaced in log space over `self.lmb_range`.
+
+        Returns:
+            dict: lambda -> estimated bytes. Points added by the caller are kept in the cache.
+        """
+        key = (hashlib.sha1(im.detach().cpu().numpy().tobytes()).hexdigest(), tuple(im.shape))
+        if key not in self._rate_curves:
+            low, high = self.lmb_range
+            probes = torch.linspace(math.log(low), math.log(high), steps=num_probes).exp().tolist()
+            probes[0], probes[-1] = low, high # avoid rounding errors at the boundaries
+            self._rate_curves[key] = dict(zip(probes, self.estimate_rate(im, probes, max_batch)))
+            while len(self._rate_curves) > self.rate_curve_cache_size:
+                self._rate_curves.popitem(last=False)
+        self._rate_curves.move_to_end(key)
+        return self._rate_curves[key]
+
+    @staticmethod
+    def _search_rate_curve(curve: dict, target):
+        """ Find the lambda that gives `target` bytes, by linear interpolation (ie, a secant step) \
+        between the two bracketing points in the log-log space. Clamped to the curve's lambda range.
+        """
+        points = sorted(curve.items())
+        if target <= points[0][1]:
+            return points[0][0]
+        for (l0, b0), (l1, b1) in zip(points[:-1], points[1:]):
+            if b1 < target:
+                continue
+            if b1 <= b0: # non-monotonic curve
+                return l1
+            t = (math.log(target) - math.log(max(b0, 1e-6))) / (math.log(b1) - math.log(max(b0, 1e-6)))
+            return math.exp(math.log(l0) + t * (math.log(l1) - math.log(l0)))
+        return points[-1][0]
+
+    @torch.no_grad()
+    def compress_to_target(self, im, target_bytes, rtol=0.02, num_probes=5, max_estimates=6,
+                           max_encodes=3, max_batch=None):
+        """ Compress an image into (at most) `target_bytes` bytes by searching for the lambda. \
+        The search runs on the estimated rates (see `estimate_rate()`) over a cached per-image \
+        rate-lambda curve, and the entropy coder only runs to confirm the chosen lambda.
+
+        Args:
+            im (torch.Tensor): an image, (1, 3, H, W), values between (0, 1)
+            target_bytes (int): target bitstream size, in bytes
+            rtol (float, optional): relative tolerance of the search. Defaults to 0.02.
+            num_probes (int, optional): number of lambdas to initialize the rate-lambda curve.
+            max_estimates (int, optional): maximum number of rate estimations per search.
+            max_encodes (int, optional): maximum number of actual encodings.
+            max_batch (int, optional): maximum number of lambdas per network pass.
+
+        Returns:
+            tuple: (bitstream, lambda). The bitstream is the largest one within `target_bytes`, \
+                or the smallest one if the target cannot be reached.
+        """
+        curve = self._get_rate_curve(im, num_probes=num_probes, max_batch=max_batch)
+        low, high = self.lmb_range
+        encoded = dict() # lambda -> bitstream
+        scale = 1.0 # ratio between the actual and the estimated sizes
+        for _ in range(max_encodes):
+            # aim slightly below the target, such that the result is likely to be within the budget
+            goal = target_bytes * (1 - rtol / 2) / scale
+            for _ in range(max_estimates):
+                lmb = self._search_rate_curve(curve, goal)
+                if lmb in curve: # a known point, or clamped to the lambda range
+                    break
+                curve[lmb] = self.estimate_rate(im, [lmb])[0]
+                if abs(curve[lmb] - goal) <= rtol * goal:
+                    break
+            if lmb in encoded:
+                break
+            encoded[lmb] = self.compress(im, lmb=lmb)
+            num_bytes = len(encoded[lmb])
+            if (target_bytes * (1 - rtol) <= num_bytes <= target_bytes) \
+                or (num_bytes > target_bytes and lmb == low) or (num_bytes <= target_bytes and lmb == high):
+                break
+            scale = num_bytes / max(curve[lmb], 1.0)
+        within = [(len(s), lmb) for lmb, s in encoded.items() if len(s) <= target_bytes]
+        _, lmb = max(within) if within else min([(len(s), lmb) for lmb, s in encoded.items()])
+        return encoded[lmb], lmb
+
+    @torch.no_grad()
+    def compress_tiled(self, img, lmb=None, tile_size=512, overlap=0, workers=0):
+        """ Compress a (very large) image tile by tile. The peak memory is bounded by the tile size.
+
+        Args:
+            img (PIL.Image or torch.Tensor): image. If a tensor, (1, 3, H, W), values between (0, 1).
+            lmb (float, optional): lambda. Defaults to `self.default_lmb`.
+            tile_size (int, optional): tile size, should be divisible by 64. Defaults to 512.
+            overlap (int, optional): overlap between neighboring tiles. Defaults to 0.
+            workers (int, optional): number of threads to encode tiles in parallel. Defaults to 0.
+
+        Returns:
+            bytes: bitstream, see `coding.tiled_compress()`
+        """
+        device = self._dummy.device
+        def _encode_tile(tile):
+            return self.compress(tile.to(device=device), lmb=lmb)
+        model_id = getattr(self, 'model_id', None) or type(self).__name__
+        return coding.tiled_compress(img, _encode_tile, tile_size=tile_size, overlap=overlap,
+                                     workers=workers, model_id=model_id, crc=self.bitstream_crc)
+
+    @torch.no_grad()
+    def decompress_tiled(self, string, workers=0):
+        """ Decompress a bitstream produced by `compress_tiled()`, tile by tile.
+
+        Args:
+            string (bytes): bitstream
+            workers (int, optional): number of threads to decode tiles in parallel. Defaults to 0.
+
+        Returns:
+            torch.Tensor: reconstructed image, (1, 3, H, W), on CPU
+        """
+        return coding.tiled_decompress(string, self.decompress, workers=workers,
+                                       model_id=getattr(self, 'model_id', None))
+
+    @torch.no_grad()
+    def compress_bytes(self, image, lmb=None):
+        """ Compress an image in memory.
+
+        Args:
+            image: encoded image file (bytes), PIL.Image, or uint8 np.ndarray. See `coding.read_image()`.
+            lmb (float, optional): lambda. Defaults to `self.default_lmb`.
+
+        Returns:
+            bytes: bitstream
+        """
+        img = coding.read_image(image)
+        im = tvf.to_tensor(img).unsqueeze_(0).to(device=self._dummy.device)
+        return self.compress(im, lmb=lmb)
+
+    @torch.no_grad()
+    def decompress_bytes(self, string, output='tensor'):
+        """ Decompress a bitstream in memory.
+
+        Args:
+            string (bytes, bytearray, or memoryview): bitstream
+            output (str, optional): 'tensor', 'numpy', or 'pil'. See `coding.format_image_output()`.
+        """
+        im_hat = self.decompress(string)
+        return coding.format_image_output(im_hat, output)
+
+    @torch.no_grad()
+    def compress_fileobj(self, image_file, bits_file, lmb=None):
+        """ Compress an image read from a binary file object, and write bits to another one.
+
+        Args:
+            image_file (BinaryIO): encoded image file
+            bits_file  (BinaryIO): output bitstream
+            lmb (float, optional): lambda. Defaults to `self.default_lmb`.
+
+        Returns:
+            int: number of bytes written
+        """
+        return bits_file.write(self.compress_bytes(image_file, lmb=lmb))
+
+    @torch.no_grad()
+    def decompress_fileobj(self, bits_file, output='tensor'):
+        """ Decompress a bitstream read from a binary file object. See `decompress_bytes()`.
+        """
+        return self.decompress_bytes(bits_file.read(), output=output)
 
     @torch.no_grad()
     def compress_file(self, img_path, output_path, lmb=None):
-        # read image
-        img = Image.open(img_path)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
-        img_padded = coding.pad_divisible_by(img, div=self.max_stride)
-        im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=self._dummy.device)
-        # compress by model
-        body_str = self.compress(im, lmb=lmb)
-        header_str = struct.pack('2H', img.height, img.width)
-        # save bits to file
-        with open(output_path, 'wb') as f:
-            f.write(header_str + body_str)
+        with open(img_path, 'rb') as fin, open(output_path, 'wb') as fout:
+            self.compress_fileobj(fin, fout, lmb=lmb)
 
     @torch.no_grad()
     def decompress_file(self, bits_path):
-        # read from file
         with open(bits_path, 'rb') as f:
-            header_str = f.read(4)
-            body_str = f.read()
-        img_h, img_w = struct.unpack('2H', header_str)
-        # decompress by model
-        im_hat = self.decompress(body_str)
-        return im_hat[:, :, :img_h, :img_w]
+            return self.decompress_fileobj(f)
+
+
+def _block_kind(block: nn.Module):
+    if isinstance(block, common.SetKey):
+        return 'key'
+    if getattr(block, 'is_latent_block', False):
+        return 'latent'
+    if getattr(block, 'requires_embedding', False):
+        return 'embedding'
+    return 'plain'
+
+
+def _run_blocks(blocks, kinds, feature, lmb_embedding):
+    for block, kind in zip(blocks, kinds):
+        feature = block(feature, lmb_embedding) if (kind == 'embedding') else block(feature)
+    return feature
+
+
+class CompressNetwork(nn.Module):
+    """ Network part of `VariableRateLossyVAE.compress()`: preprocessed image and lambda embedding \
+    -> (symbols, indexes) of all latent blocks, for the entropy coding stage. Block types are \
+    resolved at construction, so the forward pass has no type- or mode-dependent control flow, \
+    and it can be traced or compiled. Modules are shared with the model.
+    """
+    def __init__(self, model: VariableRateLossyVAE):
+        super().__init__()
+        self.enc_blocks = nn.ModuleList(model.encoder.enc_blocks)
+        self.enc_kinds = [_block_kind(b) for b in self.enc_blocks]
+        stop = [isinstance(b, common.CompresionStopFlag) for b in model.dec_blocks].index(True)
+        self.dec_blocks = nn.ModuleList(model.dec_blocks[:stop])
+        self.dec_kinds = [_block_kind(b) for b in self.dec_blocks]
+        self.bias = model.bias
+        self.max_stride = model.max_stride
+
+    def forward(self, x, lmb_embedding):
+        """
+        Args:
+            x (torch.Tensor): preprocessed image, (N, 3, H, W), see `preprocess_input()`
+            lmb_embedding (torch.Tensor): lambda embedding, (N, D), see `_compute_lmb_embedding()`
+
+        Returns:
+            tuple: symbols_0, indexes_0, symbols_1, indexes_1, ...
+        """
+        nB, _, xH, xW = x.shape
+        enc_features = dict()
+        for block, kind in zip(self.enc_blocks, self.enc_kinds):
+            if kind == 'key':
+                enc_features[block.key] = x
+            else:
+                x = block(x, lmb_embedding) if (kind == 'embedding') else block(x)
+        feature = self.bias.expand(nB, -1, xH // self.max_stride, xW // self.max_stride)
+        outputs = []
+        for block, kind in zip(self.dec_blocks, self.dec_kinds):
+            if kind == 'latent':
+                feature, symbols, indexes = block.forward_compress(feature, lmb_embedding,
+                                                                   enc_features[block.enc_key])
+                outputs.extend([symbols, indexes])
+            else:
+                feature = block(feature, lmb_embedding) if (kind == 'embedding') else block(feature)
+        return tuple(outputs)
+
+
+class DecodeSegment(nn.Module):
+    """ Network part of decompression between two entropy decoding steps: merge the previous \
+    latent (if any), run the blocks in between, and compute the prior of the next latent block. \
+    Like `CompressNetwork`, it can be traced or compiled. See `make_decode_segments()`.
+    """
+    def __init__(self, prev_block, blocks, next_block):
+        """
+        Args:
+            prev_block (VRLVBlockBase or None): the previous latent block
+            blocks (list[nn.Module]): blocks in between
+            next_block (VRLVBlockBase or None): the next latent block. If None, the segment \
+                is the last one, which outputs the network output (before `process_output()`).
+        """
+        super().__init__()
+        self.prev_block = prev_block
+        self.blocks = nn.ModuleList(blocks)
+        self.kinds = [_block_kind(b) for b in self.blocks]
+        self.next_block = next_block
+
+    def forward(self, feature, lmb_embedding, z=None):
+        """
+        Returns:
+            tuple or torch.Tensor: (feature, prior mean, CDF indexes), or the network output \
+                if this is the last segment
+        """
+        if self.prev_block is not None:
+            feature = self.prev_block.forward_end(feature, z, lmb_embedding)
+        feature = _run_blocks(self.blocks, self.kinds, feature, lmb_embedding)
+        if self.next_block is None:
+            return feature
+        return self.next_block.decode_prior(feature, lmb_embedding)
+
+
+def make_decode_segments(model: VariableRateLossyVAE):
+    """ Split the top-down path of a model into `num_latents + 1` `DecodeSegment`s.
+    """
+    segments = []
+    prev_block, blocks = None, []
+    for block in model.dec_blocks:
+        if getattr(block, 'is_latent_block', False):
+            segments.append(DecodeSegment(prev_block, blocks, block))
+            prev_block, blocks = block, []
+        elif not isinstance(block, common.CompresionStopFlag):
+            blocks.append(block)
+    segments.append(DecodeSegment(prev_block, blocks, None))
+    return segments
+
+
+class DecoderState():
+    """ Checkpointed state of the top-down (decoding) path. The feature map is checkpointed after \
+    each latent block, so decoding can continue from block k with new strings or latents, \
+    without recomputing blocks 0 to k-1. The remaining blocks (including the upsampling layers \
+    after `CompresionStopFlag`) only run when `preview()` is called.
+    """
+    def __init__(self, model: VariableRateLossyVAE, lmb, latent_hw, batch_size=1, keep_checkpoints=False):
+        """
+        Args:
+            model (VariableRateLossyVAE): model
+            lmb (float or torch.Tensor): lambda
+            latent_hw (tuple): height and width of the top latent, in units of `max_stride`
+            batch_size (int, optional): batch size. Defaults to 1.
+            keep_checkpoints (bool, optional): keep the checkpoints of all latent blocks, \
+                which allows `restore()` to any of them. By default, only the latest one is kept.
+        """
+        self.model = model
+        self.keep_checkpoints = keep_checkpoints
+        lmb = model.expand_to_tensor(lmb, n=batch_size)
+        self.lmb_embedding = model._get_lmb_embedding(lmb, n=batch_size)
+        feature = model.get_bias(bhw_repeat=(batch_size, *latent_hw))
+        # number of decoded latent blocks -> (feature, position in `model.dec_blocks`)
+        self.checkpoints = OrderedDict({0: (feature, 0)})
+        self.num_decoded = 0
+
+    @property
+    def num_latents(self):
+        return self.model.num_latents
+
+    @property
+    def complete(self):
+        return self.num_decoded == self.num_latents
+
+    def _run_block(self, block, feature):
+        if getattr(block, 'requires_embedding', False):
+            return block(feature, self.lmb_embedding)
+        return block(feature)
+
+    @torch.no_grad()
+    def advance(self, strings=None, latent=None, t=0.0):
+        """ Decode the next latent block, either from entropy-coded strings or from a given latent. \
+        If neither is provided, the latent is sampled from the prior with temperature `t`.
+
+        Args:
+            strings (list, optional): strings of each image, see `DiscretizedGaussian.decompress()`
+            latent (torch.Tensor, optional): latent variable
+            t (float, optional): temperature. Defaults to 0, ie, the prior mean.
+
+        Returns:
+            int: number of decoded latent blocks
+        """
+        assert not self.complete, 'All latent blocks are decoded'
+        assert (strings is None) or (latent is None), 'Provide either strings or latent, not both'
+        feature, pos = self.checkpoints[self.num_decoded]
+        while True:
+            block = self.model.dec_blocks[pos]
+            pos += 1
+            if getattr(block, 'is_latent_block', False):
+                if strings is not None:
+                    feature, _ = block(feature, self.lmb_embedding, mode='decompress', strings=strings)
+                else:
+                    feature, _ = block(feature, self.lmb_embedding, mode='sampling', latent=latent, t=t)
+                break
+            feature = self._run_block(block, feature)
+        self.num_decoded += 1
+        if not self.keep_checkpoints:
+            self.checkpoints.clear()
+        self.checkpoints[self.num_decoded] = (feature, pos)
+        return self.num_decoded
+
+    def restore(self, k):
+        """ Go back to the checkpoint after `k` latent blocks, eg, to continue with other latents.
+
+        Args:
+            k (int): number of decoded latent blocks
+        """
+        if k not in self.checkpoints:
+            raise KeyError(f'No checkpoint after {k} latent blocks, available: {list(self.checkpoints)}. '
+                           'Use keep_checkpoints=True to keep all of them.')
+        for key in [key for key in self.checkpoints if key > k]:
+            self.checkpoints.pop(key)
+        self.num_decoded = k
+
+    def _tail_input(self, t=0.0):
+        """ Run the remaining latent blocks and get the input of the synthesis tail """
+        feature, pos = self.checkpoints[self.num_decoded]
+        tail_start, _, _ = self.model._synthesis_tail()
+        for block in self.model.dec_blocks[pos:tail_start]:
+            if getattr(block, 'is_latent_block', False):
+                feature, _ = block(feature, self.lmb_embedding, mode='sampling', latent=None, t=t)
+            else:
+                feature = self._run_block(block, feature)
+        return feature
+
+    def _run_tail(self, feature, box=None):
+        """ Run the synthesis tail, optionally only on a region (plus its receptive-field halo) """
+        tail_start, scale, halo = self.model._synthesis_tail()
+        if box is not None: # crop the tail input to the region plus halo
+            left, top, right, bottom = box
+            _, _, fH, fW = feature.shape
+            y0, x0 = max(top // scale - halo, 0), max(left // scale - halo, 0)
+            y1, x1 = min(-(-bottom // scale) + halo, fH), min(-(-right // scale) + halo, fW)
+            feature = feature[:, :, y0:y1, x0:x1]
+        for block in self.model.dec_blocks[tail_start:]:
+            feature = self._run_block(block, feature)
+        if box is not None:
+            feature = feature[:, :, top-y0*scale:bottom-y0*scale, left-x0*scale:right-x0*scale]
+        return self.model.process_output(feature)
+
+    @torch.no_grad()
+    def preview(self, t=0.0, box=None):
+        """ Run the remaining latent blocks (sampled from the prior with temperature `t`) and \
+        the remaining layers, and get the output image. The state is not changed.
+
+        Args:
+            t (float, optional): temperature. Defaults to 0, ie, the prior mean.
+            box (tuple, optional): (left, top, right, bottom) in pixels. If provided, the \
+                synthesis tail only runs on this region plus its receptive-field halo.
+
+        Returns:
+            torch.Tensor: image, (N, 3, H, W), values between (0, 1). Not cropped if `box` is None.
+        """
+        return self._run_tail(self._tail_input(t=t), box=box)
+
+    @torch.no_grad()
+    def iter_bands(self, band_height=256, t=0.0):
+        """ Like `preview()`, but the synthesis tail runs in horizontal bands (with receptive-field \
+        overlap), and finished rows are yielded band by band. The peak memory is bounded by \
+        the band height instead of the image height.
+
+        Args:
+            band_height (int, optional): number of pixel rows per band. Rounded to a multiple \
+                of the tail upsampling factor. Defaults to 256.
+            t (float, optional): temperature. Defaults to 0, ie, the prior mean.
+
+        Yields:
+            torch.Tensor: rows of the image, (N, 3, h, W), values between (0, 1). Not cropped.
+        """
+        feature = self._tail_input(t=t)
+        _, scale, _ = self.model._synthesis_tail()
+        _, _, fH, fW = feature.shape
+        step = max(band_height // scale, 1) * scale
+        for top in range(0, fH * scale, step):
+            bottom = min(top + step, fH * scale)
+            yield self._run_tail(feature, box=(0, top, fW * scale, bottom))
+
+
+class ProgressiveDecoder():
+    """ Incremental decoder for a bitstream that arrives in chunks, eg, over a slow link. \
+    Each latent block is decoded once, as soon as all its sub-streams are received. \
+    `reconstruct()` can be called at any time, and the latent blocks that are not received \
+    yet are set to their prior means (ie, sampling with temperature 0).
+    """
+    def __init__(self, model: VariableRateLossyVAE):
+        """
+        Args:
+            model (VariableRateLossyVAE): model in compress mode, see `model.compress_mode()`
+        """
+        self.model = model
+        self.buffer = bytearray()
+        self.img_hw = None # known after the container header is received
+        self.state = None # DecoderState
+        self._block_counts = None
+        # container parsed once its index is received. Its offsets locate the sub-streams in `buffer`
+        self._container = None
+
+    @property
+    def num_decoded(self):
+        return 0 if (self.state is None) else self.state.num_decoded
+
+    @property
+    def complete(self):
+        return (self.state is not None) and self.state.complete
+
+    @torch.no_grad()
+    def feed(self, data):
+        """ Append received bytes, and decode the latent blocks that become complete.
+
+        Args:
+            data (bytes, bytearray, or memoryview): next chunk of the bitstream
+
+        Returns:
+            int: number of decoded latent blocks so far
+        """
+        self.buffer.extend(data)
+        if self._container is None:
+            try: # only the header and index are parsed, and only until they are complete
+                self._container = coding.unpack_container(bytes(self.buffer), partial=True, validate=False,
+                                                          model_id=getattr(self.model, 'model_id', None))
+            except coding.TruncatedError: # the container index is not complete yet
+                return self.num_decoded
+            self.img_hw, lmb, latent_hw, self._block_counts = self.model._parse_header(self._container)
+            self.state = DecoderState(self.model, lmb, latent_hw)
+        offsets = self._container.offsets
+        while not self.complete:
+            start = sum(self._block_counts[:self.num_decoded])
+            end = start + self._block_counts[self.num_decoded]
+            if offsets[end] > len(self.buffer):
+                break
+            strings = []
+            for i in range(start, end): # copies of the newly completed sub-streams only
+                strings.append(bytes(self.buffer[offsets[i]:offsets[i+1]]))
+                self._container.validate_substream(i, strings[-1])
+            self.state.advance(strings=[strings])
+        return self.num_decoded
+
+    @torch.no_grad()
+    def reconstruct(self, box=None):
+        """ Reconstruct the image from the latent blocks decoded so far. \
+        The decoder state is not changed, so more bytes can be fed afterwards.
+
+        Args:
+            box (tuple, optional): (left, top, right, bottom). Only reconstruct this region.
+
+        Returns:
+            torch.Tensor: reconstructed image, (1, 3, H, W), values between (0, 1)
+        """
+        if self.state is None:
+            raise RuntimeError('The bitstream header has not been received yet')
+        if box is not None:
+            return self.state.preview(box=box)
+        img_h, img_w = self.img_hw
+        return self.state.preview()[:, :, :img_h, :img_w]
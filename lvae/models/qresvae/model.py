@@ -1,6 +1,5 @@
-import pickle
+import struct
 from collections import OrderedDict
-from PIL import Image
 import math
 import torch
 import torch.nn as nn
@@ -10,6 +9,7 @@ import torchvision.transforms.functional as tvf
 from compressai.entropy_models import GaussianConditional
 
 import lvae.models.common as common
+import lvae.utils.coding as coding
 from lvae.models.entropy_coding import gaussian_log_prob_mass
 
 
@@ -686,27 +686,146 @@ class HierarchicalVAE(nn.Module):
         im_hat = self.process_output(x_hat)
         return im_hat
 
+    # bitstream header: image height and width, and the (C, H, W) shape of the top feature map.
+    # See `coding.pack_container()`
+    _bitstream_header = '<2H3H'
+    # if True, store a CRC32 checksum for each sub-stream
+    bitstream_crc = False
+
+    def _pack_bitstream(self, compressed_obj, img_hw):
+        """ Pack the output of `compress()`, for a single image, into a container.
+
+        Args:
+            compressed_obj (list): output of `compress()`
+            img_hw (tuple): original (unpadded) image height and width
+        """
+        lossless = hasattr(self.out_net, 'compress')
+        strings = compressed_obj[:-2] if lossless else compressed_obj[:-1]
+        feature_shape = compressed_obj[-2] if lossless else compressed_obj[-1]
+        assert feature_shape[0] == 1, f'Only support a single image, got {feature_shape=}'
+        header = struct.pack(self._bitstream_header, *img_hw, *feature_shape[1:])
+        substreams = [strs_batch[0] for strs_batch in strings]
+        kinds = [coding.StreamKind.LATENT] * len(substreams)
+        if lossless:
+            substreams.append(compressed_obj[-1][0])
+            kinds.append(coding.StreamKind.PIXELS)
+        model_id = getattr(self, 'model_id', None) or type(self).__name__
+        return coding.pack_container(model_id, header, substreams, kinds=kinds, crc=self.bitstream_crc)
+
+    def _unpack_bitstream(self, string):
+        """ Parse a container produced by `_pack_bitstream()`.
+
+        Returns:
+            tuple: (compressed_obj, (img_h, img_w)), where compressed_obj is the input of `decompress()`
+        """
+        container = coding.unpack_container(string, model_id=getattr(self, 'model_id', None))
+        img_h, img_w, fc, fh, fw = struct.unpack(self._bitstream_header, container.header)
+        # the compressai entropy coder requires `bytes` rather than `memoryview`
+        compressed_obj = [[bytes(s)] for s in container.substreams(kind=coding.StreamKind.LATENT)]
+        compressed_obj.append((1, fc, fh, fw))
+        if hasattr(self.out_net, 'compress'): # lossless compression
+            compressed_obj.append([bytes(s) for s in container.substreams(kind=coding.StreamKind.PIXELS)])
+        return compressed_obj, (img_h, img_w)
+
     @torch.no_grad()
-    def compress_file(self, img_path, output_path):
-        """ Compress an image file specified by `img_path` and save to `output_path`
+    def compress_tiled(self, img, tile_size=512, overlap=0, workers=0):
+        """ Compress a (very large) image tile by tile. The peak memory is bounded by the tile size.
 
         Args:
-            img_path    (str): input image path
-            output_path (str): output bits path
+            img (PIL.Image or torch.Tensor): image. If a tensor, (1, 3, H, W), values between (0, 1).
+            tile_size (int, optional): tile size, should be divisible by 64. Defaults to 512.
+            overlap (int, optional): overlap between neighboring tiles. Defaults to 0.
+            workers (int, optional): number of threads to encode tiles in parallel. Defaults to 0.
+
+        Returns:
+            bytes: bitstream, see `coding.tiled_compress()`
+        """
+        device = next(self.parameters()).device
+        def _encode_tile(tile):
+            im = coding.pad_tensor_divisible_by(tile, div=self.max_stride).to(device=device)
+            compressed_obj = self.compress(im)
+            return self._pack_bitstream(compressed_obj, img_hw=(tile.shape[2], tile.shape[3]))
+        model_id = getattr(self, 'model_id', None) or type(self).__name__
+        return coding.tiled_compress(img, _encode_tile, tile_size=tile_size, overlap=overlap,
+                                     workers=workers, model_id=model_id, crc=self.bitstream_crc)
+
+    @torch.no_grad()
+    def decompress_tiled(self, string, workers=0):
+        """ Decompress a bitstream produced by `compress_tiled()`, tile by tile.
+
+        Args:
+            string (bytes): bitstream
+            workers (int, optional): number of threads to decode tiles in parallel. Defaults to 0.
+
+        Returns:
+            torch.Tensor: reconstructed image, (1, 3, H, W), on CPU
+        """
+        def _decode_tile(tile_string):
+            compressed_obj, (tile_h, tile_w) = self._unpack_bitstream(tile_string)
+            return self.decompress(compressed_obj)[:, :, :tile_h, :tile_w]
+        return coding.tiled_decompress(string, _decode_tile, workers=workers,
+                                       model_id=getattr(self, 'model_id', None))
+
+    @torch.no_grad()
+    def compress_bytes(self, image):
+        """ Compress an image in memory.
+
+        Args:
+            image: encoded image file (bytes), PIL.Image, or uint8 np.ndarray. See `coding.read_image()`.
+
+        Returns:
+            bytes: bitstream
         """
-        # read image
-        img = Image.open(img_path)
-        if img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
+        img = coding.read_image(image)
         img_padded = pad_divisible_by(img, div=self.max_stride)
         device = next(self.parameters()).device
         im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
         # compress by model
         compressed_obj = self.compress(im)
-        compressed_obj.append((img.height, img.width))
-        # save bits to file
-        with open(output_path, 'wb') as f:
-            pickle.dump(compressed_obj, file=f)
+        return self._pack_bitstream(compressed_obj, img_hw=(img.height, img.width))
+
+    @torch.no_grad()
+    def decompress_bytes(self, string, output='tensor'):
+        """ Decompress a bitstream in memory.
+
+        Args:
+            string (bytes, bytearray, or memoryview): bitstream
+            output (str, optional): 'tensor', 'numpy', or 'pil'. See `coding.format_image_output()`.
+        """
+        compressed_obj, (img_h, img_w) = self._unpack_bitstream(string)
+        # decompress by model
+        im_hat = self.decompress(compressed_obj)
+        return coding.format_image_output(im_hat[:, :, :img_h, :img_w], output)
+
+    @torch.no_grad()
+    def compress_fileobj(self, image_file, bits_file):
+        """ Compress an image read from a binary file object, and write bits to another one.
+
+        Args:
+            image_file (BinaryIO): encoded image file
+            bits_file  (BinaryIO): output bitstream
+
+        Returns:
+            int: number of bytes written
+        """
+        return bits_file.write(self.compress_bytes(image_file))
+
+    @torch.no_grad()
+    def decompress_fileobj(self, bits_file, output='tensor'):
+        """ Decompress a bitstream read from a binary file object. See `decompress_bytes()`.
+        """
+        return self.decompress_bytes(bits_file.read(), output=output)
+
+    @torch.no_grad()
+    def compress_file(self, img_path, output_path):
+        """ Compress an image file specified by `img_path` and save to `output_path`
+
+        Args:
+            img_path    (str): input image path
+            output_path (str): output bits path
+        """
+        with open(img_path, 'rb') as fin, open(output_path, 'wb') as fout:
+            self.compress_fileobj(fin, fout)
 
     @torch.no_grad()
     def decompress_file(self, bits_path):
@@ -718,13 +837,8 @@ class HierarchicalVAE(nn.Module):
         Returns:
             torch.Tensor: reconstructed image
         """
-        # read from file
         with open(bits_path, 'rb') as f:
-            compressed_obj = pickle.load(file=f)
-        img_h, img_w = compressed_obj.pop()
-        # decompress by model
-        im_hat = self.decompress(compressed_obj)
-        return im_hat[:, :, :img_h, :img_w]
+            return self.decompress_fileobj(f)
 
 
 def pad_divisible_by(img, div=64):
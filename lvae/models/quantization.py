@@ -0,0 +1,204 @@
+""" INT8 quantization for CPU inference. The MLP `Linear` layers of the ConvNeXt blocks and the \
+1x1 convolutions get INT8 weights, with dynamically quantized activations. The heads that \
+produce the entropy model parameters (`prior`) and the latents (`posterior`), and the output \
+network, stay in FP32.
+
+Quantized models write bitstreams with their own model id (eg, `qarv_base-int8-fbgemm`), because \
+the entropy decoder must compute exactly the same priors as the encoder. A bitstream produced by \
+a quantized model can only be decoded by the same quantized model, and vice versa.
+
+### Code examples:
+    >>> errors = calibrate(model, 'images/calibration') # per-layer relative error
+    >>> layers = [name for name, err in errors.items() if err <= 0.02]
+    >>> qmodel = quantize_model(model, layers=layers)
+    >>> qmodel.compress_mode(True)
+    >>> string = qmodel.compress_bytes('image.png')
+"""
+from pathlib import Path
+from collections import OrderedDict
+import copy
+import torch
+import torch.nn as nn
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import default_dynamic_qconfig
+
+import lvae.models.common as common
+
+# sub-modules with these names are kept in FP32, see the module docstring
+fp32_module_names = ('prior', 'posterior', 'out_net', 'lmb_embedding', 'embedding_layer')
+
+
+class Int8Linear(nn.Module):
+    """ Linear layer with INT8 weights and dynamically quantized activations. The activation \
+    scale is computed per sample rather than per batch, so the output of an image does not depend \
+    on the other images in the batch, and batched coding stays in sync with single-image coding.
+    """
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        linear = copy.copy(linear)
+        linear.qconfig = default_dynamic_qconfig
+        self.qlinear = nnqd.Linear.from_float(linear)
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+
+    def forward(self, x):
+        if x.shape[0] == 1:
+            return self.qlinear(x)
+        return torch.cat([self.qlinear(xi) for xi in x.split(1, dim=0)], dim=0)
+
+
+class Int8Conv1x1(nn.Module):
+    """ 1x1 convolution as an `Int8Linear` over the channel dimension """
+    def __init__(self, conv: nn.Conv2d):
+        super().__init__()
+        linear = nn.Linear(conv.in_channels, conv.out_channels, bias=(conv.bias is not None))
+        linear.weight.data.copy_(conv.weight.data.flatten(1))
+        if conv.bias is not None:
+            linear.bias.data.copy_(conv.bias.data)
+        self.linear = Int8Linear(linear)
+
+    def forward(self, x):
+        x = self.linear(x.permute(0, 2, 3, 1))
+        return x.permute(0, 3, 1, 2)
+
+
+def _is_conv1x1(module: nn.Module):
+    return isinstance(module, nn.Conv2d) and (module.kernel_size == (1, 1)) and \
+        (module.stride == (1, 1)) and (module.groups == 1) and (module.padding in ((0, 0), 'valid'))
+
+
+def quantizable_layers(model: nn.Module):
+    """ Names of the layers that can be quantized: the MLP `Linear` layers of ConvNeXt blocks, \
+    and the 1x1 convolutions, except in the FP32 modules (see `fp32_module_names`).
+
+    Returns:
+        list[str]: layer names, as in `model.named_modules()`
+    """
+    names = []
+    for name, module in model.named_modules():
+        if any([part in fp32_module_names for part in name.split('.')]):
+            continue
+        is_mlp_linear = isinstance(module, nn.Linear) and (name.split('.')[-2:-1] == ['mlp'])
+        if is_mlp_linear or _is_conv1x1(module):
+            names.append(name)
+    return names
+
+
+def _fold_layer_scale(model: nn.Module, layers):
+    """ Fold the layer scaling (gamma) of ConvNeXt blocks into their quantized second MLP layer, \
+    such that gamma is applied before rounding the weights. The fused AdaLN path is disabled.
+    """
+    layers = set(layers)
+    for name, module in model.named_modules():
+        gamma = getattr(module, 'gamma', None)
+        if (f'{name}.mlp.fc2' not in layers) or not isinstance(gamma, torch.Tensor):
+            continue
+        if isinstance(module, common.ConvNeXtBlockAdaLN):
+            module.fuse_for_inference(False)
+        fc2 = module.mlp.fc2
+        gamma = gamma.detach().reshape(-1)
+        fc2.weight.data.mul_(gamma.view(-1, 1))
+        fc2.bias.data.mul_(gamma)
+        module.gamma = None
+
+
+@torch.no_grad()
+def quantize_model(model: nn.Module, layers=None):
+    """ Get an INT8-quantized copy of a model, for CPU inference.
+
+    Args:
+        model (nn.Module): QARV or QRes-VAE model
+        layers (list[str], optional): layers to quantize, eg, selected by `calibrate()`. \
+            Defaults to all of `quantizable_layers(model)`.
+
+    Returns:
+        nn.Module: quantized model on CPU, in eval mode. Call `compress_mode(True)` before coding.
+    """
+    candidates = quantizable_layers(model)
+    layers = candidates if (layers is None) else list(layers)
+    unknown = set(layers) - set(candidates)
+    assert not unknown, f'Layers cannot be quantized: {sorted(unknown)[:8]}'
+    qmodel = copy.deepcopy(model).cpu().eval()
+    if hasattr(qmodel, '_inference_graphs'): # graphs captured from the FP32 layers are invalid
+        qmodel._inference_graphs.clear()
+    _fold_layer_scale(qmodel, layers)
+    for name in layers:
+        parent_name, _, attr = name.rpartition('.')
+        parent = qmodel.get_submodule(parent_name)
+        layer = getattr(parent, attr)
+        setattr(parent, attr, Int8Linear(layer) if isinstance(layer, nn.Linear) else Int8Conv1x1(layer))
+    # the quantized model computes different priors, so its bitstreams are not compatible
+    model_id = getattr(model, 'model_id', None) or type(model).__name__
+    qmodel.model_id = f'{model_id}-int8-{torch.backends.quantized.engine}'
+    qmodel.quantized_layers = layers
+    return qmodel
+
+
+@torch.no_grad()
+def calibrate(model: nn.Module, img_dir, max_images=8, lambdas=None):
+    """ Measure the error of quantizing each layer on a set of calibration images. Each layer \
+    is quantized alone, with the same input as in the FP32 model, during compression and \
+    decompression of the images.
+
+    Args:
+        model (nn.Module): QARV or QRes-VAE model, in `compress_mode(True)`
+        img_dir (str): directory of calibration images
+        max_images (int, optional): maximum number of images. Defaults to 8.
+        lambdas (list[float], optional): lambdas of variable-rate models. Defaults to the \
+            model's default lambda.
+
+    Returns:
+        OrderedDict: layer name -> relative error, ||y_int8 - y|| / ||y||
+    """
+    img_paths = sorted([p for p in Path(img_dir).rglob('*.*') if p.suffix.lower() in ('.png', '.jpg', '.jpeg')])
+    img_paths = img_paths[:max_images]
+    assert len(img_paths) > 0, f'No image found in {img_dir}'
+    device = next(model.parameters()).device
+    layers = quantizable_layers(model)
+    errors = {name: [0.0, 0.0] for name in layers} # name -> [squared error, squared norm]
+
+    def _make_hook(name, qlayer):
+        def _hook(module, inputs, output):
+            x = inputs[0].detach().float().cpu()
+            y_q = qlayer(x)
+            errors[name][0] += (y_q - output.float().cpu()).square().sum().item()
+            errors[name][1] += output.float().square().sum().item()
+        return _hook
+
+    handles = []
+    for name in layers:
+        layer = model.get_submodule(name)
+        qlayer = Int8Linear(layer.cpu()) if isinstance(layer, nn.Linear) else Int8Conv1x1(layer.cpu())
+        layer.to(device=device)
+        handles.append(layer.register_forward_hook(_make_hook(name, qlayer)))
+    try:
+        for impath in img_paths:
+            for lmb in (lambdas or [None]):
+                kwargs = dict() if (lmb is None) else dict(lmb=lmb)
+                model.decompress_bytes(model.compress_bytes(impath, **kwargs))
+    finally:
+        for h in handles:
+            h.remove()
+    return OrderedDict([(name, (se / max(norm, 1e-12)) ** 0.5) for name, (se, norm) in errors.items()])
+
+
+def save_quantized(qmodel: nn.Module, path):
+    """ Save a model produced by `quantize_model()` """
+    checkpoint = {'layers': qmodel.quantized_layers, 'model_id': qmodel.model_id,
+                  'state_dict': qmodel.state_dict()}
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    torch.save(checkpoint, path)
+
+
+def load_quantized(model: nn.Module, path):
+    """ Load a model saved by `save_quantized()`.
+
+    Args:
+        model (nn.Module): the FP32 model with the same architecture
+        path (str): checkpoint path
+    """
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    qmodel = quantize_model(model, layers=checkpoint['layers'])
+    qmodel.load_state_dict(checkpoint['state_dict'])
+    qmodel.model_id = checkpoint['model_id']
+    return qmodel
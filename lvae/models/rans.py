@@ -0,0 +1,154 @@
+""" Interleaved multi-lane rANS coder, vectorized with NumPy.
+
+It works directly on int32 NumPy buffers (symbols, CDF indexes, and a flattened CDF table),
+and uses the same quantized CDF tables as the compressai rANS coder (16-bit precision).
+Symbols are assigned to lanes in a round-robin manner, ie, symbol `i` belongs to lane `i % lanes`,
+and all lanes are updated together in each step.
+
+Bitstream format, version 1 (all values are little-endian):
+    - header, `<BHII`: version (=1), number of lanes, number of symbols, number of escapes
+    - int32 x number of escapes: raw values of the symbols that are outside of the CDF table
+    - uint32 x number of lanes: final rANS states of the lanes
+    - uint16 x ...: renormalization words, in the order they are read by the decoder
+"""
+import struct
+import numpy as np
+
+VERSION = 1
+PRECISION = 16 # CDF precision, in bits
+_HEADER = '<BHII'
+_RANS_L = 1 << 16 # lower bound of the rANS state
+_WORD_BITS = 16
+
+
+class RansTables():
+    """ Flattened CDF tables, precomputed from the compressai quantized CDF tables.
+    """
+    def __init__(self, quantized_cdf, cdf_lengths, offsets):
+        """
+        Args:
+            quantized_cdf (array-like): (num_rows, max_length), CDF tables
+            cdf_lengths   (array-like): (num_rows,), number of valid entries in each row
+            offsets       (array-like): (num_rows,), symbol offsets
+        """
+        quantized_cdf = np.asarray(quantized_cdf, dtype=np.int64)
+        self.cdf_lengths = np.asarray(cdf_lengths, dtype=np.int64).reshape(-1)
+        self.offsets = np.asarray(offsets, dtype=np.int64).reshape(-1)
+        assert quantized_cdf.shape[0] == self.cdf_lengths.shape[0] == self.offsets.shape[0]
+        # the last valid symbol of each row is the escape symbol
+        self.max_values = self.cdf_lengths - 2
+        rows = [quantized_cdf[r, :self.cdf_lengths[r]] for r in range(quantized_cdf.shape[0])]
+        assert all([(row[0] == 0) and (row[-1] == (1 << PRECISION)) for row in rows])
+        # flattened CDF table, and the start position of each row
+        self.flat_cdf = np.concatenate(rows)
+        self.row_starts = np.cumsum([0] + [len(row) for row in rows[:-1]])
+        # strictly increasing keys for looking up symbols with a single `np.searchsorted`
+        self._row_key = np.int64(1 << (PRECISION + 1))
+        row_ids = np.repeat(np.arange(len(rows)), [len(row) for row in rows])
+        self.flat_keys = row_ids * self._row_key + self.flat_cdf
+
+
+def encode(symbols, indexes, tables: RansTables, max_lanes=128, min_symbols_per_lane=1024):
+    """ Encode symbols into a byte string
+
+    Args:
+        symbols (np.ndarray): int32, 1-D, symbols
+        indexes (np.ndarray): int32, 1-D, CDF indexes (rows of the CDF table)
+        tables  (RansTables): CDF tables
+        max_lanes (int, optional): maximum number of interleaved lanes.
+        min_symbols_per_lane (int, optional): each lane costs 4 bytes to flush its state, \\
+            so short inputs use fewer lanes.
+
+    Returns:
+        bytes: bitstream
+    """
+    symbols = np.asarray(symbols, dtype=np.int64).reshape(-1)
+    indexes = np.asarray(indexes, dtype=np.int64).reshape(-1)
+    assert symbols.shape == indexes.shape, f'{symbols.shape=}, {indexes.shape=}'
+    num = symbols.shape[0]
+    lanes = int(min(max_lanes, max(1, num // min_symbols_per_lane)))
+    # map symbols to table entries. Out-of-range symbols are coded as escapes
+    values = symbols - tables.offsets[indexes]
+    max_values = tables.max_values[indexes]
+    escape = (values < 0) | (values >= max_values)
+    values = np.where(escape, max_values, values)
+    flat_pos = tables.row_starts[indexes] + values
+    starts = tables.flat_cdf[flat_pos].astype(np.uint64)
+    freqs = tables.flat_cdf[flat_pos + 1].astype(np.uint64) - starts
+
+    # rANS encoding, in the reverse order of decoding
+    steps = (num + lanes - 1) // lanes
+    states = np.full(lanes, _RANS_L, dtype=np.uint64)
+    words = []
+    for t in reversed(range(steps)):
+        a, b = t * lanes, min((t + 1) * lanes, num)
+        x, freq, start = states[:b-a], freqs[a:b], starts[a:b]
+        renorm = x >= (freq << np.uint64(PRECISION))
+        if renorm.any():
+            words.append((x[renorm] & np.uint64(0xffff)).astype(np.uint16))
+            x[renorm] >>= np.uint64(_WORD_BITS)
+        states[:b-a] = ((x // freq) << np.uint64(PRECISION)) + (x % freq) + start
+    # the decoder reads the words in the reverse order of emission
+    words = np.concatenate(words + [np.zeros(0, dtype=np.uint16)])[::-1]
+    escapes = symbols[escape]
+    header = struct.pack(_HEADER, VERSION, lanes, num, escapes.shape[0])
+    return b''.join([
+        header, escapes.astype('<i4').tobytes(), states.astype('<u4').tobytes(),
+        words.astype('<u2').tobytes()
+    ])
+
+
+def decode(string, indexes, tables: RansTables):
+    """ Decode symbols from a byte string produced by `encode()`
+
+    Args:
+        string  (bytes): bitstream
+        indexes (np.ndarray): int32, 1-D, CDF indexes (rows of the CDF table)
+        tables  (RansTables): CDF tables
+
+    Returns:
+        np.ndarray: int32, 1-D, decoded symbols
+    """
+    buffer = memoryview(string)
+    _len = struct.calcsize(_HEADER)
+    version, lanes, num, num_escapes = struct.unpack(_HEADER, buffer[:_len])
+    assert version == VERSION, f'Unsupported rANS bitstream version {version}'
+    indexes = np.asarray(indexes, dtype=np.int64).reshape(-1)
+    assert indexes.shape[0] == num, f'{indexes.shape=}, {num=}'
+    escapes = np.frombuffer(buffer, dtype='<i4', count=num_escapes, offset=_len)
+    _len = _len + 4 * num_escapes
+    states = np.frombuffer(buffer, dtype='<u4', count=lanes, offset=_len).astype(np.uint64)
+    _len = _len + 4 * lanes
+    words = np.frombuffer(buffer, dtype='<u2', offset=_len).astype(np.uint64)
+
+    row_keys = indexes * tables._row_key
+    values = np.empty(num, dtype=np.int64)
+    mask = np.uint64((1 << PRECISION) - 1)
+    ptr = 0
+    steps = (num + lanes - 1) // lanes
+    for t in range(steps):
+        a, b = t * lanes, min((t + 1) * lanes, num)
+        x = states[:b-a]
+        slot = x & mask
+        # find the symbol whose CDF interval contains `slot`
+        flat_pos = np.searchsorted(tables.flat_keys, row_keys[a:b] + slot.astype(np.int64), side='right') - 1
+        start = tables.flat_cdf[flat_pos].astype(np.uint64)
+        freq = tables.flat_cdf[flat_pos + 1].astype(np.uint64) - start
+        values[a:b] = flat_pos - tables.row_starts[indexes[a:b]]
+        x = freq * (x >> np.uint64(PRECISION)) + slot - start
+        renorm = x < _RANS_L
+        k = int(renorm.sum())
+        if k > 0:
+            # words of the same step are stored in descending lane order
+            x[renorm] = (x[renorm] << np.uint64(_WORD_BITS)) | words[ptr:ptr+k][::-1]
+            ptr += k
+        states[:b-a] = x
+    assert ptr == words.shape[0], f'{ptr=}, {words.shape[0]=}'
+
+    # escapes
+    max_values = tables.max_values[indexes]
+    symbols = values + tables.offsets[indexes]
+    escape = (values == max_values)
+    assert int(escape.sum()) == num_escapes, f'{escape.sum()=}, {num_escapes=}'
+    symbols[escape] = escapes
+    return symbols.astype(np.int32)
@@ -1,55 +1,63 @@
-from PIL import Image
-from tqdm import tqdm
 from pathlib import Path
-from collections import defaultdict, OrderedDict
+from collections import OrderedDict
 import json
 import argparse
 import math
 import torch
 import torch.nn.functional as tnf
 import torchvision.transforms.functional as tvf
-from timm.utils import AverageMeter
 
-from lvae.paths import known_datasets
 from lvae.models.registry import get_model
-from lvae.utils.coding import pad_divisible_by
+from lvae.utils.coding import pad_divisible_by, read_image
+from lvae.evaluation import imcoding_evaluate_parallel
 
 
-def evaluate_model(model, lmb, dataset_name):
+@torch.no_grad()
+def evaluate_image(model, image, lmb):
+    """ Estimate the rate (from the KL terms, without entropy coding) and the distortion of one image.
+
+    Args:
+        model (torch.nn.Module): pytorch model, with `forward_end2end` and `process_output` methods.
+        image: image, see `lvae.utils.coding.read_image()`
+        lmb (float): lambda
+
+    Returns:
+        dict[str -> float]: bpp, mse, psnr
+    """
     device = next(model.parameters()).device
-    # get list of image paths
-    img_dir = known_datasets[dataset_name]
-    img_paths = list(Path(img_dir).rglob('*.*'))
-    print(f'Evaluating {type(model)} on {len(img_paths)} images from {img_dir}')
-    pbar = tqdm(img_paths)
-    # evaluate model
-    all_image_stats = defaultdict(AverageMeter)
-    for impath in pbar:
-        # read image
-        img = Image.open(impath)
-        imgh, imgw = img.height, img.width
-        # pad image
-        img_padded = pad_divisible_by(img, div=model.max_stride)
-
-        # forward pass
-        im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
-        x_hat, stats_all = model.forward_end2end(im, lmb=lmb)
-
-        # compute bpp
-        _, imC, imH, imW = im.shape
-        kl = sum([stat['kl'].sum(dim=(1, 2, 3)) for stat in stats_all]).mean(0) / (imH * imW)
-        bpp_theoretical = kl.item() * math.log2(math.e)
-        # compute psnr
-        real = tvf.to_tensor(img)
-        fake = model.process_output(x_hat).cpu().squeeze(0)[:, :imgh, :imgw]
-        mse = tnf.mse_loss(real, fake, reduction='mean').item()
-        psnr = float(-10 * math.log10(mse))
-        # accumulate results
-        all_image_stats['bpp'].update(bpp_theoretical)
-        all_image_stats['psnr'].update(psnr)
-
-    results = {k: meter.avg for k,meter in all_image_stats.items()}
-    return results
+    img = read_image(image)
+    imgh, imgw = img.height, img.width
+    # pad image
+    img_padded = pad_divisible_by(img, div=model.max_stride)
+
+    # forward pass
+    im = tvf.to_tensor(img_padded).unsqueeze_(0).to(device=device)
+    x_hat, stats_all = model.forward_end2end(im, lmb=lmb)
+
+    # compute bpp
+    _, imC, imH, imW = im.shape
+    kl = sum([stat['kl'].sum(dim=(1, 2, 3)) for stat in stats_all]).mean(0) / (imH * imW)
+    bpp_theoretical = kl.item() * math.log2(math.e)
+    # compute psnr
+    real = tvf.to_tensor(img)
+    fake = model.process_output(x_hat).cpu().squeeze(0)[:, :imgh, :imgw]
+    mse = tnf.mse_loss(real, fake, reduction='mean').item()
+    psnr = float(-10 * math.log10(mse))
+    stats = {
+        'bpp':  float(bpp_theoretical),
+        'mse':  float(mse),
+        'psnr': psnr
+    }
+    return stats
+
+
+def evaluate_model(model, lmb, dataset_name, **kwargs):
+    """ Evaluate the model at one lambda, averaged over a dataset. Images are read and evaluated \
+    by `lvae.evaluation.imcoding_evaluate_parallel()` with `evaluate_image()`, and per-image \
+    results are cached. Keyword arguments are passed to it, eg, `workers` and `cache_dir`.
+    """
+    results = imcoding_evaluate_parallel(model, dataset_name, lambdas=[lmb], image_func=evaluate_image, **kwargs)
+    return {k: vlist[0] for k, vlist in results.items() if k != 'lambda'}
 
 
 @torch.no_grad()
@@ -61,6 +69,9 @@ def main():
     parser.add_argument('-s', '--steps',        type=int,   default=16)
     parser.add_argument('-n', '--dataset_name', type=str,   default='tecnick-rgb-1200')
     parser.add_argument('-d', '--device',       type=str,   default='cuda:0')
+    parser.add_argument('-w', '--workers',      type=int,   default=0, help='CPU worker processes')
+    parser.add_argument('--loader_workers',     type=int,   default=2)
+    parser.add_argument('--cache_dir',          type=str,   default='runs/eval-cache')
     args = parser.parse_args()
 
     kwargs = eval(f'dict({args.model_args})')
@@ -79,13 +90,14 @@ def main():
         print(f'Creating {save_json_path.parent} ...')
         save_json_path.parent.mkdir(parents=True)
 
-    all_lmb_stats = defaultdict(list)
-    for lmb in lambdas:
-        results = evaluate_model(model, lmb, args.dataset_name)
-        print(results)
-
-        for k,v in results.items():
-            all_lmb_stats[k].append(v)
+    # all lambdas of each image are evaluated after it is read. Per-image results are cached in
+    # args.cache_dir, so only new lambdas or images are computed
+    all_lmb_stats = imcoding_evaluate_parallel(
+        model, args.dataset_name, lambdas=lambdas, loader_workers=args.loader_workers,
+        workers=args.workers, model_spec=(args.model, kwargs), cache_dir=args.cache_dir,
+        image_func=evaluate_image
+    )
+    all_lmb_stats.pop('lambda')
     # save to json
     json_data = OrderedDict()
     json_data['name'] = args.model
@@ -1,3 +1,5 @@
+import functools
+
 _all_models = dict()
 
 
@@ -6,10 +8,22 @@ def register_model(func):
     if name in _all_models:
         msg = f'Warning: model function *{name}* is multiply defined.'
         print(f'\u001b[93m' + msg + '\u001b[0m')
-    _all_models[name] = func
-    return func
+
+    @functools.wraps(func)
+    def model_func(*args, **kwargs):
+        model = func(*args, **kwargs)
+        # the model id is stored in bitstreams, see `lvae.utils.coding.pack_container()`
+        model.model_id = name
+        return model
+
+    _all_models[name] = model_func
+    return model_func
 
 
 def get_model(name, *args, **kwargs):
     model_func = _all_models[name]
     return model_func(*args, **kwargs)
+
+
+def list_models():
+    return sorted(_all_models.keys())
@@ -0,0 +1,216 @@
+""" Opt-in profiling of the hot paths of a model: per-module wall time and memory of the encoder \
+blocks, each phase of the latent blocks, the synthesis tail, entropy coding, and bitstream packing.
+
+Results can be exported as a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev) \
+or printed as an aggregated table. The timing wrappers are installed on the model instance only \
+inside `with Profiler(model)`, so there is no overhead when profiling is disabled.
+
+### Code examples:
+    >>> with Profiler(model) as prof:
+    ...     model.decompress(model.compress(im))
+    >>> print(prof.table())
+    >>> prof.export_chrome_trace('runs/profile/trace.json')
+"""
+from pathlib import Path
+from collections import OrderedDict
+import os
+import re
+import sys
+import json
+import time
+import resource
+import threading
+import torch
+import torch.nn as nn
+
+import lvae.models.common as common
+
+
+def current_rss():
+    """ Resident set size of this process, in bytes """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError): # not Linux. ru_maxrss is in KB on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+# (attribute, event name) of the latent block phases. Missing attributes are skipped.
+_latent_block_phases = [
+    ('transform_prior',     'transform_prior'),
+    ('transform_posterior', 'transform_posterior'),
+    ('resnet_end',          'resnet_end'),
+    ('compress',            'compress'),   # QRes-VAE: prior, indexes, and entropy coding
+    ('decompress',          'decompress'), # QRes-VAE: prior, indexes, and entropy decoding
+]
+_entropy_model_phases = [
+    ('build_indexes', 'build_indexes'),
+    ('compress',      'entropy_encode'),
+    ('decompress',    'entropy_decode'),
+]
+# model methods
+_model_phases = [
+    ('compress',           'compress'),
+    ('decompress',         'decompress'),
+    ('_entropy_encode',    'entropy_encode'),
+    ('_pack_bitstream',    'pack_bitstream'),
+    ('_unpack_bitstream',  'unpack_bitstream'),
+]
+
+
+class Profiler():
+    """ Record the wall time and memory change of the hot paths of a model. See the module docstring.
+    """
+    def __init__(self, model: nn.Module, sync=None, memory=True):
+        """
+        Args:
+            model (nn.Module): a QARV (`VariableRateLossyVAE`) or QRes-VAE (`HierarchicalVAE`) model
+            sync (bool, optional): synchronize CUDA before and after each event, such that the \
+                time is attributed to the right module. Defaults to True if the model is on GPU.
+            memory (bool, optional): record the change of allocated CUDA memory (on GPU) or \
+                RSS (on CPU) of each event.
+        """
+        self.model = model
+        device = next(model.parameters()).device
+        self.cuda = (device.type == 'cuda')
+        self.device = device
+        self.sync = self.cuda if (sync is None) else sync
+        self.memory = memory
+        self.events = []
+        self._wrapped = []
+        self._t0 = None
+
+    def _targets(self):
+        """ Yield (object, method name, event name) of all profiled methods """
+        model = self.model
+        encoder = getattr(model, 'encoder', None)
+        for i, block in enumerate(getattr(encoder, 'enc_blocks', [])):
+            yield block, 'forward', f'enc_blocks.{i}'
+        dec_blocks = getattr(model, 'dec_blocks', None)
+        if dec_blocks is None: # QRes-VAE
+            dec_blocks = model.decoder.dec_blocks
+        latent_pos = [i for i, b in enumerate(dec_blocks) if hasattr(b, 'discrete_gaussian')]
+        stop_pos = [i for i, b in enumerate(dec_blocks) if isinstance(b, common.CompresionStopFlag)]
+        # the synthesis tail: blocks after `CompresionStopFlag` (or after the last latent block)
+        tail_start = (stop_pos[0] + 1) if stop_pos else (latent_pos[-1] + 1)
+        for i, block in enumerate(dec_blocks):
+            if i in latent_pos:
+                for attr, name in _latent_block_phases:
+                    if hasattr(block, attr):
+                        yield block, attr, f'dec_blocks.{i}.{name}'
+                for attr, name in _entropy_model_phases:
+                    yield block.discrete_gaussian, attr, f'dec_blocks.{i}.{name}'
+            elif i >= tail_start:
+                yield block, 'forward', f'tail.{i}'
+            elif not isinstance(block, common.CompresionStopFlag):
+                yield block, 'forward', f'dec_blocks.{i}'
+        out_net = getattr(model, 'out_net', None)
+        for attr in ('mean', 'compress', 'decompress'):
+            if hasattr(out_net, attr):
+                yield out_net, attr, f'tail.out_net.{attr}'
+        for attr, name in _model_phases:
+            if hasattr(model, attr):
+                yield model, attr, name
+
+    def _memory(self):
+        if not self.memory:
+            return 0
+        return torch.cuda.memory_allocated(self.device) if self.cuda else current_rss()
+
+    def _wrap(self, obj, attr, name):
+        if isinstance(getattr(obj, attr), nn.Module): # a sub-module, eg, `resnet_end`
+            obj, attr = getattr(obj, attr), 'forward'
+        func = getattr(obj, attr)
+        events = self.events
+        def _profiled(*args, **kwargs):
+            if self.sync:
+                torch.cuda.synchronize(self.device)
+            mem_start = self._memory()
+            t_start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.sync:
+                    torch.cuda.synchronize(self.device)
+                t_end = time.perf_counter()
+                events.append((name, t_start, t_end - t_start, self._memory() - mem_start,
+                               threading.get_ident()))
+        setattr(obj, attr, _profiled)
+        self._wrapped.append((obj, attr))
+
+    def reset(self):
+        self.events.clear()
+
+    def __enter__(self):
+        assert not self._wrapped, 'The profiler is already active'
+        for obj, attr, name in self._targets():
+            self._wrap(obj, attr, name)
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        for obj, attr in reversed(self._wrapped):
+            delattr(obj, attr) # remove the instance attribute, ie, restore the class method
+        self._wrapped = []
+
+    def summary(self, by='phase'):
+        """ Aggregate the recorded events.
+
+        Args:
+            by (str, optional): 'phase' merges the same phase of all blocks, eg, \
+                `dec_blocks.*.transform_prior`. 'name' keeps each block separate.
+
+        Returns:
+            OrderedDict: name -> dict of calls, total time (ms), mean time (ms), and \
+                memory change (MB), in order of the first call
+        """
+        assert by in ('phase', 'name'), f'Unknown {by=}'
+        stats = OrderedDict()
+        for name, _, duration, mem, _ in sorted(self.events, key=lambda e: e[1]):
+            if by == 'phase':
+                name = re.sub(r'\.\d+', '.*', name)
+            s = stats.setdefault(name, {'calls': 0, 'total_ms': 0.0, 'mem_mb': 0.0})
+            s['calls'] += 1
+            s['total_ms'] += duration * 1000
+            s['mem_mb'] += mem / 2**20
+        for s in stats.values():
+            s['mean_ms'] = s['total_ms'] / s['calls']
+        return stats
+
+    def wall_time(self):
+        """ Time from the first event start to the last event end, in seconds """
+        if len(self.events) == 0:
+            return 0.0
+        start = min([e[1] for e in self.events])
+        end = max([e[1] + e[2] for e in self.events])
+        return end - start
+
+    def table(self, by='phase'):
+        """ Format `summary()` as a table. Events are nested (eg, `compress` includes all \
+        the others), so the percentages do not sum to 100.
+        """
+        wall_ms = max(self.wall_time() * 1000, 1e-9)
+        mem_unit = 'cuda_MB' if self.cuda else 'rss_MB'
+        lines = [f'{"name":<36s} {"calls":>6s} {"total_ms":>10s} {"mean_ms":>9s} {"%":>6s} {mem_unit:>9s}']
+        for name, s in self.summary(by=by).items():
+            lines.append(f'{name:<36s} {s["calls"]:>6d} {s["total_ms"]:>10.2f} {s["mean_ms"]:>9.3f} '
+                         f'{s["total_ms"]/wall_ms*100:>6.1f} {s["mem_mb"]:>9.2f}')
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        """ The recorded events in the Chrome trace event format (complete events, `ph='X'`) """
+        t0 = min([e[1] for e in self.events], default=self._t0 or 0.0)
+        trace_events = []
+        for name, t_start, duration, mem, tid in self.events:
+            trace_events.append({
+                'name': name, 'cat': name.split('.')[0], 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+                'ts': (t_start - t0) * 1e6, 'dur': duration * 1e6, 'args': {'mem_mb': mem / 2**20},
+            })
+        return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+    def export_chrome_trace(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), fp=f)
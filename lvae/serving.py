@@ -0,0 +1,584 @@
+""" Serving utilities: dynamic micro-batching of compression / decompression requests.
+
+Requests are put into an asyncio queue. A collector coroutine groups queued requests of the same
+kind into micro-batches, waiting at most `max_delay` seconds after the first request of a batch,
+and runs each batch on a dedicated model worker thread. See `serve.py` for the HTTP front end.
+"""
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import ast
+import time
+import queue
+import asyncio
+import itertools
+import threading
+import numpy as np
+import torch
+import torchvision.transforms.functional as tvf
+
+from lvae.models.registry import get_model
+
+
+class ServingMetrics():
+    """ Queue depth, batch size, and latency metrics of each model, exported in the Prometheus \
+        text format.
+    """
+    def __init__(self, window=1024):
+        """
+        Args:
+            window (int, optional): number of recent requests used for latency quantiles.
+        """
+        self.queue_depth = defaultdict(int) # model -> depth
+        self.requests = defaultdict(int) # (model, kind, status) -> count
+        self.batches = defaultdict(int)  # (model, kind) -> count
+        self.batched_requests = defaultdict(int) # (model, kind) -> count
+        self.latencies = defaultdict(lambda: deque(maxlen=window)) # (model, kind) -> recent latencies
+        self.latency_sum = defaultdict(float)
+        self.latency_count = defaultdict(int)
+
+    def observe_request(self, model, kind, status, latency=None):
+        self.requests[(model, kind, status)] += 1
+        if latency is not None:
+            self.latencies[(model, kind)].append(latency)
+            self.latency_sum[(model, kind)] += latency
+            self.latency_count[(model, kind)] += 1
+
+    def observe_batch(self, model, kind, size):
+        self.batches[(model, kind)] += 1
+        self.batched_requests[(model, kind)] += size
+
+    def latency_quantiles(self, model, kind, quantiles=(0.5, 0.9, 0.99)):
+        values = self.latencies[(model, kind)]
+        if len(values) == 0:
+            return {q: float('nan') for q in quantiles}
+        return dict(zip(quantiles, np.quantile(np.array(values), quantiles).tolist()))
+
+    def to_prometheus(self):
+        lines = ['# TYPE lvae_queue_depth gauge']
+        for model, depth in sorted(self.queue_depth.items()):
+            lines.append(f'lvae_queue_depth{{model="{model}"}} {depth}')
+        lines.append('# TYPE lvae_requests_total counter')
+        for (model, kind, status), count in sorted(self.requests.items()):
+            lines.append(f'lvae_requests_total{{model="{model}",kind="{kind}",status="{status}"}} {count}')
+        lines.append('# TYPE lvae_batches_total counter')
+        for (model, kind), count in sorted(self.batches.items()):
+            lines.append(f'lvae_batches_total{{model="{model}",kind="{kind}"}} {count}')
+        lines.append('# TYPE lvae_batched_requests_total counter')
+        for (model, kind), count in sorted(self.batched_requests.items()):
+            lines.append(f'lvae_batched_requests_total{{model="{model}",kind="{kind}"}} {count}')
+        lines.append('# TYPE lvae_latency_seconds summary')
+        for (model, kind) in sorted(self.latencies.keys()):
+            labels = f'model="{model}",kind="{kind}"'
+            for q, v in self.latency_quantiles(model, kind).items():
+                lines.append(f'lvae_latency_seconds{{{labels},quantile="{q}"}} {v:.6f}')
+            lines.append(f'lvae_latency_seconds_sum{{{labels}}} {self.latency_sum[(model, kind)]:.6f}')
+            lines.append(f'lvae_latency_seconds_count{{{labels}}} {self.latency_count[(model, kind)]}')
+        return '\n'.join(lines) + '\n'
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class _Request():
+    def __init__(self, kind, payload, params, future):
+        self.kind = kind
+        self.payload = payload
+        self.params = params
+        self.future = future
+        self.t_enqueue = time.perf_counter()
+
+
+def run_compress_batch(model, images, lmbs):
+    """ Compress a list of PIL images. Use the model's batched path if available.
+    """
+    if hasattr(model, 'compress_batch'):
+        ims = [tvf.to_tensor(img) for img in images]
+        lmbs = [lmb or model.default_lmb for lmb in lmbs]
+        return model.compress_batch(ims, lmbs=lmbs)
+    # fixed-rate models
+    return [model.compress_bytes(img) for img in images]
+
+
+def run_decompress_batch(model, strings):
+    """ Decompress a list of bitstreams into (1, 3, H, W) CPU tensors. Use the model's batched \
+        path if available.
+    """
+    if hasattr(model, 'decompress_batch'):
+        return [im.cpu() for im in model.decompress_batch(strings)]
+    return [model.decompress_bytes(s).cpu() for s in strings]
+
+
+def run_evaluate_batch(model, images, lmbs, image_func=None):
+    """ Compress and decompress a list of images, and measure the rate and distortion. \
+        See `lvae.evaluation.evaluate_image_coding()`, or `image_func` if provided.
+    """
+    from lvae.evaluation import evaluate_image_coding # lvae.evaluation imports this module
+    image_func = image_func or evaluate_image_coding
+    return [image_func(model, img, lmb=lmb) for img, lmb in zip(images, lmbs)]
+
+
+_run_funcs = {
+    'compress': lambda model, payloads, params: run_compress_batch(
+        model, payloads, [p.get('lmb') for p in params]),
+    'decompress': lambda model, payloads, params: run_decompress_batch(model, payloads),
+    'evaluate': lambda model, payloads, params: run_evaluate_batch(
+        model, payloads, [p.get('lmb') for p in params], params[0].get('image_func')),
+}
+
+
+def run_model_batch(model, kind, payloads, params):
+    """ Run a batch of `kind` ('compress' or 'decompress') requests with `model` """
+    with torch.no_grad():
+        return _run_funcs[kind](model, payloads, params)
+
+
+class MicroBatcher():
+    """ Collect compress / decompress requests into micro-batches under a latency budget.
+    """
+    def __init__(self, model=None, max_batch=8, max_delay=0.01, max_queue=256, metrics=None,
+                 runner=None, max_inflight=1, name='default'):
+        """
+        Args:
+            model (torch.nn.Module): model, already in compress mode. Not needed if `runner` is given.
+            max_batch (int, optional): maximum number of requests per batch. Defaults to 8.
+            max_delay (float, optional): maximum waiting time (seconds) after the first request \
+                of a batch arrives. Defaults to 0.01.
+            max_queue (int, optional): maximum number of queued requests. Further requests are \
+                rejected with `QueueFullError`. Defaults to 256.
+            metrics (ServingMetrics, optional): metrics.
+            runner (callable, optional): (kind, payloads, params) -> outputs, blocking. \
+                Defaults to running `model` in the worker thread.
+            max_inflight (int, optional): number of batches that run concurrently, eg, the number \
+                of worker processes behind `runner`. Defaults to 1.
+            name (str, optional): model name in the metrics. Defaults to 'default'.
+        """
+        assert (model is not None) or (runner is not None)
+        self.model = model
+        self.runner = runner or (lambda *args: run_model_batch(self.model, *args))
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.max_inflight = max_inflight
+        self.name = name
+        self.metrics = metrics or ServingMetrics()
+        self._queue = None
+        self._pending = deque() # dequeued requests that are not batched yet, in arrival order
+        self._collector = None
+        self._inflight = None
+        # model execution happens in these worker threads, not in the event loop
+        self._worker = ThreadPoolExecutor(max_workers=max_inflight, thread_name_prefix='lvae-model')
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._collector = asyncio.create_task(self._collect_loop())
+
+    async def stop(self):
+        if self._collector is not None:
+            self._collector.cancel()
+            try:
+                await self._collector
+            except asyncio.CancelledError:
+                pass
+        self._worker.shutdown(wait=True)
+
+    async def submit(self, kind, payload, **params):
+        """ Submit a request and wait for its result.
+
+        Args:
+            kind (str): 'compress' (payload is a PIL.Image) or 'decompress' (payload is bytes)
+            payload: request payload
+            params: request parameters, eg, `lmb` for compression
+        """
+        assert kind in _run_funcs, f'Unknown {kind=}'
+        if self.queue_depth >= self.max_queue:
+            self.metrics.observe_request(self.name, kind, 'rejected')
+            raise QueueFullError(f'Request queue is full ({self.max_queue=})')
+        request = _Request(kind, payload, params, asyncio.get_running_loop().create_future())
+        self._queue.put_nowait(request)
+        self.metrics.queue_depth[self.name] = self.queue_depth
+        try:
+            result = await request.future
+        except Exception:
+            self.metrics.observe_request(self.name, kind, 'error', time.perf_counter() - request.t_enqueue)
+            raise
+        self.metrics.observe_request(self.name, kind, 'ok', time.perf_counter() - request.t_enqueue)
+        return result
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._pending)
+
+    async def _next_batch(self):
+        """ Wait for the first request, then collect requests of the same kind until the batch \
+            is full or the latency budget is used up.
+        """
+        first = self._pending.popleft() if self._pending else (await self._queue.get())
+        batch = [first]
+        # pending requests of the same kind first
+        others = deque()
+        while self._pending and len(batch) < self.max_batch:
+            request = self._pending.popleft()
+            (batch if (request.kind == first.kind) else others).append(request)
+        others.extend(self._pending)
+        # then wait for new requests until the deadline
+        deadline = first.t_enqueue + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    request = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                else: # the latency budget is used up. Only take requests that are already queued
+                    request = self._queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                break
+            (batch if (request.kind == first.kind) else others).append(request)
+        self._pending = others
+        self.metrics.queue_depth[self.name] = self.queue_depth
+        return batch
+
+    async def _collect_loop(self):
+        while True:
+            await self._inflight.acquire()
+            batch = await self._next_batch()
+            batch = [r for r in batch if not r.future.cancelled()]
+            if len(batch) == 0:
+                self._inflight.release()
+                continue
+            self.metrics.observe_batch(self.name, batch[0].kind, len(batch))
+            asyncio.create_task(self._execute(batch))
+
+    async def _execute(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            outputs = await loop.run_in_executor(self._worker, self._run_batch, batch)
+        finally:
+            self._inflight.release()
+        for request, (output, error) in zip(batch, outputs):
+            if request.future.cancelled():
+                continue
+            if error is None:
+                request.future.set_result(output)
+            else:
+                request.future.set_exception(error)
+
+    def _run_batch(self, batch):
+        """ Run a batch in a worker thread. If the batch fails (eg, one corrupted bitstream), \
+            the requests are run one by one such that only the bad requests fail.
+
+        Returns:
+            list[tuple]: (output, exception) for each request
+        """
+        kind = batch[0].kind
+        try:
+            outputs = self.runner(kind, [r.payload for r in batch], [r.params for r in batch])
+            return [(out, None) for out in outputs]
+        except Exception as e:
+            if len(batch) == 1:
+                return [(None, e)]
+        outputs = []
+        for request in batch:
+            try:
+                outputs.append((self.runner(kind, [request.payload], [request.params])[0], None))
+            except Exception as e:
+                outputs.append((None, e))
+        return outputs
+
+
+def parse_model_spec(spec: str):
+    """ Parse a model spec, `name` or `name:key=value,key=value`, eg, `qres34m:lmb=64`.
+
+    Returns:
+        tuple: (name, kwargs)
+    """
+    name, _, kwargs_str = spec.partition(':')
+    kwargs = dict()
+    for item in filter(None, kwargs_str.split(',')):
+        k, _, v = item.partition('=')
+        try:
+            kwargs[k.strip()] = ast.literal_eval(v.strip())
+        except (ValueError, SyntaxError):
+            kwargs[k.strip()] = v.strip()
+    return name.strip(), kwargs
+
+
+def model_nbytes(model: torch.nn.Module):
+    """ Memory of parameters and buffers, in bytes """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum([t.numel() * t.element_size() for t in tensors])
+
+
+class ModelPool():
+    """ Models loaded on demand, keyed by registry name and kwargs, with LRU eviction.
+
+    On CPU, model weights are moved to shared memory (`share_memory_()`), such that worker \
+    processes (see `ModelWorkerProcesses`) can host replicas without copying the weights.
+    """
+    def __init__(self, max_bytes=None, device='cpu', model_func=None):
+        """
+        Args:
+            max_bytes (int, optional): memory cap of all loaded models. The least recently used \
+                models are evicted when exceeded. None means no cap.
+            device (str, optional): device. Defaults to 'cpu'.
+            model_func (callable, optional): (name, **kwargs) -> model. Defaults to \
+                `lvae.models.registry.get_model`.
+        """
+        self.max_bytes = max_bytes
+        self.device = torch.device(device)
+        self.model_func = model_func or get_model
+        self._models = OrderedDict() # key -> model, in LRU order
+        self._loading = dict() # key -> Future of a model being loaded
+        self._lock = threading.Lock()
+        self.eviction_callbacks = [] # called with the evicted key
+
+    @staticmethod
+    def make_key(name, kwargs):
+        return (name, tuple(sorted(kwargs.items())))
+
+    @property
+    def total_bytes(self):
+        return sum([model_nbytes(m) for m in self._models.values()])
+
+    def _load(self, name, kwargs):
+        return self._prepare(self.model_func(name, **kwargs))
+
+    def _prepare(self, model):
+        model = model.to(device=self.device)
+        model.eval()
+        if hasattr(model, 'compress_mode'):
+            model.compress_mode(True)
+        if self.device.type == 'cpu':
+            model.share_memory()
+        return model
+
+    def add(self, name, model, **kwargs):
+        """ Add a model with custom weights, eg, fine-tuned ones. The pool holds its own copy, \
+        built from `model_func(name, pretrained=False, **kwargs)` and the weights of `model`, \
+        in the same way as the replicas in worker processes. `model` itself is not changed.
+
+        Returns:
+            torch.nn.Module: the pool's copy
+        """
+        key = self.make_key(name, kwargs)
+        instance = self.model_func(name, **dict(kwargs, pretrained=False))
+        if hasattr(instance, 'compress_mode'): # entropy coding buffers must have the right shapes
+            instance.compress_mode(True)
+        instance.load_state_dict(model.state_dict())
+        with self._lock:
+            self._models[key] = self._prepare(instance)
+            self._models.move_to_end(key)
+        return self._models[key]
+
+    def get(self, name, **kwargs):
+        """ Get a model, loading it if necessary. Loading runs outside the lock, such that \
+        requests for other models are not blocked. Concurrent requests for a model being loaded \
+        wait for the same load.
+        """
+        key = self.make_key(name, kwargs)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            loading = self._loading.get(key, None)
+            is_loader = (loading is None)
+            if is_loader:
+                loading = self._loading[key] = Future()
+        if not is_loader:
+            return loading.result()
+        try:
+            model = self._load(name, kwargs)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key)
+            loading.set_exception(e)
+            raise
+        with self._lock:
+            self._loading.pop(key)
+            self._models[key] = model
+            # evict the least recently used models, but never the requested one
+            while (self.max_bytes is not None) and (len(self._models) > 1) \
+                    and (self.total_bytes > self.max_bytes):
+                evicted, _ = self._models.popitem(last=False)
+                for callback in self.eviction_callbacks:
+                    callback(evicted)
+        loading.set_result(model)
+        return model
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+
+def _worker_process_main(inbox, outbox, num_threads, model_func):
+    """ Main loop of a model worker process. Messages:
+        - ('load', key, name, kwargs, state_dict): build a replica that shares `state_dict`
+        - ('evict', key): drop a replica
+        - ('run', job_id, key, kind, payloads, params): run a batch and reply (job_id, outputs, error)
+    """
+    torch.set_num_threads(num_threads)
+    replicas = dict()
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        if message[0] == 'load':
+            _, key, name, kwargs, state_dict = message
+            try:
+                model = model_func(name, **dict(kwargs, pretrained=False))
+                model.eval()
+                # entropy coding tables are (persistent) buffers, so they must have the right shapes
+                if hasattr(model, 'compress_mode'):
+                    model.compress_mode(True)
+                # `assign=True` keeps the shared-memory tensors instead of copying into new ones
+                model.load_state_dict(state_dict, assign=True)
+                replicas[key] = model
+            except Exception as e: # reported by the following 'run' messages
+                replicas[key] = e
+        elif message[0] == 'evict':
+            replicas.pop(message[1], None)
+        elif message[0] == 'run':
+            _, job_id, key, kind, payloads, params = message
+            try:
+                model = replicas[key]
+                if isinstance(model, Exception):
+                    raise model
+                with torch.no_grad():
+                    outputs = _run_funcs[kind](model, payloads, params)
+                outbox.put((job_id, outputs, None))
+            except Exception as e:
+                outbox.put((job_id, None, e))
+        else:
+            raise ValueError(f'Unknown message {message[0]}')
+
+
+class ModelWorkerProcesses():
+    """ CPU worker processes for parallel model execution. Replicas of the models in a \
+        `ModelPool` are pinned to worker processes, and they share weights with the pool.
+    """
+    def __init__(self, pool: ModelPool, num_workers=2, threads_per_worker=1, replicas_per_model=None):
+        """
+        Args:
+            pool (ModelPool): model pool, on CPU
+            num_workers (int, optional): number of worker processes. Defaults to 2.
+            threads_per_worker (int, optional): number of torch threads per worker. Defaults to 1.
+            replicas_per_model (int, optional): number of workers hosting each model. \
+                Defaults to all workers.
+        """
+        assert pool.device.type == 'cpu', 'Worker processes only support CPU models'
+        self.pool = pool
+        self.num_workers = num_workers
+        self.replicas_per_model = min(replicas_per_model or num_workers, num_workers)
+        ctx = torch.multiprocessing.get_context('spawn')
+        self._outbox = ctx.Queue()
+        self._inboxes = [ctx.Queue() for _ in range(num_workers)]
+        self._processes = [
+            ctx.Process(target=_worker_process_main, daemon=True,
+                        args=(inbox, self._outbox, threads_per_worker, pool.model_func))
+            for inbox in self._inboxes
+        ]
+        for p in self._processes:
+            p.start()
+        self._lock = threading.Lock()
+        self._hosts = dict() # key -> list of worker indices hosting the model
+        self._inflight = [0] * num_workers
+        self._jobs = dict() # job_id -> concurrent.futures.Future
+        self._job_counter = itertools.count()
+        self._next_host = 0
+        pool.eviction_callbacks.append(self._evict)
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+
+    def _evict(self, key):
+        with self._lock:
+            for wi in self._hosts.pop(key, []):
+                self._inboxes[wi].put(('evict', key))
+
+    def _assign_hosts(self, key, name, kwargs, model):
+        """ Pin the replicas of a model to live workers, spreading models across workers """
+        alive = [wi for wi, p in enumerate(self._processes) if p.is_alive()]
+        if len(alive) == 0:
+            raise RuntimeError('All model worker processes died')
+        num = len(alive)
+        hosts = [alive[(self._next_host + i) % num] for i in range(min(self.replicas_per_model, num))]
+        self._next_host = (self._next_host + self.replicas_per_model) % num
+        state_dict = model.state_dict() # shared-memory tensors, sent as handles without copying
+        for wi in hosts:
+            self._inboxes[wi].put(('load', key, name, kwargs, state_dict))
+        self._hosts[key] = hosts
+        return hosts
+
+    def submit(self, name, kwargs, kind, payloads, params):
+        """ Run a batch in a worker process hosting the model.
+
+        Returns:
+            concurrent.futures.Future: list of outputs
+        """
+        model = self.pool.get(name, **kwargs)
+        key = self.pool.make_key(name, kwargs)
+        future = Future()
+        with self._lock:
+            # workers that died are left out, and the model moves to live workers if none is left
+            hosts = [wi for wi in self._hosts.get(key, []) if self._processes[wi].is_alive()]
+            if len(hosts) == 0:
+                try:
+                    hosts = self._assign_hosts(key, name, kwargs, model)
+                except RuntimeError as e:
+                    future.set_exception(e)
+                    return future
+            wi = min(hosts, key=lambda i: self._inflight[i]) # least busy replica
+            self._inflight[wi] += 1
+            job_id = next(self._job_counter)
+            self._jobs[job_id] = (future, wi)
+            self._inboxes[wi].put(('run', job_id, key, kind, payloads, params))
+        return future
+
+    def _fail_dead_workers(self):
+        """ Fail the jobs of worker processes that died, such that no request waits forever, \
+        and remove the dead workers from the hosts of all models.
+        """
+        with self._lock:
+            dead = [wi for wi, p in enumerate(self._processes) if not p.is_alive()]
+            if len(dead) == 0:
+                return
+            for key, hosts in list(self._hosts.items()):
+                hosts = [wi for wi in hosts if wi not in dead]
+                if len(hosts) > 0:
+                    self._hosts[key] = hosts
+                else:
+                    self._hosts.pop(key)
+            for job_id, (future, wi) in list(self._jobs.items()):
+                if wi in dead:
+                    self._jobs.pop(job_id)
+                    self._inflight[wi] -= 1
+                    future.set_exception(RuntimeError(f'Model worker process {wi} died'))
+
+    def _read_results(self):
+        while True:
+            # check for dead workers on every iteration, as the outbox may never be quiet
+            self._fail_dead_workers()
+            try:
+                message = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if message is None:
+                break
+            job_id, outputs, error = message
+            with self._lock:
+                if job_id not in self._jobs: # already failed, as its worker died
+                    continue
+                future, wi = self._jobs.pop(job_id)
+                self._inflight[wi] -= 1
+            if error is None:
+                future.set_result(outputs)
+            else:
+                future.set_exception(error)
+
+    def shutdown(self):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for p in self._processes:
+            p.join(timeout=10)
+        self._outbox.put(None)
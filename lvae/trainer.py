@@ -2,6 +2,7 @@ from tqdm import tqdm
 from pathlib import Path
 from collections import defaultdict
 import os
+import contextlib
 import time
 import logging
 import math
@@ -16,6 +17,7 @@ from timm.utils import ModelEmaV2, unwrap_model, random_seed
 import lvae.utils as utils
 from lvae.datasets.loader import make_trainloader
 from lvae.models.registry import get_model
+from lvae.profiling import Profiler
 
 
 class BaseTrainingWrapper():
@@ -358,9 +360,13 @@ class BaseTrainingWrapper():
             # training step
             assert model.training
             batch = next(self.trainloader)
-            with amp.autocast(enabled=cfg.amp):
+            profiling = self.is_main and (cfg.profile_interval > 0) and (step % cfg.profile_interval == 0)
+            profiler = Profiler(unwrap_model(model)) if profiling else contextlib.nullcontext()
+            with amp.autocast(enabled=cfg.amp), profiler:
                 stats = model(batch)
                 loss = stats['loss'] / float(cfg.accum_num)
+            if profiling:
+                stats.update(self.profile_stats(profiler))
             self.scaler.scale(loss).backward() # gradients are averaged over devices in DDP mode
             # parameter update (with Gradient Accumulation when cfg.accum_num > 1)
             if step % cfg.accum_num == 0:
@@ -405,6 +411,26 @@ class BaseTrainingWrapper():
             good = True
         return grad_norm, good
 
+    # progress table key -> profiler phase, see `lvae.profiling.Profiler.summary()`
+    profile_keys = {
+        't_enc':   'enc_blocks.*',
+        't_prior': 'dec_blocks.*.transform_prior',
+        't_post':  'dec_blocks.*.transform_posterior',
+        't_tail':  'tail.*',
+    }
+
+    def profile_stats(self, profiler: Profiler):
+        """ Forward time (ms) of the main model parts, for the progress table. \
+        The Chrome trace of the profiled iteration is saved to the log directory.
+        """
+        summary = profiler.summary(by='phase')
+        stats = {'t_fwd': profiler.wall_time() * 1000}
+        for key, phase in self.profile_keys.items():
+            if phase in summary:
+                stats[key] = summary[phase]['total_ms']
+        profiler.export_chrome_trace(self._log_dir / 'profile-trace.json')
+        return stats
+
     def init_progress_table(self):
         assert self.is_main
         print()
@@ -1,9 +1,16 @@
+import io
 import sys
 import json
 import math
 import pickle
+import zlib
 import struct
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import torch
+import torch.nn.functional as tnf
 import torchvision.transforms.functional as tvf
 
 
@@ -70,6 +77,248 @@ def unpack_byte_string(string):
     return strings_all
 
 
+def encode_varint(value: int):
+    """ Encode a non-negative integer as a LEB128 varint (7 bits per byte, little-endian)
+
+    Args:
+        value (int): a non-negative integer
+
+    Returns:
+        bytes: 1 byte for values < 128, 2 bytes for values < 16384, etc.
+    """
+    assert value >= 0, f'{value=} should be non-negative'
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+class TruncatedError(ValueError):
+    """ The buffer ends before a complete value (or container index) is read """
+    pass
+
+
+def decode_varint(buffer, pos=0):
+    """ Decode a LEB128 varint from `buffer` starting at `pos`
+
+    Args:
+        buffer (bytes or memoryview): buffer
+        pos (int, optional): start position. Defaults to 0.
+
+    Returns:
+        tuple: (value, position after the varint)
+    """
+    value, shift = 0, 0
+    while True:
+        if pos >= len(buffer):
+            raise TruncatedError('Truncated varint')
+        byte = buffer[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not (byte & 0x80):
+            return value, pos
+        shift += 7
+
+
+class StreamKind():
+    """ Kinds of sub-streams in a container """
+    LATENT = 0 # entropy-coded latent variable (or a channel group of it)
+    TILE   = 1 # a complete container of an image tile
+    FRAME  = 2 # a complete container of a video frame
+    PIXELS = 3 # entropy-coded pixels (lossless coding)
+
+
+CONTAINER_MAGIC = b'LVAE'
+CONTAINER_VERSION = 1
+_FLAG_CRC = 0x01
+
+
+def pack_container(model_id: str, header: bytes, substreams, kinds=None, crc=False):
+    """ Pack sub-streams into a container. The layout is (varint = LEB128):
+
+    - magic `LVAE` (4 bytes), version (uint8), flags (uint8; bit 0: sub-streams have CRC32)
+    - model id: varint length + utf-8 string
+    - header: varint length + model-specific header bytes
+    - index: varint number of sub-streams, then for each: varint kind, varint length, \
+        [uint32 CRC32, if enabled]
+    - payload: all sub-streams concatenated
+
+    Args:
+        model_id (str): model identifier, eg, the registered model name
+        header (bytes): model-specific header, eg, image size and lambda
+        substreams (list[bytes]): sub-streams (latent blocks, tiles, frames, ...)
+        kinds (list[int], optional): `StreamKind` of each sub-stream. Defaults to LATENT.
+        crc (bool, optional): store a CRC32 checksum for each sub-stream. Defaults to False.
+
+    Returns:
+        bytes: the container
+    """
+    kinds = [StreamKind.LATENT] * len(substreams) if (kinds is None) else kinds
+    assert len(kinds) == len(substreams), f'{len(kinds)=}, {len(substreams)=}'
+    model_id = model_id.encode('utf-8')
+    parts = [
+        CONTAINER_MAGIC, struct.pack('2B', CONTAINER_VERSION, _FLAG_CRC if crc else 0),
+        encode_varint(len(model_id)), model_id,
+        encode_varint(len(header)), header,
+        encode_varint(len(substreams)),
+    ]
+    for kind, sub in zip(kinds, substreams):
+        parts.append(encode_varint(kind) + encode_varint(len(sub)))
+        if crc:
+            parts.append(struct.pack('<I', zlib.crc32(sub)))
+    parts.extend(substreams)
+    return b''.join(parts)
+
+
+class Container():
+    """ A parsed container, see `pack_container()`. Parsing only reads the index, \
+        and sub-streams are zero-copy `memoryview` slices of the input buffer.
+    """
+    def __init__(self, buffer, partial=False):
+        """
+        Args:
+            buffer (bytes, bytearray, or memoryview): the container
+            partial (bool, optional): allow a truncated payload, ie, a byte prefix of the \
+                container. Only the first `num_complete` sub-streams can be accessed. \
+                The index must be complete, otherwise a `TruncatedError` is raised.
+        """
+        buffer = memoryview(buffer)
+        if len(buffer) < 6:
+            raise TruncatedError('Truncated container header')
+        if bytes(buffer[:4]) != CONTAINER_MAGIC:
+            raise ValueError('Not an lvae container (bad magic number)')
+        self.version, self.flags = buffer[4], buffer[5]
+        if self.version != CONTAINER_VERSION:
+            raise ValueError(f'Unsupported container version {self.version}')
+        pos = 6
+        _len, pos = decode_varint(buffer, pos)
+        if pos + _len > len(buffer):
+            raise TruncatedError('Truncated container header')
+        self.model_id = bytes(buffer[pos:pos+_len]).decode('utf-8')
+        pos += _len
+        _len, pos = decode_varint(buffer, pos)
+        self.header = buffer[pos:pos+_len]
+        pos += _len
+        if pos > len(buffer):
+            raise TruncatedError('Truncated container header')
+        num, pos = decode_varint(buffer, pos)
+        self.kinds, lengths, self.crcs = [], [], []
+        for _ in range(num):
+            kind, pos = decode_varint(buffer, pos)
+            length, pos = decode_varint(buffer, pos)
+            self.kinds.append(kind)
+            lengths.append(length)
+            if self.flags & _FLAG_CRC:
+                if pos + 4 > len(buffer):
+                    raise TruncatedError('Truncated container index')
+                self.crcs.append(struct.unpack('<I', buffer[pos:pos+4])[0])
+                pos += 4
+        # offsets of each sub-stream
+        self.offsets = np.cumsum([pos] + lengths).tolist()
+        if partial and (self.offsets[-1] > len(buffer)):
+            # number of leading sub-streams that are completely available
+            self.num_complete = int(np.searchsorted(self.offsets[1:], len(buffer), side='right'))
+        elif self.offsets[-1] != len(buffer):
+            raise ValueError(f'Container size mismatch: {self.offsets[-1]=}, {len(buffer)=}')
+        else:
+            self.num_complete = len(lengths)
+        self._buffer = buffer
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, i):
+        """ Get the i-th sub-stream (zero-copy) """
+        if i >= self.num_complete:
+            raise IndexError(f'Sub-stream {i} is truncated, only {self.num_complete} are complete')
+        return self._buffer[self.offsets[i]:self.offsets[i+1]]
+
+    def substreams(self, kind=None):
+        """ Get all (complete) sub-streams, optionally filtered by `kind` """
+        return [self[i] for i in range(self.num_complete) if (kind is None) or (self.kinds[i] == kind)]
+
+    def validate(self):
+        """ Check the CRC32 of all complete sub-streams, if present. Raise ValueError if corrupted. """
+        for i in range(min(len(self.crcs), self.num_complete)):
+            self.validate_substream(i, self[i])
+        return True
+
+    def validate_substream(self, i, data):
+        """ Check the CRC32 of the i-th sub-stream, given its bytes (eg, received after parsing), \
+            if present. Raise ValueError if corrupted.
+        """
+        if (i < len(self.crcs)) and (zlib.crc32(data) != self.crcs[i]):
+            raise ValueError(f'CRC mismatch in sub-stream {i}')
+
+
+def unpack_container(buffer, model_id=None, validate=True, partial=False):
+    """ Parse a container, see `pack_container()`.
+
+    Args:
+        buffer (bytes, bytearray, or memoryview): the container
+        model_id (str, optional): if provided, check that the container was produced by this model.
+        validate (bool, optional): check CRC32 checksums, if present. Defaults to True.
+        partial (bool, optional): accept a truncated container. See `Container`.
+
+    Returns:
+        Container: the parsed container
+    """
+    container = Container(buffer, partial=partial)
+    if (model_id is not None) and (container.model_id != model_id):
+        raise ValueError(f'The bitstream is produced by {container.model_id}, not {model_id}')
+    if validate:
+        container.validate()
+    return container
+
+
+def read_image(image):
+    """ Read an RGB image from memory, without touching the file system (except for paths)
+
+    Args:
+        image: one of
+            - bytes, bytearray, or memoryview: an encoded image file, eg, PNG or JPEG
+            - file-like object (binary): an encoded image file
+            - str or pathlib.Path: path to an image file
+            - PIL.Image
+            - np.ndarray: uint8, (H, W, 3) or (H, W)
+
+    Returns:
+        PIL.Image: RGB image
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image))
+    elif isinstance(image, np.ndarray):
+        assert image.dtype == np.uint8, f'{image.dtype=} should be uint8'
+        image = Image.fromarray(image)
+    elif not isinstance(image, Image.Image): # path or file-like object
+        image = Image.open(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def format_image_output(im, output='tensor'):
+    """ Convert a reconstructed image to the requested output type
+
+    Args:
+        im (torch.Tensor): (1, 3, H, W), values between (0, 1)
+        output (str, optional): 'tensor' returns `im` unchanged; 'numpy' returns a \
+            uint8 (H, W, 3) np.ndarray; 'pil' returns a PIL.Image. Defaults to 'tensor'.
+    """
+    if output == 'tensor':
+        return im
+    elif output in ('numpy', 'pil'):
+        im = im.squeeze(0).clamp(0, 1).mul(255).round_().to(dtype=torch.uint8)
+        im = im.permute(1, 2, 0).cpu().numpy()
+        return im if (output == 'numpy') else Image.fromarray(im)
+    raise ValueError(f'Unknown {output=}')
+
+
 def pad_divisible_by(img, div=64):
     """ Pad a PIL.Image such that both its sides are divisible by `div`
 
@@ -91,6 +340,28 @@ def pad_divisible_by(img, div=64):
     return padded
 
 
+def pad_tensor_divisible_by(im, div=64):
+    """ Pad an image tensor at right and bottom border (edge padding), \
+        such that both its sides are divisible by `div`
+
+    Args:
+        im (torch.Tensor): image, (1, C, H, W) or (C, H, W)
+        div (int, optional): denominator. Defaults to 64.
+
+    Returns:
+        torch.Tensor: padded image, (1, C, H, W)
+    """
+    im = im.unsqueeze(0) if (im.dim() == 3) else im
+    assert (im.dim() == 4) and (im.shape[0] == 1), f'{im.shape=}'
+    h_old, w_old = im.shape[2:4]
+    pad_h = (div - h_old % div) % div
+    pad_w = (div - w_old % div) % div
+    if (pad_h > 0) or (pad_w > 0):
+        # left, right, top, bottom
+        im = tnf.pad(im, pad=(0, pad_w, 0, pad_h), mode='replicate')
+    return im
+
+
 def crop_divisible_by(img, div=64):
     ''' Center crop a PIL.Image such that both its sides are divisible by `div`
 
@@ -110,6 +381,150 @@ def crop_divisible_by(img, div=64):
     return cropped
 
 
+def _tile_starts(length, tile_size, overlap):
+    starts = [0]
+    while starts[-1] + tile_size < length:
+        starts.append(starts[-1] + tile_size - overlap)
+    return starts
+
+
+def get_tile_boxes(img_h, img_w, tile_size=512, overlap=0):
+    """ Split an image into tiles. Consecutive tiles overlap by exactly `overlap` pixels, \
+        and the tiles at the right and bottom border are cropped to the image size.
+
+    Args:
+        img_h (int): image height
+        img_w (int): image width
+        tile_size (int, optional): tile size. Defaults to 512.
+        overlap (int, optional): overlap between neighboring tiles. Defaults to 0.
+
+    Returns:
+        list[tuple]: a list of (top, left, bottom, right)
+    """
+    assert 0 <= overlap <= tile_size // 2, f'{overlap=} should be in [0, {tile_size//2}]'
+    boxes = []
+    for y0 in _tile_starts(img_h, tile_size, overlap):
+        for x0 in _tile_starts(img_w, tile_size, overlap):
+            boxes.append((y0, x0, min(y0 + tile_size, img_h), min(x0 + tile_size, img_w)))
+    return boxes
+
+
+def _blending_ramp(length, overlap, ramp_start, ramp_end):
+    weight = torch.ones(length)
+    if overlap > 0:
+        ramp = (torch.arange(overlap, dtype=torch.float32) + 0.5) / overlap
+        if ramp_start:
+            weight[:overlap] = ramp
+        if ramp_end:
+            weight[-overlap:] = 1.0 - ramp
+    return weight
+
+
+def tile_blending_weight(box, img_h, img_w, overlap):
+    """ Linear blending weights of a tile. The weights of all tiles sum to one at every pixel.
+
+    Args:
+        box (tuple): (top, left, bottom, right), as given by `get_tile_boxes()`
+        img_h (int): image height
+        img_w (int): image width
+        overlap (int): overlap between neighboring tiles
+
+    Returns:
+        torch.Tensor: weight, (1, 1, bottom-top, right-left)
+    """
+    y0, x0, y1, x1 = box
+    wy = _blending_ramp(y1 - y0, overlap, ramp_start=(y0 > 0), ramp_end=(y1 < img_h))
+    wx = _blending_ramp(x1 - x0, overlap, ramp_start=(x0 > 0), ramp_end=(x1 < img_w))
+    return (wy.view(1, 1, -1, 1) * wx.view(1, 1, 1, -1))
+
+
+def _crop_tile(img, box):
+    y0, x0, y1, x1 = box
+    if isinstance(img, torch.Tensor):
+        img = img.unsqueeze(0) if (img.dim() == 3) else img
+        return img[:, :, y0:y1, x0:x1]
+    # PIL.Image. Only the tile is converted to a tensor
+    return tvf.to_tensor(img.crop((x0, y0, x1, y1))).unsqueeze_(0)
+
+
+def _map(func, iterable, workers):
+    """ Ordered map. If `workers` > 0, run in a thread pool with at most 2x`workers` pending tasks, \
+        such that the memory for finished-but-unconsumed results stays bounded.
+    """
+    if not workers:
+        yield from map(func, iterable)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def tiled_compress(img, encode_func, tile_size=512, overlap=0, workers=0, model_id='', crc=False):
+    """ Compress an image tile by tile. Each tile is encoded independently by `encode_func`.
+
+    Args:
+        img (PIL.Image or torch.Tensor): image. If a tensor, (1, 3, H, W) or (3, H, W).
+        encode_func (callable): (1, 3, h, w) tile tensor -> bytes
+        tile_size (int, optional): tile size, should be divisible by 64. Defaults to 512.
+        overlap (int, optional): overlap between neighboring tiles. Defaults to 0.
+        workers (int, optional): number of threads to encode tiles in parallel. Defaults to 0.
+        model_id (str, optional): model identifier stored in the container.
+        crc (bool, optional): store a CRC32 checksum for each tile. Defaults to False.
+
+    Returns:
+        bytes: a container (see `pack_container()`) with header `<2I2H` \
+            (height, width, tile size, overlap) and one `StreamKind.TILE` sub-stream per tile
+    """
+    assert tile_size % 64 == 0, f'{tile_size=} should be divisible by 64'
+    img_h, img_w = (img.shape[-2], img.shape[-1]) if isinstance(img, torch.Tensor) else (img.height, img.width)
+    boxes = get_tile_boxes(img_h, img_w, tile_size=tile_size, overlap=overlap)
+    tile_strings = list(_map(lambda box: encode_func(_crop_tile(img, box)), boxes, workers))
+    header = struct.pack('<2I2H', img_h, img_w, tile_size, overlap)
+    kinds = [StreamKind.TILE] * len(tile_strings)
+    return pack_container(model_id, header, tile_strings, kinds=kinds, crc=crc)
+
+
+def tiled_decompress(string, decode_func, workers=0, model_id=None):
+    """ Decompress an image tile by tile. Overlapping tiles are linearly blended at the seams.
+
+    Args:
+        string (bytes): bitstream produced by `tiled_compress()`
+        decode_func (callable): bytes -> (1, 3, h, w) tile tensor
+        workers (int, optional): number of threads to decode tiles in parallel. Defaults to 0.
+        model_id (str, optional): if provided, check that the bitstream was produced by this model.
+
+    Returns:
+        torch.Tensor: reconstructed image, (1, 3, H, W), on CPU
+    """
+    container = unpack_container(string, model_id=model_id)
+    img_h, img_w, tile_size, overlap = struct.unpack('<2I2H', container.header)
+    tile_strings = container.substreams(kind=StreamKind.TILE)
+    boxes = get_tile_boxes(img_h, img_w, tile_size=tile_size, overlap=overlap)
+    num = len(tile_strings)
+    assert len(boxes) == num, f'{len(boxes)=}, {num=}'
+
+    def _decode(i):
+        tile = decode_func(tile_strings[i]).cpu()
+        y0, x0, y1, x1 = boxes[i]
+        assert tile.shape[2:4] == (y1 - y0, x1 - x0), f'{tile.shape=}, {boxes[i]=}'
+        if overlap > 0:
+            tile = tile * tile_blending_weight(boxes[i], img_h, img_w, overlap)
+        return tile
+
+    im_hat = None
+    for i, tile in enumerate(_map(_decode, range(num), workers)):
+        if im_hat is None:
+            im_hat = torch.zeros(1, tile.shape[1], img_h, img_w, dtype=tile.dtype)
+        y0, x0, y1, x1 = boxes[i]
+        im_hat[:, :, y0:y1, x0:x1] += tile
+    return im_hat
+
+
 def bd_rate(r1, psnr1, r2, psnr2):
     """ Compute average bit rate difference between RD-2 and RD-1. (RD-1 is the baseline)
 
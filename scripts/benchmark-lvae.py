@@ -0,0 +1,89 @@
+""" Benchmark the registered models, and compare against a saved baseline. Examples:
+    python scripts/benchmark-lvae.py run -m qarv_base qres34m -r 256x256 512x512 -b 1 4 -t 1 8
+    python scripts/benchmark-lvae.py run -o runs/benchmarks/baseline.json
+    python scripts/benchmark-lvae.py compare runs/benchmarks/baseline.json runs/benchmarks/new.json
+"""
+import sys
+import time
+import argparse
+import torch
+import torch.backends.cudnn
+
+from lvae.models.registry import list_models
+from lvae.benchmark import (DEFAULT_RESOLUTIONS, run_benchmark, save_results, load_results,
+                            compare_results, format_comparison)
+
+
+def _parse_resolution(s: str):
+    width, height = [int(v) for v in s.lower().split('x')]
+    return (height, width)
+
+
+def run(args):
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+    torch.manual_seed(0)
+    kwargs = eval(f'dict({args.kwargs})')
+    data = run_benchmark(
+        args.models or list_models(), resolutions=args.resolutions, batch_sizes=args.batch_sizes,
+        threads=args.threads or [None], repeats=args.repeats, device=args.device,
+        images=args.images, model_kwargs=kwargs, async_transfer=args.async_transfer
+    )
+    for r in data['results']:
+        if 'skipped' in r:
+            print(f'{r["model"]:<20s} skipped: {r["skipped"]}')
+    output = args.output or f'runs/benchmarks/{time.strftime("%Y-%m-%d-%H-%M-%S")}.json'
+    save_results(data, output)
+    print(f'Saved results to {output}')
+    if args.baseline is not None:
+        return _compare(load_results(args.baseline), data, args.tolerance)
+    return 0
+
+
+def _compare(baseline, current, tolerance):
+    rows = compare_results(baseline, current, tolerance=tolerance)
+    print(format_comparison(rows))
+    num_regressions = sum([row['regression'] for row in rows])
+    print(f'{num_regressions} regressions (tolerance={tolerance*100:.0f}%) in {len(rows)} comparisons')
+    return 1 if num_regressions > 0 else 0
+
+
+def compare(args):
+    return _compare(load_results(args.baseline), load_results(args.current), args.tolerance)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='run the benchmark')
+    parser_run.add_argument('-m', '--models',      type=str,   default=None, nargs='+',
+                            help='default: all registered models')
+    parser_run.add_argument('-a', '--kwargs',      type=str,   default='pretrained=True')
+    parser_run.add_argument('-r', '--resolutions', type=_parse_resolution, nargs='+',
+                            default=DEFAULT_RESOLUTIONS, help='WxH, eg, 1920x1080')
+    parser_run.add_argument('-b', '--batch_sizes', type=int,   default=[1], nargs='+')
+    parser_run.add_argument('-t', '--threads',     type=int,   default=None, nargs='+')
+    parser_run.add_argument('-n', '--repeats',     type=int,   default=5)
+    parser_run.add_argument('-d', '--device',      type=str,   default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser_run.add_argument('-i', '--images',      type=str,   default='synthetic',
+                            help='synthetic, or a dataset name / path')
+    parser_run.add_argument('--async_transfer',    action='store_true',
+                            help='also measure the GPU idle time removed by asynchronous host transfers')
+    parser_run.add_argument('-o', '--output',      type=str,   default=None)
+    parser_run.add_argument('--baseline',          type=str,   default=None, help='compare against this file')
+    parser_run.add_argument('--tolerance',         type=float, default=0.1)
+    parser_run.set_defaults(func=run)
+
+    parser_cmp = subparsers.add_parser('compare', help='compare two benchmark results')
+    parser_cmp.add_argument('baseline', type=str)
+    parser_cmp.add_argument('current',  type=str)
+    parser_cmp.add_argument('--tolerance', type=float, default=0.1)
+    parser_cmp.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+""" Load generator for `serve.py`. Sends concurrent compress / decompress requests and reports
+throughput and latency. Example:
+    python serve.py --model qarv_base --max_batch 8 --max_delay_ms 10
+    python scripts/loadgen-serve.py -i images/ -c 16 -n 256 --mode mixed
+"""
+from pathlib import Path
+import time
+import random
+import asyncio
+import argparse
+import numpy as np
+import aiohttp
+
+
+async def _worker(session, url, jobs, latencies, errors, lmb):
+    while jobs:
+        kind, payload = jobs.pop()
+        params = {} if (lmb is None or kind == 'decompress') else {'lmb': str(lmb)}
+        t0 = time.perf_counter()
+        async with session.post(f'{url}/{kind}', data=payload, params=params) as resp:
+            await resp.read()
+            if resp.status != 200:
+                errors[resp.status] = errors.get(resp.status, 0) + 1
+                continue
+        latencies[kind].append(time.perf_counter() - t0)
+
+
+async def run(args):
+    img_paths = [args.input] if Path(args.input).is_file() else \
+        sorted([p for p in Path(args.input).rglob('*.*') if p.suffix.lower() in ('.png', '.jpg', '.jpeg')])
+    images = [p.read_bytes() for p in img_paths]
+    assert len(images) > 0, f'No image found in {args.input}'
+    timeout = aiohttp.ClientTimeout(total=None)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        # prepare bitstreams for decompression requests
+        bitstreams = []
+        if args.mode in ('decompress', 'mixed'):
+            for img in images:
+                async with session.post(f'{args.url}/compress', data=img) as resp:
+                    assert resp.status == 200, await resp.text()
+                    bitstreams.append(await resp.read())
+        random.seed(0)
+        jobs = []
+        for i in range(args.num_requests):
+            kind = args.mode if (args.mode != 'mixed') else random.choice(['compress', 'decompress'])
+            payload = random.choice(images if (kind == 'compress') else bitstreams)
+            jobs.append((kind, payload))
+
+        latencies = {'compress': [], 'decompress': []}
+        errors = dict()
+        t_start = time.perf_counter()
+        await asyncio.gather(*[
+            _worker(session, args.url, jobs, latencies, errors, args.lmb) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - t_start
+
+        async with session.get(f'{args.url}/metrics') as resp:
+            metrics = await resp.text()
+
+    num_ok = sum([len(v) for v in latencies.values()])
+    print(f'{args.num_requests} requests, concurrency={args.concurrency}, time={elapsed:.2f}s, '
+          f'throughput={num_ok/elapsed:.2f} requests/s, errors={errors}')
+    for kind, values in latencies.items():
+        if len(values) == 0:
+            continue
+        p50, p90, p99 = np.quantile(np.array(values), [0.5, 0.9, 0.99]).tolist()
+        print(f'{kind:>10s}: n={len(values)}, latency p50={p50*1000:.1f}ms, '
+              f'p90={p90*1000:.1f}ms, p99={p99*1000:.1f}ms')
+    print('---------------- server metrics ----------------')
+    print('\n'.join([line for line in metrics.splitlines() if not line.startswith('#')]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--url',          type=str, default='http://127.0.0.1:5000')
+    parser.add_argument('-i', '--input',        type=str, default='images')
+    parser.add_argument('-n', '--num_requests', type=int, default=128)
+    parser.add_argument('-c', '--concurrency',  type=int, default=8)
+    parser.add_argument('--mode',   type=str,   default='compress', choices=['compress', 'decompress', 'mixed'])
+    parser.add_argument('--lmb',    type=float, default=None)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
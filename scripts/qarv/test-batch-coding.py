@@ -0,0 +1,118 @@
+""" Test that batched encoding (`compress_batch()` and `compress_multi_rate()`) gives bitstreams \
+that decode correctly with single-image decoding (`decompress()`), and that batched decoding \
+(`decompress_batch()`) gives the same images. Each decoding is compared with the encoder-side \
+reconstruction, ie, the encoder's latents decoded at batch size 1. A mismatched CDF index \
+corrupts the rest of the bitstream, which shows up as a low PSNR. Examples:
+
+    python scripts/qarv/test-batch-coding.py -d cuda:0
+    # random weights, with non-trivial layer scaling (gamma) in all AdaLN blocks
+    python scripts/qarv/test-batch-coding.py -a "pretrained=False" --gamma 0.5 --sizes 150x200 256x384
+"""
+import sys
+import math
+import argparse
+import numpy as np
+import torch
+import torchvision.transforms.functional as tvf
+
+import lvae
+import lvae.models.common as common
+from lvae.utils.coding import format_image_output
+from lvae.benchmark import synthetic_images
+from lvae.models.qarv.model import DecoderState
+
+
+def psnr(a: np.ndarray, b: np.ndarray):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if (mse == 0) else -10 * math.log10(mse / 255**2)
+
+
+@torch.no_grad()
+def encoder_references(model, ims, lmbs):
+    """ Encoder-side reconstructions: the latents of a batched network pass (the same as in \
+    `compress_batch()`), decoded one image at a time.
+
+    Args:
+        ims (torch.Tensor): padded images, (N, 3, H, W), or (1, 3, H, W) for multiple lambdas
+        lmbs (list[float]): lambdas, one per image
+
+    Returns:
+        list[np.ndarray]: uint8 images, not cropped
+    """
+    lmb = torch.tensor(lmbs, device=ims.device)
+    with common.batch_invariant(): # as in `compress_batch()`
+        lv_block_results = model.forward_end2end(ims, lmb, mode='compress', get_latent=True)
+    latent_hw = (ims.shape[2] // model.max_stride, ims.shape[3] // model.max_stride)
+    references = []
+    for i, v in enumerate(lmbs):
+        state = DecoderState(model, v, latent_hw=latent_hw)
+        for stats in lv_block_results:
+            state.advance(latent=stats['z'][i:i+1])
+        references.append(format_image_output(state.preview(), 'numpy'))
+    return references
+
+
+def compare(name, outputs, references, threshold):
+    mismatched = 0
+    for i, (out, ref) in enumerate(zip(outputs, references)):
+        out = format_image_output(out, 'numpy')
+        value = psnr(out, ref[:out.shape[0], :out.shape[1]])
+        if value < threshold:
+            mismatched += 1
+            print(f'  {name}: image {i} is corrupted, PSNR {value:.2f} dB')
+    print(f'{name:<48s} mismatched {mismatched} / {len(outputs)}')
+    return mismatched
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',      type=str,   default='qarv_base')
+    parser.add_argument('-a', '--model_args', type=str,   default='pretrained=True')
+    parser.add_argument('-d', '--device',     type=str,   default='cpu')
+    parser.add_argument('-s', '--sizes',      type=str,   default=['150x200', '256x384'], nargs='+',
+                        help='image sizes, eg, 150x200')
+    parser.add_argument('-l', '--lambdas',    type=float, default=[16, 64, 256, 1024], nargs='+',
+                        help='one image per lambda')
+    parser.add_argument('--seeds',            type=int,   default=2)
+    parser.add_argument('--gamma',            type=float, default=None,
+                        help='if provided, set the layer scaling of all AdaLN blocks to this value')
+    parser.add_argument('--threshold',        type=float, default=45.0,
+                        help='PSNR (dB) w.r.t. the encoder-side reconstruction, below which a decoding is corrupted')
+    args = parser.parse_args()
+
+    kwargs = eval(f'dict({args.model_args})')
+    model = lvae.get_model(args.model, **kwargs)
+    if args.gamma is not None:
+        for m in model.modules():
+            if isinstance(m, common.ConvNeXtBlockAdaLN) and (m.gamma is not None):
+                m.gamma.data.fill_(args.gamma)
+    model = model.to(device=torch.device(args.device))
+    model.eval()
+    model.compress_mode(True)
+    device = model._dummy.device
+
+    failed = 0
+    for size in args.sizes:
+        height, width = [int(v) for v in size.split('x')]
+        for seed in range(args.seeds):
+            images = synthetic_images(len(args.lambdas), height, width, seed=seed)
+            ims = [tvf.to_tensor(img).unsqueeze_(0).to(device=device) for img in images]
+            padded = torch.cat([model._pad_to_stride(im) for im in ims], dim=0)
+            references = encoder_references(model, padded, args.lambdas)
+            strings = model.compress_batch(ims, lmbs=args.lambdas)
+            tag = f'{size} seed={seed}'
+            failed += compare(f'[{tag}] compress_batch -> decompress',
+                              [model.decompress(s) for s in strings], references, args.threshold)
+            failed += compare(f'[{tag}] compress_batch -> decompress_batch',
+                              model.decompress_batch(strings), references, args.threshold)
+            # all lambdas for the first image
+            references = encoder_references(model, padded[:1], args.lambdas)
+            strings = model.compress_multi_rate(ims[0], lmbs=args.lambdas)
+            failed += compare(f'[{tag}] compress_multi_rate -> decompress',
+                              [model.decompress(s) for s in strings], references, args.threshold)
+    sys.exit(1 if failed > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
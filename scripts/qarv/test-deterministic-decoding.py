@@ -0,0 +1,203 @@
+""" Cross-device round-trip test of deterministic decoding (see `set_deterministic()`). \
+Bitstreams are decoded on other devices / kernels, and compared with the encoder-side decoding. \
+A mismatched CDF index corrupts the rest of the bitstream, which shows up as a low PSNR. Examples:
+
+    # encode on one machine, and decode on another (eg, copy runs/det-test to a CPU node)
+    python scripts/qarv/test-deterministic-decoding.py encode -i path/to/images -d cuda:0 -o runs/det-test
+    python scripts/qarv/test-deterministic-decoding.py decode -o runs/det-test -d cpu --threads 4
+
+    # in one process: encode on cuda:0, decode on cpu with 1 and 8 threads, and on channels_last
+    # kernels; compare with the default mode, and check the decoding throughput budget
+    python scripts/qarv/test-deterministic-decoding.py roundtrip -i path/to/images -d cuda:0 \\
+        -t cpu:threads=1 cpu:threads=8 cuda:0:channels_last --compare_modes --budget 0.05
+"""
+from pathlib import Path
+from collections import OrderedDict
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import numpy as np
+from PIL import Image
+import torch
+
+import lvae
+from lvae.utils.coding import read_image, format_image_output
+from lvae.benchmark import synthetic_images
+
+
+def get_images(args):
+    if args.images is None:
+        return [(f'synthetic{i}', img) for i, img in enumerate(synthetic_images(args.num, 256, 384))]
+    paths = sorted([p for p in Path(args.images).rglob('*.*') if p.suffix.lower() in ('.png', '.jpg', '.jpeg')])
+    return [(p.stem, read_image(str(p))) for p in paths[:args.num]]
+
+
+def get_model(args, target='cpu', deterministic=True):
+    """ Load the model on a decoding target, eg, 'cpu', 'cpu:threads=8', 'cuda:0:channels_last'
+    """
+    parts = target.split(':')
+    options = [p for p in parts if (p == 'channels_last') or p.startswith('threads=')]
+    device = ':'.join([p for p in parts if p not in options])
+    for opt in options:
+        if opt.startswith('threads='):
+            torch.set_num_threads(int(opt.split('=')[1]))
+    kwargs = eval(f'dict({args.model_args})')
+    model = lvae.get_model(args.model, **kwargs)
+    model = model.to(device=torch.device(device))
+    if 'channels_last' in options:
+        model = model.to(memory_format=torch.channels_last)
+    model.eval()
+    model.compress_mode(True)
+    model.set_deterministic(deterministic)
+    return model
+
+
+def psnr(a: np.ndarray, b: np.ndarray):
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return float('inf') if (mse == 0) else -10 * math.log10(mse / 255**2)
+
+
+def _sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+@torch.no_grad()
+def encode_all(model, images, lambdas):
+    """ Returns:
+        list[dict]: one record per (image, lambda), with the bitstream and the encoder-side decoding
+    """
+    records = []
+    for name, img in images:
+        for lmb in lambdas:
+            string = model.compress_bytes(img, lmb=lmb)
+            reference = format_image_output(model.decompress_bytes(string), 'numpy')
+            records.append({'name': f'{name}-lmb{lmb:g}', 'string': string, 'reference': reference})
+    return records
+
+
+@torch.no_grad()
+def decode_all(model, records, threshold):
+    """ Decode all bitstreams, and compare with the encoder-side decoding.
+
+    Returns:
+        dict: number of mismatched images (PSNR below `threshold`), min PSNR, and decoding time
+    """
+    mismatched, min_psnr, total_time = [], float('inf'), 0.0
+    for r in records:
+        _sync()
+        t_start = time.perf_counter()
+        im = model.decompress_bytes(r['string'])
+        _sync()
+        total_time += time.perf_counter() - t_start
+        value = psnr(format_image_output(im, 'numpy'), r['reference'])
+        min_psnr = min(min_psnr, value)
+        if value < threshold:
+            mismatched.append(r['name'])
+    return {'mismatched': len(mismatched), 'total': len(records), 'min_psnr': min_psnr,
+            'decode_time': total_time / len(records), 'mismatched_names': mismatched}
+
+
+def _print_stats(label, stats):
+    print(f'{label:<40s} mismatched {stats["mismatched"]:>3d} / {stats["total"]:<3d}  '
+          f'min PSNR {stats["min_psnr"]:7.2f} dB  decode {stats["decode_time"]:.3f}s/image')
+
+
+def encode(args):
+    model = get_model(args, args.device, deterministic=not args.default_mode)
+    records = encode_all(model, get_images(args), args.lambdas)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for r in records:
+        (out_dir / f'{r["name"]}.bits').write_bytes(r['string'])
+        Image.fromarray(r['reference']).save(out_dir / f'{r["name"]}-reference.png')
+    manifest = OrderedDict()
+    manifest['model'] = args.model
+    manifest['deterministic'] = not args.default_mode
+    manifest['device'] = args.device
+    manifest['platform'] = platform.platform()
+    manifest['torch'] = torch.__version__
+    manifest['threads'] = torch.get_num_threads()
+    manifest['names'] = [r['name'] for r in records]
+    with open(out_dir / 'manifest.json', 'w') as f:
+        json.dump(manifest, fp=f, indent=4)
+    print(f'Saved {len(records)} bitstreams to {out_dir}')
+    return 0
+
+
+def decode(args):
+    out_dir = Path(args.out_dir)
+    with open(out_dir / 'manifest.json', 'r') as f:
+        manifest = json.load(f)
+    args.model = manifest['model']
+    target = args.device if (args.threads is None) else f'{args.device}:threads={args.threads}'
+    model = get_model(args, target, deterministic=manifest['deterministic'])
+    records = [{'name': name, 'string': (out_dir / f'{name}.bits').read_bytes(),
+                'reference': np.array(Image.open(out_dir / f'{name}-reference.png'))}
+               for name in manifest['names']]
+    stats = decode_all(model, records, args.threshold)
+    _print_stats(f'{manifest["device"]} -> {target}', stats)
+    return 1 if stats['mismatched'] > 0 else 0
+
+
+def roundtrip(args):
+    images = get_images(args)
+    modes = [True, False] if args.compare_modes else [True]
+    results = OrderedDict()
+    for deterministic in modes:
+        model = get_model(args, args.device, deterministic=deterministic)
+        records = encode_all(model, images, args.lambdas)
+        mode = 'deterministic' if deterministic else 'default'
+        results[mode] = {args.device: decode_all(model, records, args.threshold)}
+        del model
+        for target in args.targets:
+            results[mode][target] = decode_all(get_model(args, target, deterministic), records, args.threshold)
+        for target, stats in results[mode].items():
+            _print_stats(f'[{mode}] {args.device} -> {target}', stats)
+    status = 1 if any([st['mismatched'] > 0 for st in results['deterministic'].values()]) else 0
+    if args.compare_modes:
+        t_det = results['deterministic'][args.device]['decode_time']
+        t_default = results['default'][args.device]['decode_time']
+        overhead = t_det / t_default - 1
+        within = overhead <= args.budget
+        print(f'Decoding time overhead of the deterministic mode on {args.device}: {overhead*100:+.1f} % '
+              f'({"within" if within else "exceeds"} the budget of {args.budget*100:.0f} %)')
+        status = status if within else 1
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name in ('encode', 'decode', 'roundtrip'):
+        sub = subparsers.add_parser(name)
+        sub.add_argument('-m', '--model',      type=str,   default='qarv_base')
+        sub.add_argument('-a', '--model_args', type=str,   default='pretrained=True')
+        sub.add_argument('-d', '--device',     type=str,   default='cpu')
+        sub.add_argument('--threshold',        type=float, default=45.0,
+                         help='PSNR (dB) w.r.t. the encoder-side decoding, below which a decoding is corrupted')
+        if name in ('encode', 'decode'):
+            sub.add_argument('-o', '--out_dir', type=str,  default='runs/det-test')
+        if name in ('encode', 'roundtrip'):
+            sub.add_argument('-i', '--images', type=str,   default=None, help='default: synthetic images')
+            sub.add_argument('-n', '--num',    type=int,   default=8)
+            sub.add_argument('-l', '--lambdas', type=float, default=[16, 128, 1024], nargs='+')
+    subparsers.choices['encode'].add_argument('--default_mode', action='store_true',
+                                              help='encode without deterministic decoding, for comparison')
+    subparsers.choices['decode'].add_argument('--threads', type=int, default=None)
+    subparsers.choices['roundtrip'].add_argument('-t', '--targets', type=str, default=['cpu:threads=1'], nargs='+',
+                                                 help='decoding targets, eg, cpu:threads=8, cuda:0:channels_last')
+    subparsers.choices['roundtrip'].add_argument('--compare_modes', action='store_true',
+                                                 help='also test the default (non-deterministic) mode')
+    subparsers.choices['roundtrip'].add_argument('--budget', type=float, default=0.05,
+                                                 help='maximum decoding time overhead of the deterministic mode')
+    args = parser.parse_args()
+    func = {'encode': encode, 'decode': decode, 'roundtrip': roundtrip}[args.command]
+    sys.exit(func(args))
+
+
+if __name__ == '__main__':
+    main()
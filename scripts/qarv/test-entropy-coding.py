@@ -0,0 +1,64 @@
+""" Round-trip test of the entropy coding configurations (see `set_entropy_coding()`). \
+Each configuration must decode its own bitstreams to the same image as the sequential coder, \
+including process pools, which receive the sub-streams of the container. Examples:
+
+    python scripts/qarv/test-entropy-coding.py
+    python scripts/qarv/test-entropy-coding.py -a "pretrained=False" --workers 4
+"""
+import sys
+import argparse
+import torch
+
+import lvae
+from lvae.benchmark import synthetic_images
+
+
+def roundtrip(model, images, lmb):
+    outputs = []
+    for img in images:
+        string = model.compress_bytes(img, lmb=lmb)
+        outputs.append((string, model.decompress_bytes(string)))
+    return outputs
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',      type=str,   default='qarv_base')
+    parser.add_argument('-a', '--model_args', type=str,   default='pretrained=True')
+    parser.add_argument('-n', '--num',        type=int,   default=2)
+    parser.add_argument('-l', '--lmb',        type=float, default=256)
+    parser.add_argument('--workers',          type=int,   default=2)
+    args = parser.parse_args()
+
+    kwargs = eval(f'dict({args.model_args})')
+    model = lvae.get_model(args.model, **kwargs)
+    model.eval()
+    model.compress_mode(True)
+    images = synthetic_images(args.num, 192, 256)
+
+    configs = [
+        dict(channel_groups=1, workers=0),
+        dict(channel_groups=4, workers=0),
+        dict(channel_groups=4, workers=args.workers, executor='thread'),
+        dict(channel_groups=1, workers=args.workers, executor='process'),
+        dict(channel_groups=4, workers=args.workers, executor='process'),
+        dict(channel_groups=4, workers=args.workers, executor='process', coder='numpy-rans'),
+    ]
+    model.set_entropy_coding()
+    reference = roundtrip(model, images, args.lmb)
+    failed = 0
+    for cfg in configs:
+        model.set_entropy_coding(**cfg)
+        outputs = roundtrip(model, images, args.lmb)
+        ok = all([torch.equal(im, ref_im) for (_, im), (_, ref_im) in zip(outputs, reference)])
+        if cfg.get('coder', 'compressai') == 'compressai' and cfg['channel_groups'] == 1:
+            ok = ok and all([s == ref_s for (s, _), (ref_s, _) in zip(outputs, reference)])
+        failed += int(not ok)
+        print(f'{"ok  " if ok else "FAIL"} {cfg}')
+    model.set_entropy_coding()
+    sys.exit(1 if failed > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
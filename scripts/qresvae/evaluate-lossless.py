@@ -12,20 +12,18 @@ from lvae.models.qresvae.zoo import qres34m_lossless
 
 @torch.inference_mode()
 def evaluate_model(model, dataset_root):
-    tmp_bit_path = Path('tmp.bits')
-
     img_paths = list(Path(dataset_root).rglob('*.*'))
     img_paths.sort()
     pbar = tqdm(img_paths)
     accumulated_bpp = 0.0
     for impath in pbar:
-        model.compress_file(impath, tmp_bit_path)
-        num_bits = tmp_bit_path.stat().st_size * 8
-        fake = model.decompress_file(tmp_bit_path).squeeze(0).cpu()
-        tmp_bit_path.unlink()
+        img = Image.open(impath)
+        string = model.compress_bytes(img)
+        num_bits = len(string) * 8
+        fake = model.decompress_bytes(string).squeeze(0).cpu()
 
         # make sure the compression is lossless
-        real = tvf.pil_to_tensor(Image.open(impath)) # uint8
+        real = tvf.pil_to_tensor(img) # uint8
         fake = torch.round_(fake * 255.0).to(dtype=torch.uint8) # uint8
         assert torch.equal(real, fake)
         # compute bpp
@@ -0,0 +1,112 @@
+""" Quantize a model to INT8 for CPU inference, and report the BD-rate cost (w.r.t. VTM 18.0) \
+next to the speedup. Examples:
+    python scripts/quantize-lvae.py -m qarv_base -c path/to/calibration/images -n kodak
+    python scripts/quantize-lvae.py -m qres34m -c path/to/calibration/images --max_error 0.02
+"""
+from pathlib import Path
+from collections import OrderedDict
+import json
+import math
+import platform
+import argparse
+import torch
+
+from lvae.models.registry import get_model
+from lvae.models.quantization import calibrate, quantize_model, save_quantized
+from lvae.evaluation import imcoding_evaluate_parallel, compute_bd_rate_over_anchor, vtm_anchor_paths
+from lvae.benchmark import synthetic_images, benchmark_config
+
+
+def evaluate(model, args, lambdas):
+    results = imcoding_evaluate_parallel(model, args.dataset_name, lambdas=lambdas,
+                                         loader_workers=args.loader_workers, cache_dir=args.cache_dir)
+    results = OrderedDict([(k, list(v)) for k, v in results.items()])
+    if (lambdas is not None) and (args.dataset_name in vtm_anchor_paths):
+        results['bd-rate'] = compute_bd_rate_over_anchor(results, args.dataset_name)
+    height, width = args.speed_resolution
+    speed = benchmark_config(model, synthetic_images(1, height, width), repeats=args.repeats)
+    results['encode_time'] = speed['encode']['mean']
+    results['decode_time'] = speed['decode']['mean']
+    return results
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--model',        type=str,   default='qarv_base')
+    parser.add_argument('-a', '--model_args',   type=str,   default='pretrained=True')
+    parser.add_argument('-c', '--calib_dir',    type=str,   required=True, help='calibration images')
+    parser.add_argument('--calib_images',       type=int,   default=8)
+    parser.add_argument('--max_error',          type=float, default=0.05,
+                        help='quantize layers whose relative output error is at most this')
+    parser.add_argument('-n', '--dataset_name', type=str,   default='kodak')
+    parser.add_argument('-l', '--lmb_range',    type=float, default=None, nargs='+')
+    parser.add_argument('-s', '--steps',        type=int,   default=8)
+    parser.add_argument('--speed_resolution',   type=int,   default=[512, 768], nargs=2, help='height width')
+    parser.add_argument('--repeats',            type=int,   default=3)
+    parser.add_argument('--threads',            type=int,   default=None)
+    parser.add_argument('--loader_workers',     type=int,   default=2)
+    parser.add_argument('--cache_dir',          type=str,   default='runs/eval-cache')
+    parser.add_argument('-o', '--output',       type=str,   default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    kwargs = eval(f'dict({args.model_args})')
+    model = get_model(args.model, **kwargs)
+    model.eval()
+    model.compress_mode(True)
+
+    if hasattr(model, 'default_lmb'):
+        start, end = args.lmb_range or model.lmb_range
+        lambdas = torch.linspace(math.log(start), math.log(end), steps=args.steps).exp().tolist()
+    else:
+        print(f'==== model {args.model} is not variable-rate. Evaluating at its fixed rate ====')
+        lambdas = None
+
+    # calibration: quantize the layers whose output is least affected
+    errors = calibrate(model, args.calib_dir, max_images=args.calib_images,
+                       lambdas=None if (lambdas is None) else [lambdas[0], lambdas[-1]])
+    layers = [name for name, err in errors.items() if err <= args.max_error]
+    print(f'Quantizing {len(layers)} / {len(errors)} layers (relative error <= {args.max_error})')
+    qmodel = quantize_model(model, layers=layers)
+    qmodel.compress_mode(True)
+
+    output = Path(args.output or f'runs/quantized/{args.model}-int8.pt')
+    save_quantized(qmodel, output)
+    print(f'Saved quantized model to {output}')
+
+    report = OrderedDict()
+    report['name'] = args.model
+    report['test-set'] = args.dataset_name
+    report['platform'] = platform.platform()
+    report['engine'] = torch.backends.quantized.engine
+    report['threads'] = torch.get_num_threads()
+    report['lambdas'] = lambdas
+    report['layer_errors'] = errors
+    report['quantized_layers'] = layers
+    report['fp32'] = evaluate(model, args, lambdas)
+    report['int8'] = evaluate(qmodel, args, lambdas)
+    fp32, int8 = report['fp32'], report['int8']
+    report['speedup'] = {
+        'encode': fp32['encode_time'] / int8['encode_time'],
+        'decode': fp32['decode_time'] / int8['decode_time'],
+    }
+    with open(output.with_suffix('.json'), 'w') as f:
+        json.dump(report, fp=f, indent=4)
+    print(f'Saved report to {output.with_suffix(".json")} \n')
+
+    for name in ('fp32', 'int8'):
+        for k in ('bpp', 'psnr'):
+            vlist_str = ', '.join([f'{v:.12f}'[:7] for v in report[name][k]])
+            print(f'{name} {k:<6s} = [{vlist_str}]')
+    if 'bd-rate' in int8:
+        print(f'BD-rate w.r.t. VTM 18.0: fp32 {fp32["bd-rate"]:.2f} %, int8 {int8["bd-rate"]:.2f} %, '
+              f'cost {int8["bd-rate"] - fp32["bd-rate"]:+.2f} %')
+    msg = ', '.join([f'{k} {fp32[f"{k}_time"]:.3f}s -> {int8[f"{k}_time"]:.3f}s '
+                     f'({report["speedup"][k]:.2f}x)' for k in ('encode', 'decode')])
+    print(f'Speed ({args.speed_resolution[0]}x{args.speed_resolution[1]}): {msg}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+import argparse
+from time import time
+import torch
+
+import lvae.models.common as common
+
+
+def timeit(func, x, emb, iters, cuda_sync):
+    for _ in range(max(iters // 10, 1)): # warm up
+        func(x, emb)
+    if cuda_sync:
+        torch.cuda.synchronize()
+    t_start = time()
+    for _ in range(iters):
+        func(x, emb)
+    if cuda_sync:
+        torch.cuda.synchronize()
+    return (time() - t_start) / iters
+
+
+@torch.no_grad()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--channels',    type=int,   default=128)
+    parser.add_argument('-k', '--kernel_size', type=int,   default=7)
+    parser.add_argument('-r', '--mlp_ratio',   type=float, default=1.5)
+    parser.add_argument('-s', '--size',        type=int,   default=[256, 256], nargs=2)
+    parser.add_argument('-b', '--batch_size',  type=int,   default=1)
+    parser.add_argument('-i', '--iters',       type=int,   default=50)
+    parser.add_argument('--atol',              type=float, default=1e-5)
+    parser.add_argument('-d', '--device',      type=str,   default='cuda:0')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    cuda_sync = (device.type == 'cuda')
+    torch.manual_seed(0)
+
+    block = common.ConvNeXtBlockAdaLN(args.channels, embed_dim=256,
+                                      kernel_size=args.kernel_size, mlp_ratio=args.mlp_ratio)
+    block.gamma.data.uniform_(0.5, 1.5) # the default gamma (1e-6) hides numerical errors
+    block = block.to(device=device).eval()
+
+    H, W = args.size
+    x = torch.randn(args.batch_size, args.channels, H, W, device=device)
+    emb = torch.randn(args.batch_size, 256, device=device)
+
+    # reference block
+    y_ref = block(x, emb)
+    t_ref = timeit(block, x, emb, args.iters, cuda_sync)
+
+    # fused block, channels_last end to end
+    common.fuse_adaln_blocks(block, mode=True)
+    x_cl = x.contiguous(memory_format=torch.channels_last)
+    y_fused = block(x_cl, emb)
+    t_fused = timeit(block, x_cl, emb, args.iters, cuda_sync)
+
+    max_diff = (y_ref - y_fused).abs().max().item()
+    print(f'input=({args.batch_size}, {args.channels}, {H}, {W}), device={device}')
+    print(f'reference: {t_ref*1000:.3f} ms, fused: {t_fused*1000:.3f} ms, '
+          f'speedup: {t_ref/t_fused:.3f}x')
+    print(f'max abs difference = {max_diff:.3e}, tolerance = {args.atol:.1e}')
+    assert max_diff <= args.atol, f'{max_diff=} exceeds tolerance {args.atol}'
+
+    if args.batch_size > 1:
+        # per-sample MLP, as in batched entropy coding (see `common.batch_invariant()`)
+        with common.batch_invariant():
+            t_per_sample = timeit(block, x_cl, emb, args.iters, cuda_sync)
+        print(f'fused, batched MLP: {t_fused*1000:.3f} ms, fused, per-sample MLP: '
+              f'{t_per_sample*1000:.3f} ms, batched speedup: {t_per_sample/t_fused:.3f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,7 @@ import torchvision.transforms.functional as tvf
 
 from lvae.paths import known_datasets
 from lvae.models.registry import get_model
+from lvae.profiling import Profiler
 
 
 def speedtest(model, first=None, verbose=True):
@@ -44,6 +45,41 @@ def speedtest(model, first=None, verbose=True):
     return enc_time, dec_time
 
 
+def speedtest_batch(model, batch_size, first=None):
+    device = next(model.parameters()).device
+    cuda_sync = torch.cuda.is_available()
+
+    # find images
+    image_root = known_datasets['kodak']
+    img_paths = sorted(image_root.rglob('*.*'))
+    if first is not None:
+        img_paths = img_paths[:first]
+    ims = [tvf.to_tensor(Image.open(impath)).to(device=device) for impath in img_paths]
+
+    encode_time = 0
+    decode_time = 0
+    for start in range(0, len(ims), batch_size):
+        batch = ims[start:start+batch_size]
+
+        t_start = time()
+        strings = model.compress_batch(batch)
+        if cuda_sync:
+            torch.cuda.synchronize()
+        t_enc_finish = time()
+        outputs = model.decompress_batch(strings)
+        if cuda_sync:
+            torch.cuda.synchronize()
+        t_dec_finish = time()
+
+        encode_time += (t_enc_finish - t_start)
+        decode_time += (t_dec_finish - t_enc_finish)
+
+    # throughput in images/sec
+    enc_throughput = len(ims) / encode_time
+    dec_throughput = len(ims) / decode_time
+    return enc_throughput, dec_throughput
+
+
 @torch.no_grad()
 def main():
     parser = argparse.ArgumentParser()
@@ -51,6 +87,9 @@ def main():
     parser.add_argument('-a', '--kwargs',  type=str, default='pretrained=True')
     parser.add_argument('-d', '--device',  type=str, default='cuda:0')
     parser.add_argument('-w', '--workers', type=int, default=None)
+    parser.add_argument('-b', '--batch_sizes', type=int, default=[], nargs='+')
+    parser.add_argument('-p', '--profile', type=int, default=0, help='profile the first N images')
+    parser.add_argument('--trace_dir', type=str, default='runs/profile')
     args = parser.parse_args()
 
     print('---------------- version info ----------------')
@@ -85,6 +124,18 @@ def main():
         _ = speedtest(model, first=4, verbose=False) # warm up
         enc_time, dec_time = speedtest(model)
         print(f'encode time={enc_time:.3f}s, decode time={dec_time:.3f}s')
+        if args.batch_sizes and hasattr(model, 'compress_batch'):
+            _ = speedtest_batch(model, batch_size=max(args.batch_sizes), first=4) # warm up
+            for bs in args.batch_sizes:
+                enc_ips, dec_ips = speedtest_batch(model, batch_size=bs)
+                print(f'batch size={bs}: encode={enc_ips:.2f} images/s, decode={dec_ips:.2f} images/s')
+        if args.profile > 0:
+            with Profiler(model) as prof:
+                _ = speedtest(model, first=args.profile, verbose=False)
+            print(prof.table())
+            trace_path = f'{args.trace_dir}/{name}-trace.json'
+            prof.export_chrome_trace(trace_path)
+            print(f'Chrome trace saved to {trace_path}')
         print()
 
 
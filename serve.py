@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Production serving entry point for image compression using Lossy-VAE models.
+Requests from all connections are collected into micro-batches (see `lvae.serving`).
+
+Run with: python serve.py --models qarv_base qres34m_lossless qres34m:lmb=64 --workers 4
+
+Endpoints (raw binary bodies, no base64):
+    POST /compress?lmb=256       body: encoded image (PNG, JPEG, ...) -> bitstream
+    POST /decompress?format=png  body: bitstream -> PNG image (or format=raw: uint8 HxWx3 pixels)
+    Both accept `model=<spec>`, one of the `--models` specs. Defaults to the first one.
+    GET  /metrics                Prometheus metrics (queue depth, batch sizes, latency)
+    GET  /healthz
+"""
+import io
+import argparse
+import asyncio
+from aiohttp import web
+import torch
+
+from lvae import get_model
+from lvae.serving import (MicroBatcher, ServingMetrics, QueueFullError, ModelPool,
+                          ModelWorkerProcesses, parse_model_spec, run_model_batch)
+from lvae.utils.coding import read_image, format_image_output, unpack_container
+
+
+def _encode_png(im):
+    buffer = io.BytesIO()
+    format_image_output(im, 'pil').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+async def _get_batcher(request: web.Request):
+    """ Get (or create) the micro-batcher of the requested model """
+    app = request.app
+    spec = request.query.get('model', app['default_spec'])
+    if spec not in app['specs']:
+        raise web.HTTPNotFound(text=f'Unknown model={spec}, available: {list(app["specs"].keys())}')
+    if spec not in app['batchers']:
+        name, kwargs = app['specs'][spec]
+        pool: ModelPool = app['pool']
+        workers: ModelWorkerProcesses = app['workers']
+        if workers is None: # run in the server process
+            runner = lambda kind, payloads, params: run_model_batch(
+                pool.get(name, **kwargs), kind, payloads, params)
+            max_inflight = 1
+        else: # run in worker processes
+            runner = lambda kind, payloads, params: workers.submit(
+                name, kwargs, kind, payloads, params).result()
+            max_inflight = workers.num_workers
+        batcher = MicroBatcher(runner=runner, max_inflight=max_inflight, name=spec,
+                               metrics=app['metrics'], **app['batcher_kwargs'])
+        await batcher.start()
+        app['batchers'][spec] = batcher
+    return app['batchers'][spec], app['specs'][spec][0]
+
+
+async def handle_compress(request: web.Request):
+    batcher, _ = await _get_batcher(request)
+    lmb = request.query.get('lmb', None)
+    lmb = None if (lmb is None) else float(lmb)
+    body = await request.read()
+    loop = asyncio.get_running_loop()
+    # image decoding runs in the default thread pool, not in the event loop
+    try:
+        img = await loop.run_in_executor(None, read_image, body)
+    except Exception as e:
+        raise web.HTTPBadRequest(text=f'Cannot decode the image: {e}')
+    try:
+        string = await batcher.submit('compress', img, lmb=lmb)
+    except QueueFullError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+    headers = {'X-Image-Width': str(img.width), 'X-Image-Height': str(img.height)}
+    return web.Response(body=string, content_type='application/octet-stream', headers=headers)
+
+
+async def handle_decompress(request: web.Request):
+    batcher, model_name = await _get_batcher(request)
+    output_format = request.query.get('format', 'png')
+    if output_format not in ('png', 'raw'):
+        raise web.HTTPBadRequest(text=f'Unknown format={output_format}, should be png or raw')
+    body = await request.read()
+    # validate the container before queueing, such that a bad request does not reach the model
+    try:
+        unpack_container(body, model_id=model_name)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=f'Invalid bitstream: {e}')
+    try:
+        im_hat = await batcher.submit('decompress', body)
+    except QueueFullError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+    loop = asyncio.get_running_loop()
+    headers = {'X-Image-Width': str(im_hat.shape[3]), 'X-Image-Height': str(im_hat.shape[2])}
+    if output_format == 'png':
+        data = await loop.run_in_executor(None, _encode_png, im_hat)
+        return web.Response(body=data, content_type='image/png', headers=headers)
+    data = format_image_output(im_hat, 'numpy').tobytes()
+    return web.Response(body=data, content_type='application/octet-stream', headers=headers)
+
+
+async def handle_metrics(request: web.Request):
+    metrics: ServingMetrics = request.app['metrics']
+    return web.Response(text=metrics.to_prometheus(), content_type='text/plain')
+
+
+async def handle_health(request: web.Request):
+    return web.Response(text='ok')
+
+
+def make_app(pool: ModelPool, model_specs, workers=None, max_batch=8, max_delay=0.01,
+             max_queue=256, max_body_mb=20):
+    """ Create the aiohttp application.
+
+    Args:
+        pool (ModelPool): model pool
+        model_specs (list[str]): available models, `name` or `name:key=value,...`. \
+            See `lvae.serving.parse_model_spec()`. The first one is the default.
+        workers (ModelWorkerProcesses, optional): worker processes. If None, models run in \
+            a thread of the server process.
+        max_batch (int, optional): maximum number of requests per micro-batch.
+        max_delay (float, optional): latency budget (seconds) for collecting a micro-batch.
+        max_queue (int, optional): maximum number of queued requests (per model) before returning 503.
+        max_body_mb (int, optional): maximum request body size, in MB.
+    """
+    app = web.Application(client_max_size=max_body_mb * 1024 * 1024)
+    app['pool'] = pool
+    app['workers'] = workers
+    app['specs'] = {spec: parse_model_spec(spec) for spec in model_specs}
+    app['default_spec'] = model_specs[0]
+    app['metrics'] = ServingMetrics()
+    app['batchers'] = dict()
+    app['batcher_kwargs'] = dict(max_batch=max_batch, max_delay=max_delay, max_queue=max_queue)
+
+    async def _on_cleanup(app):
+        for batcher in app['batchers'].values():
+            await batcher.stop()
+        if app['workers'] is not None:
+            app['workers'].shutdown()
+
+    app.on_cleanup.append(_on_cleanup)
+    app.router.add_post('/compress', handle_compress)
+    app.router.add_post('/decompress', handle_decompress)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/healthz', handle_health)
+    return app
+
+
+def _get_pretrained_model(name, **kwargs):
+    kwargs.setdefault('pretrained', True)
+    return get_model(name, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--models',    type=str,   default=['qarv_base'], nargs='+')
+    parser.add_argument('-d', '--device',    type=str,   default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('-w', '--workers',   type=int,   default=0, help='CPU worker processes. 0: no worker process')
+    parser.add_argument('--threads_per_worker', type=int, default=1)
+    parser.add_argument('--max_model_mb',    type=int,   default=None, help='memory cap of loaded models')
+    parser.add_argument('--host',            type=str,   default='127.0.0.1')
+    parser.add_argument('--port',            type=int,   default=5000)
+    parser.add_argument('--max_batch',       type=int,   default=8)
+    parser.add_argument('--max_delay_ms',    type=float, default=10.0)
+    parser.add_argument('--max_queue',       type=int,   default=256)
+    parser.add_argument('--max_body_mb',     type=int,   default=20)
+    args = parser.parse_args()
+
+    max_bytes = None if (args.max_model_mb is None) else args.max_model_mb * 1024 * 1024
+    pool = ModelPool(max_bytes=max_bytes, device=args.device, model_func=_get_pretrained_model)
+    # load the default model before serving
+    name, kwargs = parse_model_spec(args.models[0])
+    print(f'Loading model {name} {kwargs} on {args.device}...')
+    pool.get(name, **kwargs)
+    workers = None
+    if args.workers > 0:
+        workers = ModelWorkerProcesses(pool, num_workers=args.workers,
+                                       threads_per_worker=args.threads_per_worker)
+
+    app = make_app(pool, args.models, workers=workers, max_batch=args.max_batch,
+                   max_delay=args.max_delay_ms / 1000, max_queue=args.max_queue,
+                   max_body_mb=args.max_body_mb)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -47,6 +47,8 @@ def parse_args():
     # device setting
     parser.add_argument('--fixseed',    action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument('--workers',    type=int,  default=6)
+    # profile the forward pass every N iterations. 0: no profiling
+    parser.add_argument('--profile_interval', type=int, default=0)
     cfg = parser.parse_args()
 
     # default settings
@@ -1,12 +1,11 @@
-import json
 import logging
 import argparse
 import torch
 from timm.utils import unwrap_model
 
-from lvae.utils.coding import bd_rate
 from lvae.paths import known_datasets
 from lvae.trainer import BaseTrainingWrapper
+from lvae.evaluation import compute_bd_rate_over_anchor
 from lvae.datasets import get_image_dateset, make_trainloader
 
 
@@ -52,6 +51,8 @@ def parse_args():
     # device setting
     parser.add_argument('--fixseed',    action=argparse.BooleanOptionalAction, default=True)
     parser.add_argument('--workers',    type=int,  default=6)
+    # profile the forward pass every N iterations. 0: no profiling
+    parser.add_argument('--profile_interval', type=int, default=0)
     cfg = parser.parse_args()
 
     # default settings
@@ -89,7 +90,7 @@ class TrainWrapper(BaseTrainingWrapper):
             'general/iter':  self._cur_iter
         }
         model_ = unwrap_model(self.model).eval()
-        results = model_.self_evaluate(val_img_dir, log_dir=log_dir, steps=cfg.val_steps)
+        results = model_.self_evaluate(val_img_dir, log_dir=log_dir, steps=cfg.val_steps, image_major=True)
         results_to_log = process_log_results(results, cfg.valset)
 
         _log_dic.update({'val-metrics/plain-'+k: v for k,v in results_to_log.items()})
@@ -107,7 +108,7 @@ class TrainWrapper(BaseTrainingWrapper):
         self._save_if_best(checkpoint)
 
         if cfg.ema:
-            results = self.ema.module.self_evaluate(val_img_dir, log_dir=log_dir, steps=cfg.val_steps)
+            results = self.ema.module.self_evaluate(val_img_dir, log_dir=log_dir, steps=cfg.val_steps, image_major=True)
             results_to_log = process_log_results(results, cfg.valset)
             _log_dic.update({'val-metrics/ema-'+k: v for k,v in results_to_log.items()})
             # save last checkpoint of EMA
@@ -147,27 +148,6 @@ def process_log_results(results, dataset_name='kodak'):
     print_json_like(results)
     return results_to_log
 
-def read_rd_stats_from_json(json_path):
-    with open(json_path, mode='r') as f:
-        stats = json.load(fp=f)
-    assert isinstance(stats, dict)
-    stats = stats.get('results', stats)
-    return stats
-
-def get_anchor_stats(dataset_name):
-    anchor_paths = {
-        'kodak': 'results/kodak/kodak-vtm18.0.json',
-        'tecnick-rgb-1200': 'results/tecnick-rgb-1200/tecnick-rgb-1200-vtm18.0.json',
-        'clic2022-test': 'results/clic2022-test/clic2022-test-vtm18.0.json'
-    }
-    anchor_stats = read_rd_stats_from_json(anchor_paths[dataset_name])
-    return anchor_stats
-
-def compute_bd_rate_over_anchor(stats, dataset_name):
-    anchor_stats = get_anchor_stats(dataset_name)
-    bdr = bd_rate(anchor_stats['bpp'], anchor_stats['psnr'], stats['bpp'], stats['psnr'])
-    return bdr
-
 def print_json_like(dict_of_list):
     for k, value in dict_of_list.items():
         if isinstance(value, list):
@@ -5,10 +5,8 @@ Run with: python web_demo.py
 Then open http://localhost:5000 in your browser.
 """
 
-import os
 import io
 import base64
-import tempfile
 import struct
 from pathlib import Path
 from flask import Flask, render_template, request, jsonify
@@ -17,6 +15,7 @@ import torch
 from torchvision.utils import save_image
 
 from lvae import get_model
+from lvae.utils.coding import unpack_container
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
@@ -39,40 +38,25 @@ def load_model():
     return model
 
 def decompress_from_bytes(bits_data):
-    """Decompress from bytes data instead of file path."""
-    # Create a temporary file to use with decompress_file
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.bits') as tmp_file:
-        tmp_file.write(bits_data)
-        tmp_path = tmp_file.name
-    
-    try:
-        model = load_model()
-        reconstructed = model.decompress_file(tmp_path)
-        return reconstructed
-    finally:
-        # Clean up temporary file
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
+    """Decompress from bytes data, in memory."""
+    model = load_model()
+    return model.decompress_bytes(bits_data)
 
 def validate_bits_file(bits_data):
-    """Validate that the bits file has the correct format."""
-    if len(bits_data) < 4:
-        raise ValueError("File is too small to be a valid bits file (must be at least 4 bytes)")
-    
-    # Check header (first 4 bytes should be image dimensions)
+    """Validate the bits file container (magic, version, model id, index, and CRCs).
+
+    Returns the image (height, width) stored in the header.
+    """
+    container = unpack_container(bits_data, model_id=model_name)
     try:
-        header = bits_data[:4]
-        img_h, img_w = struct.unpack('2H', header)
-        if img_h == 0 or img_w == 0 or img_h > 100000 or img_w > 100000:
-            raise ValueError("Invalid image dimensions in bits file header")
+        img_h, img_w = struct.unpack_from('<2H', container.header)
     except struct.error as e:
-        raise ValueError(f"Invalid bits file format: {str(e)}")
-    
-    # Check that there's enough data for at least lambda + shape + packed strings
-    if len(bits_data) < 4 + 4 + 6 + 1:  # header + lambda + shape + at least 1 byte for packed strings
+        raise ValueError(f"Invalid bits file header: {str(e)}")
+    if img_h == 0 or img_w == 0:
+        raise ValueError("Invalid image dimensions in bits file header")
+    if len(container) == 0:
         raise ValueError("File is too small - missing compression data")
-    
-    return True
+    return img_h, img_w
 
 @app.route('/')
 def index():
@@ -92,59 +76,41 @@ def compress():
         
         file_data = file.read()
         img = Image.open(io.BytesIO(file_data))
-        if img.mode in ('RGBA', 'LA', 'P'):
+        if img.mode != 'RGB':
             img = img.convert('RGB')
         
         original_size = len(file_data)
         
-        # Use temporary files for compression/decompression
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_img:
-            img.save(tmp_img.name)
-            tmp_img_path = tmp_img.name
+        # Compress and decompress in memory
+        model = load_model()
+        bits_data = model.compress_bytes(img, lmb=lmb)
+        compressed_size = len(bits_data)
+        bits_data_b64 = base64.b64encode(bits_data).decode()
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.bits') as tmp_bits:
-            tmp_bits_path = tmp_bits.name
+        # Decompress to get reconstructed image
+        reconstructed = model.decompress_bytes(bits_data)
         
-        try:
-            model = load_model()
-            model.compress_file(tmp_img_path, tmp_bits_path, lmb=lmb)
-            
-            # Read compressed size and data
-            compressed_size = os.path.getsize(tmp_bits_path)
-            with open(tmp_bits_path, 'rb') as f:
-                bits_data = f.read()
-            bits_data_b64 = base64.b64encode(bits_data).decode()
-            
-            # Decompress to get reconstructed image
-            reconstructed = model.decompress_file(tmp_bits_path)
-            
-            # Save reconstructed image to memory
-            img_buffer = io.BytesIO()
-            save_image(reconstructed, img_buffer, format='PNG')
-            img_buffer.seek(0)
-            img_data = base64.b64encode(img_buffer.read()).decode()
-            
-            compression_ratio = original_size / compressed_size
-            bpp = (compressed_size * 8) / (img.height * img.width)
-            
-            return jsonify({
-                'success': True,
-                'original_size': original_size,
-                'compressed_size': compressed_size,
-                'compression_ratio': round(compression_ratio, 2),
-                'bpp': round(bpp, 4),
-                'image_width': img.width,
-                'image_height': img.height,
-                'reconstructed_image': f"data:image/png;base64,{img_data}",
-                'bits_file_data': bits_data_b64,
-                'bits_file_name': f"{Path(file.filename).stem}.bits"
-            })
-        finally:
-            # Clean up temporary files
-            if os.path.exists(tmp_img_path):
-                os.unlink(tmp_img_path)
-            if os.path.exists(tmp_bits_path):
-                os.unlink(tmp_bits_path)
+        # Save reconstructed image to memory
+        img_buffer = io.BytesIO()
+        save_image(reconstructed, img_buffer, format='PNG')
+        img_buffer.seek(0)
+        img_data = base64.b64encode(img_buffer.read()).decode()
+        
+        compression_ratio = original_size / compressed_size
+        bpp = (compressed_size * 8) / (img.height * img.width)
+        
+        return jsonify({
+            'success': True,
+            'original_size': original_size,
+            'compressed_size': compressed_size,
+            'compression_ratio': round(compression_ratio, 2),
+            'bpp': round(bpp, 4),
+            'image_width': img.width,
+            'image_height': img.height,
+            'reconstructed_image': f"data:image/png;base64,{img_data}",
+            'bits_file_data': bits_data_b64,
+            'bits_file_name': f"{Path(file.filename).stem}.bits"
+        })
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -165,16 +131,13 @@ def decompress():
         
         # Validate the bits file format
         try:
-            validate_bits_file(bits_data)
+            img_h, img_w = validate_bits_file(bits_data)
         except ValueError as e:
             return jsonify({'error': f'Invalid bits file: {str(e)}'}), 400
         
         # Decompress from bytes
         reconstructed = decompress_from_bytes(bits_data)
         
-        # Extract image dimensions from the bits file header
-        img_h, img_w = struct.unpack('2H', bits_data[:4])
-        
         # Save reconstructed image to memory
         img_buffer = io.BytesIO()
         save_image(reconstructed, img_buffer, format='PNG')